@@ -11,11 +11,66 @@ A user can only send and receive messages and add new contacts if they are
 connected to a DSU server, otherwise they will only be able to view saved
 conversations.
 '''
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 import ds_messenger as dm
 from dsu_profile import Profile, DsuFileError
 
+# How often check_new looks for new messages, in milliseconds. Pushed
+# messages are already waiting in a local queue, so they are checked often.
+POLL_INTERVAL = 2000
+PUSH_CHECK_INTERVAL = 100
+# How often the results of network requests are checked, in milliseconds.
+RESPONSE_CHECK_INTERVAL = 50
+# Messages of a conversation inserted at once. Older ones are inserted when
+# the conversation is scrolled to the end of the ones shown.
+RENDER_BATCH = 100
+
+
+class NetworkWorker:
+    '''
+    Runs the calls that wait on the DSU server on a background thread so the
+    window stays responsive however slow the server is. Jobs are put on the
+    request queue and their results on the response queue, which the Tk
+    main thread drains by polling process_responses with after().
+    '''
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.responses = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, job: callable, on_done: callable, *args):
+        '''
+        Queues job(*args) to run on the worker thread. on_done is later
+        called on the Tk main thread with its result, or with the exception
+        it raised.
+        '''
+        self.requests.put((job, args, on_done))
+
+    def process_responses(self):
+        '''
+        Calls on_done for every job finished since the last call. Must be
+        called from the Tk main thread.
+        '''
+        while True:
+            try:
+                on_done, result = self.responses.get_nowait()
+            except queue.Empty:
+                return
+            on_done(result)
+
+    def _run(self):
+        while True:
+            job, args, on_done = self.requests.get()
+            try:
+                result = job(*args)
+            except Exception as ex:  # on_done reports it, the thread goes on
+                result = ex
+            self.responses.put((on_done, result))
+
 
 class Body(tk.Frame):
     '''
@@ -28,6 +83,9 @@ class Body(tk.Frame):
         self.root = root
         self._contacts = [str]
         self._select_callback = recipient_selected_callback
+        self._conversation = []     # messages of the conversation shown
+        self._oldest_shown = 0      # index of the oldest one inserted
+        self._showing_older = False
         # After all initialization is complete,
         # call the _draw method to pack the widgets
         # into the Body instance
@@ -87,11 +145,25 @@ class Body(tk.Frame):
         '''
         self.entry_editor.insert(1.0, message + '\n', 'entry-left')
 
+    def show_conversation(self, messages: list):
+        '''
+        Displays a conversation, a list of DirectMessage objects oldest
+        first, newest at the top of the conversation box. Only the newest
+        RENDER_BATCH messages are inserted; older ones are inserted a batch
+        at a time when the conversation is scrolled down to them.
+        '''
+        self.clear_messages()
+        self._conversation = messages
+        self._oldest_shown = len(messages)
+        self._show_older()
+
     def clear_messages(self):
         '''
         Clears the conversation box of all messages
         '''
         self.entry_editor.delete(1.0, tk.END)
+        self._conversation = []
+        self._oldest_shown = 0
 
     def get_text_entry(self) -> str:
         '''
@@ -108,6 +180,33 @@ class Body(tk.Frame):
         self.message_editor.delete(1.0, tk.END)
         self.message_editor.insert(1.0, text)
 
+    def _show_older(self):
+        '''
+        Inserts the next batch of older messages below the ones shown, with
+        a single call to the Text widget.
+        '''
+        self._showing_older = False
+        start = max(0, self._oldest_shown - RENDER_BATCH)
+        if start == self._oldest_shown:
+            return
+        chunks = []
+        for msg in reversed(self._conversation[start:self._oldest_shown]):
+            chunks += (msg.message + '\n',
+                       'entry-right' if msg.recipient else 'entry-left')
+        self._oldest_shown = start
+        self.entry_editor.insert(tk.END, *chunks)
+
+    def _scrolled(self, first: str, last: str):
+        '''
+        Moves the scrollbar with the conversation box, and inserts older
+        messages once the last one shown is in view.
+        '''
+        self._scrollbar.set(first, last)
+        if (float(last) >= 1.0 and self._oldest_shown
+                and not self._showing_older):
+            self._showing_older = True
+            self.after_idle(self._show_older)
+
     def _draw(self):
         posts_frame = tk.Frame(master=self, width=250)
         posts_frame.pack(fill=tk.BOTH, side=tk.LEFT)
@@ -139,11 +238,11 @@ class Body(tk.Frame):
         self.entry_editor.pack(fill=tk.BOTH, side=tk.LEFT,
                                expand=True, padx=0, pady=0)
 
-        entry_editor_scrollbar = tk.Scrollbar(master=scroll_frame,
-                                              command=self.entry_editor.yview)
-        self.entry_editor['yscrollcommand'] = entry_editor_scrollbar.set
-        entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT,
-                                    expand=False, padx=0, pady=0)
+        self._scrollbar = tk.Scrollbar(master=scroll_frame,
+                                       command=self.entry_editor.yview)
+        self.entry_editor['yscrollcommand'] = self._scrolled
+        self._scrollbar.pack(fill=tk.Y, side=tk.LEFT,
+                             expand=False, padx=0, pady=0)
 
 
 class Footer(tk.Frame):
@@ -230,11 +329,36 @@ class MainApp(tk.Frame):
         self.server = ''
         self.recipient = ''
         self.direct_messenger = ''
+        self.pushed_messages = None
+        self.profile = None
+        self.worker = NetworkWorker()
 
         # After all initialization is complete,
         # call the _draw method to pack the widgets
         # into the root frame
         self._draw()
+        self.after(RESPONSE_CHECK_INTERVAL, self.process_network_responses)
+
+    def close(self):
+        '''
+        Saves the changes to the profile that are still waiting to be
+        written, then closes the window.
+        '''
+        if self.profile:
+            try:
+                self.profile.stop_write_behind()
+            except DsuFileError:
+                messagebox.showerror("Save Failed",
+                                     "Unable to save the profile!")
+        self.root.destroy()
+
+    def process_network_responses(self):
+        '''
+        Hands the results of finished network requests to the methods
+        waiting for them, then checks again shortly.
+        '''
+        self.worker.process_responses()
+        self.after(RESPONSE_CHECK_INTERVAL, self.process_network_responses)
 
     def send_message(self):
         '''
@@ -250,24 +374,26 @@ class MainApp(tk.Frame):
         elif not msg:
             messagebox.showerror("Empty Message", "Invalid message!")
         else:
-            status = self.direct_messenger.send(msg, self.recipient)
-            if status is False:
-                messagebox.showerror("Disconnected", "Not connnected to a "
-                                     "server!")
-                return
-
-            self.body.insert_user_message(msg)
-            all_dms = self.direct_messenger.retrieve_all()
-            all_msgs = []
-            for dmsg in all_dms:
-                if isinstance(dmsg, dm.DirectMessage):
-                    new_msg = dmsg.to_dict()
-                    all_msgs.append(new_msg)
-
-            self.profile.save_messages([all_msgs.pop()])
-            self.profile.save_profile(f'{self.username}.dsu')
-
             self.body.set_text_entry('')
+            self.worker.submit(self.direct_messenger.send_message,
+                               lambda sent_msg: self._sent(msg, sent_msg),
+                               msg, self.recipient)
+
+    def _sent(self, msg: str, sent_msg):
+        '''
+        Displays and saves a message once the server has stored it, or gives
+        the message back to the entry box if it couldn't be sent.
+        '''
+        if not isinstance(sent_msg, dm.DirectMessage):
+            if not self.body.get_text_entry():
+                self.body.set_text_entry(msg)
+            messagebox.showerror("Disconnected", "Not connnected to a "
+                                 "server!")
+            return
+        if sent_msg.recipient == self.recipient:
+            self.body.insert_user_message(sent_msg.message)
+        self.profile.save_messages([sent_msg])
+        self.profile.save_profile(f'{self.username}.dsu')
 
     def add_contact(self):
         '''
@@ -292,15 +418,12 @@ class MainApp(tk.Frame):
 
     def display_recipient_messages(self):
         '''
-        Displays all saved messages for the currently selected recipient,
-        both sent and received, in the conversation box.
+        Displays the saved messages for the currently selected recipient,
+        both sent and received, in the conversation box. Older messages are
+        displayed as the conversation is scrolled to them.
         '''
-        all_msgs = self.profile.get_messages()
-        for msg in all_msgs:
-            if 'recipient' in msg and msg['recipient'] == self.recipient:
-                self.body.insert_user_message(msg['message'])
-            elif 'from' in msg and msg['from'] == self.recipient:
-                self.body.insert_contact_message(msg['message'])
+        self.body.show_conversation(
+            self.profile.get_conversation(self.recipient))
 
     def recipient_selected(self, recipient):
         '''
@@ -337,13 +460,17 @@ class MainApp(tk.Frame):
         self.username = ud.user
         self.password = ud.pwd
 
+        if self.profile:
+            self.profile.stop_write_behind()
         self.profile = Profile(self.server,
                                self.username,
                                self.password)
         try:
-            self.profile.load_profile(f'{self.username}.dsu')
+            self.profile.load_profile(f'{self.username}.dsu', lazy=True)
         except DsuFileError:
             self.profile.save_profile(f'{self.username}.dsu')
+        # Bursts of incoming messages are saved with one write
+        self.profile.start_write_behind()
 
         if not (self.profile.username == self.username
                 and self.profile.password == self.password):
@@ -351,47 +478,116 @@ class MainApp(tk.Frame):
                                  "Invalid username or password!")
             return
 
+        if ud.server and ud.server != self.server:
+            self.server = ud.server
+            self.direct_messenger = ''
+            cursor = self.profile.sync_cursor
+            if self.profile.dsuserver != self.server:
+                cursor = None
+            self.footer.footer_label['text'] = "Connecting..."
+            self.worker.submit(self._connect, self._connected, self.server,
+                               self.username, self.password, cursor)
+
         friends = self.profile.get_friends()
         for friend in friends:
             self.body.insert_contact(friend)
-        if ud.server and ud.server != self.server:
-            self.server = ud.server
-            self.direct_messenger = dm.DirectMessenger(self.server,
-                                                       self.username,
-                                                       self.password)
-
-
-            all_dms = self.direct_messenger.retrieve_all()
-            all_msgs = []
-            for dmsg in all_dms:
-                if isinstance(dmsg, dm.DirectMessage):
-                    msg = dmsg.to_dict()
-                    all_msgs.append(msg)
-            self.profile.overwrite_messages(all_msgs)
-            self.profile.save_profile(f'{self.username}.dsu')
-            self.after(2000, self.check_new)
+
+    @staticmethod
+    def _connect(server: str, username: str, password: str, cursor):
+        '''
+        Runs on the network worker. Joins the server, downloads the messages
+        stored since the cursor and subscribes to new messages. If the cursor
+        is None, or the server can't send the messages since it, returns the
+        full history as well, streamed from the server as it arrives, to
+        replace the messages of the profile. Large responses, such as the
+        full history, are compressed if the server can.
+        '''
+        messenger = dm.DirectMessenger(server, username, password,
+                                       compress=True)
+        history = None
+        new_dms = []
+        if cursor is None:
+            try:
+                history = list(messenger.iter_since(0))
+            except ValueError:
+                # Servers without delta sync can only send the full history
+                history = list(messenger.iter_all())
+        else:
+            new_dms = messenger.retrieve_since(cursor)
+            if not isinstance(new_dms, list):
+                history = list(messenger.iter_all())
+                new_dms = []
+        pushed_messages = queue.Queue()
+        if not messenger.subscribe(pushed_messages.put):
+            pushed_messages = None
+        return messenger, history, new_dms, pushed_messages
+
+    def _connected(self, result):
+        '''
+        Starts using the connection opened by _connect and saves the
+        messages it downloaded to the profile. The profile belongs to the
+        Tk main thread, so it is only changed here.
+        '''
+        if isinstance(result, Exception):
+            self.footer.footer_label['text'] = "Disconnected."
+            messagebox.showerror("Disconnected", "Unable to connect to the "
+                                 "server!")
+            return
+        messenger, history, new_dms, self.pushed_messages = result
+        self.direct_messenger = messenger
+        self.footer.footer_label['text'] = "Ready."
+        if history is not None:
+            self.profile.overwrite_messages(history)
+        self.profile.save_messages([dmsg for dmsg in new_dms
+                                    if isinstance(dmsg, dm.DirectMessage)])
+        self.profile.dsuserver = self.server
+        self.profile.sync_cursor = messenger.cursor
+        self.profile.save_profile(f'{self.username}.dsu')
+        self.after(POLL_INTERVAL, self.check_new)
 
     def check_new(self):
         '''
         The program continuously checks for new messages sent to the user every
-        2 seconds. If the user receives a message from a contact not already in
-        the contacts list, the new contact is saved to the user's list of
+        2 seconds, or reads the messages the server pushed if it supports
+        pushing them. If the user receives a message from a contact not already
+        in the contacts list, the new contact is saved to the user's list of
         friends and inserted into the contacts list. If the user receives a
         message from the currently selected contact, displays the new message.
         '''
-        if self.direct_messenger:
-            all_new = self.direct_messenger.retrieve_new()
-            all_new_msgs = []
-            for new in all_new:
-                if isinstance(new, dm.DirectMessage):
-                    new = new.to_dict()
-                    all_new_msgs.append(new)
-                    self.body.insert_contact(new['from'])
-                    if new['from'] == self.recipient:
-                        self.body.insert_contact_message(new['message'])
-                    self.profile.save_messages(all_new_msgs)
-                    self.profile.save_profile(f'{self.username}.dsu')
-            self.after(2000, self.check_new)
+        if self.direct_messenger and self.pushed_messages:
+            all_new = []
+            while not self.pushed_messages.empty():
+                all_new.extend(self.pushed_messages.get())
+            self._received(all_new)
+            self.after(PUSH_CHECK_INTERVAL, self.check_new)
+        elif self.direct_messenger:
+            self.worker.submit(self.direct_messenger.retrieve_new,
+                               self._polled)
+
+    def _polled(self, all_new):
+        '''
+        Shows the messages retrieve_new returned on the network worker, then
+        checks again after POLL_INTERVAL.
+        '''
+        if isinstance(all_new, list):
+            self._received(all_new)
+        self.after(POLL_INTERVAL, self.check_new)
+
+    def _received(self, all_new: list):
+        '''
+        Saves the new messages received by the user, adds their senders to
+        the contacts and displays the ones from the selected contact.
+        '''
+        all_new_msgs = []
+        for new in all_new:
+            if isinstance(new, dm.DirectMessage):
+                all_new_msgs.append(new)
+                self.body.insert_contact(new.sender)
+                if new.sender == self.recipient:
+                    self.body.insert_contact_message(new.message)
+        if all_new_msgs:
+            self.profile.save_messages(all_new_msgs)
+            self.profile.save_profile(f'{self.username}.dsu')
 
     def _draw(self):
         # Build a menu and add it to the root frame.
@@ -435,6 +631,7 @@ if __name__ == "__main__":
     # subclass Tk.Frame, since our root frame is main, we initialize
     # the class with it.
     app = MainApp(main)
+    main.protocol("WM_DELETE_WINDOW", app.close)
 
     # When update is called, we finalize the states of all widgets that
     # have been configured within the root frame. Here, update ensures that
@@ -0,0 +1,121 @@
+# Andrew Ngo
+# azngo@uci.edu
+# 63263981
+
+'''
+Benchmark of the memory used to hold a client's message history.
+Compares message dictionaries, as Profile used to save them, and a
+DirectMessage with a __dict__, as ds_messenger used to return them, with
+the slotted DirectMessage with interned usernames.
+
+Usage: python bench_message_memory.py [number of messages]
+'''
+
+import sys
+import gc
+import json
+import tracemalloc
+from ds_protocol import DirectMessage
+
+CONTACTS = 50
+
+
+class DictDirectMessage:
+    '''
+    DirectMessage as it was before it was slotted.
+    '''
+    def __init__(self):
+        self.sender = None
+        self.recipient = None
+        self.message = None
+        self.timestamp = None
+        self.id = None
+
+
+def server_messages(count: int) -> bytes:
+    '''
+    Returns a JSON response holding count messages, as a client would
+    receive it from the server.
+    '''
+    messages = []
+    for i in range(count):
+        msg = {'message': f'Message number {i}',
+               'timestamp': str(1700000000 + i / 7),
+               'id': i + 1}
+        if i % 2:
+            msg['from'] = f'contact{i % CONTACTS}'
+        else:
+            msg['recipient'] = f'contact{i % CONTACTS}'
+        messages.append(msg)
+    return json.dumps({'response': {'type': 'ok',
+                                    'messages': messages}}).encode()
+
+
+def as_dicts(lines: list) -> list:
+    '''
+    Copies of the parsed dictionaries, as Profile used to save them.
+    '''
+    return [dict(line) for line in lines]
+
+
+def as_dict_objects(lines: list) -> list:
+    '''
+    DirectMessage objects with a __dict__, as they used to be built.
+    '''
+    msgs = []
+    for line in lines:
+        dm = DictDirectMessage()
+        if 'recipient' in line:
+            dm.recipient = line['recipient']
+        else:
+            dm.sender = line['from']
+        dm.message = line['message']
+        dm.timestamp = line['timestamp']
+        dm.id = line.get('id')
+        msgs.append(dm)
+    return msgs
+
+
+def as_slotted(lines: list) -> list:
+    '''
+    Slotted DirectMessage objects, as they are built now.
+    '''
+    return [DirectMessage.from_dict(line) for line in lines]
+
+
+def measure(build: callable, response: bytes) -> int:
+    '''
+    Returns the bytes still allocated once the history is built from the
+    response and the parsed response is dropped.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    lines = json.loads(response)['response']['messages']
+    history = build(lines)
+    del lines
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del history
+    return size
+
+
+def main():
+    '''
+    Prints the memory used by each representation.
+    '''
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    response = server_messages(count)
+    print(f'{count} messages, {CONTACTS} contacts')
+    baseline = None
+    for name, build in (('dict', as_dicts),
+                        ('DirectMessage with __dict__', as_dict_objects),
+                        ('slotted DirectMessage', as_slotted)):
+        size = measure(build, response)
+        baseline = baseline or size
+        print(f'{name:30} {size / 2 ** 20:8.1f} MiB '
+              f'{size / count:6.0f} B/message {size / baseline:6.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Andrew Ngo
+# azngo@uci.edu
+# 63263981
+
+'''
+Benchmark of the CPU time spent encoding and parsing one direct message on
+its way from a client, through the server and back. Compares the str path,
+where every frame was decoded, stripped, dumped from a dictionary and
+encoded again, with the bytes path of ds_protocol. Then compares the size
+and the parsing time of a long history sent as JSON and as a binary frame,
+both with and without compression.
+
+Usage: python bench_protocol.py [number of messages] [history length]
+'''
+
+import sys
+import json
+import time
+import timeit
+import ds_protocol
+
+TOKEN = '4e1b9dd2-5fe9-4f3b-8d1a-3c1d2d0f9a77'
+RECORD = {'recipient': 'markb', 'message': 'Hello there, how are you?',
+          'timestamp': 1603167689.3928561, 'id': 1234}
+
+
+def str_path():
+    '''
+    One message sent and answered the way the client and server used to.
+    '''
+    request = ds_protocol.encode_json(
+        'directmessage', username='markb', token=TOKEN,
+        message='Hello there, how are you?',
+        timestamp=1603167689.3928561).encode() + b'\r\n'
+    command = json.loads(request.decode().strip())
+    response = json.dumps({'response': {
+        'type': 'ok', 'message': 'Direct message sent',
+        'record': RECORD}}).encode() + b'\r\n'
+    error = json.dumps({'response': {
+        'type': 'error', 'message': 'Invalid user token.'}}).encode() + b'\r\n'
+    ds_protocol.extract_json(response.decode().strip())
+    return command, error
+
+
+def bytes_path():
+    '''
+    The same message sent and answered with the bytes API.
+    '''
+    request = ds_protocol.encode_json_bytes(
+        'directmessage', username='markb', token=TOKEN,
+        message='Hello there, how are you?', timestamp=1603167689.3928561)
+    command = json.loads(request.strip())
+    response = ds_protocol.encode_response_bytes(
+        'ok', message='Direct message sent', record=RECORD)
+    error = ds_protocol.encode_response_bytes(
+        'error', message='Invalid user token.')
+    ds_protocol.parse_response_bytes(response)
+    return command, error
+
+
+def history(count: int) -> list:
+    '''
+    Returns count messages, as the server sends them in an 'all' response.
+    '''
+    messages = []
+    for i in range(count):
+        msg = {'message': f'Message number {i}',
+               'timestamp': str(1700000000 + i / 7),
+               'id': i + 1}
+        if i % 2:
+            msg['from'] = f'contact{i % 50}'
+        else:
+            msg['recipient'] = f'contact{i % 50}'
+        messages.append(msg)
+    return messages
+
+
+def measure(path: callable, count: int) -> float:
+    '''
+    Returns the best CPU time per message, in microseconds, of 5 runs.
+    '''
+    runs = timeit.repeat(path, timer=time.process_time,
+                         number=count, repeat=5)
+    return min(runs) / count * 1e6
+
+
+def main():
+    '''
+    Prints the CPU time per message of each path.
+    '''
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    assert str_path() == bytes_path()
+    print(f'{count} messages')
+    baseline = None
+    for name, path in (('str', str_path), ('bytes', bytes_path)):
+        per_message = measure(path, count)
+        baseline = baseline or per_message
+        print(f'{name:10} {per_message:6.2f} us/message '
+              f'{per_message / baseline:6.0%}')
+
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    messages = history(length)
+    print(f'history of {length} messages')
+    baseline = None
+    for name, encode, compress in (
+            ('json', ds_protocol.encode_response_bytes, False),
+            ('binary', ds_protocol.encode_binary_response, False),
+            ('json+zlib', ds_protocol.encode_response_bytes, True),
+            ('binary+zlib', ds_protocol.encode_binary_response, True)):
+        frame = encode('ok', messages=messages, cursor=None)
+        if compress:
+            frame = ds_protocol.compress_frame(frame)
+        found = ds_protocol.find_frame(frame)
+        frame = frame[:found[0]]
+        parse = min(timeit.repeat(
+            lambda frame=frame: ds_protocol.parse_response_bytes(frame),
+            timer=time.process_time, number=1, repeat=5))
+        baseline = baseline or len(frame)
+        print(f'{name:12} {len(frame) / 2 ** 20:6.2f} MiB '
+              f'{len(frame) / baseline:6.0%} {parse * 1e3:8.1f} ms to parse')
+
+
+if __name__ == '__main__':
+    main()
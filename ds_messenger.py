@@ -7,59 +7,127 @@ DSU client for a ICS32 DSP.
 Allows a user to communicate with other users on the server.
 '''
 
+import asyncio
 import socket
+import zlib
+import threading
+import collections
+import queue
+import time
 import ds_protocol
+from ds_protocol import DirectMessage
 
-
-class DirectMessage:
-    '''
-    Class for storing direct messages sent and received by users
-    '''
-    def __init__(self):
-        self.sender = None
-        self.recipient = None
-        self.message = None
-        self.timestamp = None
-
-    def to_dict(self):
-        '''
-        Method for converting a DirectMessage object to a dictionary.
-        '''
-        msg = {}
-        if self.sender:
-            msg['from'] = self.sender
-        else:
-            msg['recipient'] = self.recipient
-        msg['message'] = self.message
-        msg['timestamp'] = self.timestamp
-        return msg
+# Bytes read from the socket, or decompressed, at a time.
+READ_SIZE = 65536
+# Port of the DSU server, unless the server address is given as host:port.
+DEFAULT_PORT = 3001
+# Most requests send_many keeps in flight without reading their responses.
+PIPELINE_WINDOW = 256
+# Connection attempts made when the connection drops. The wait between two
+# attempts starts at RECONNECT_DELAY seconds and doubles up to
+# RECONNECT_MAX_DELAY.
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.25
+RECONNECT_MAX_DELAY = 4
 
 
 class DirectMessenger:
     '''
     Client class that handles communication between users on a DSU server.
-    Returns True if successful, False if unsuccessful
+    Returns True if successful, False if unsuccessful.
+    Keeps one connection to the server open for every request. If it drops,
+    reconnects with backoff and resumes the session, so the token stays
+    the same whenever the server still remembers it.
+    With binary=True, asks the server for binary responses, which are
+    smaller and faster to parse for long histories, and with compress=True for large responses
+    to be compressed, for slow links. Falls back to plain JSON responses
+    if the server can't.
     '''
-    def __init__(self, dsuserver=None, username=None, password=None):
+    def __init__(self, dsuserver=None, username=None, password=None,
+                 port=DEFAULT_PORT, binary=False, compress=False):
+        self.dsuserver = dsuserver
+        self.port = port
+        self.username = username
+        self.password = password
+        self.binary = binary
+        self.compress = compress
         self.token = None
-        self.client = connect_to_server(dsuserver)
-        data = join_server(self.client, username, password)
-        self.token = data
+        self.cursor = None
+        self.capabilities = set()
+        self._push_callback = None
+        self._pushed_id = 0     # highest id given to the push callback
+        self._responses = queue.Queue()
+        self._reconnect_lock = threading.Lock()
+        self._closed = False
+        self._conn = None
+        client = connect_to_server(dsuserver, port)
+        if client:
+            self._conn = _Connection(client)
+            self._start_session(self._conn)
 
     def send(self, message: str, recipient: str) -> bool:
         '''
         Attempts to send a message to the specified recipient.
         '''
+        return self.send_message(message, recipient) is not None
+
+    def send_message(self, message: str, recipient: str) -> DirectMessage:
+        '''
+        Attempts to send a message to the specified recipient. If successful,
+        returns the message as the server stored it, as a DirectMessage with
+        the server's timestamp and id. Returns None if unsuccessful.
+        '''
         if not self.token:
-            return False
-        json = ds_protocol.encode_json(msg_type='directmessage',
-                                       username=recipient,
-                                       message=message,
-                                       token=self.token).encode()
-        self.client.sendall(json + b'\r\n')
-        recv = ds_protocol.extract_json(self.client.recv(4096).strip())
-        recv_type = recv.msg_type
-        return recv_type == 'ok'
+            return None
+        try:
+            recv = self._request(resend=False,
+                                 msg_type='directmessage',
+                                 username=recipient,
+                                 message=message)
+        except OSError:
+            return None
+        return sent_direct_message(recv, message, recipient)
+
+    def send_many(self, messages) -> list:
+        '''
+        Attempts to send every (recipient, message) pair of an iterable.
+        If the server supports pipelining, writes the requests in batches
+        without waiting for each response and reads the responses as they
+        arrive; otherwise sends them one at a time. Returns a list with
+        True or False for each message, in order.
+        '''
+        messages = list(messages)
+        if not self.token:
+            return [False] * len(messages)
+        if 'pipelining' not in self.capabilities:
+            return [self.send(message, recipient)
+                    for recipient, message in messages]
+        frames = [ds_protocol.encode_json_bytes(msg_type='directmessage',
+                                                username=recipient,
+                                                message=message,
+                                                token=self.token)
+                  for recipient, message in messages]
+        results = []
+        pending = 0
+        conn = self._conn
+        try:
+            for i in range(0, len(frames), PIPELINE_WINDOW):
+                batch = frames[i:i + PIPELINE_WINDOW]
+                conn.send(b''.join(batch))
+                pending += len(batch)
+                # Keep at most one batch unanswered while the next is sent
+                while pending > len(batch):
+                    results.append(self._recv_response(conn).msg_type == 'ok')
+                    pending -= 1
+            while pending:
+                results.append(self._recv_response(conn).msg_type == 'ok')
+                pending -= 1
+        except OSError:
+            # The server may have stored any unanswered message, so they
+            # aren't resent
+            results += [False] * (len(frames) - len(results))
+            self._reconnect(conn)
+        return results
 
     def retrieve_new(self) -> list:
         '''
@@ -67,21 +135,10 @@ class DirectMessenger:
         returns a list of DirectMessage objects containing the contents.
         Returns an error message if unsuccessful.
         '''
-        json = ds_protocol.encode_json(msg_type='directmessage',
-                                       message='new',
-                                       token=self.token).encode()
-        self.client.sendall(json + b'\r\n')
-        recv = ds_protocol.extract_json(self.client.recv(4096).strip())
+        recv = self._request(resend=False,
+                             msg_type='directmessage', message='new')
         if recv.msg_type == 'ok':
-            lines = recv.message
-            new_msgs = []
-            for line in lines:
-                dm = DirectMessage()
-                dm.sender = line['from']
-                dm.message = line['message']
-                dm.timestamp = line['timestamp']
-                new_msgs.append(dm)
-            return new_msgs
+            return [to_direct_message(line) for line in recv.message]
         return recv.message
 
     def retrieve_all(self) -> list:
@@ -90,27 +147,589 @@ class DirectMessenger:
         successful, returns a list of DirectMessage objects. If unsuccessful,
         returns an error message.
         '''
-        json = ds_protocol.encode_json(msg_type='directmessage',
-                                       message='all',
-                                       token=self.token).encode()
-        self.client.sendall(json + b'\r\n')
-        recv = ds_protocol.extract_json(self.client.recv(4069).strip())
+        recv = self._request(msg_type='directmessage', message='all')
+        if recv.msg_type == 'ok':
+            return [to_direct_message(line) for line in recv.message]
+        return recv.message
+
+    def iter_all(self):
+        '''
+        Retrieves all messages like retrieve_all, but yields them as
+        DirectMessage objects as soon as each one arrives, so the history
+        never has to be in memory at once. Raises ValueError with the error
+        message if unsuccessful.
+        '''
+        yield from self._stream(msg_type='directmessage', message='all')
+
+    def iter_since(self, cursor: int = 0):
+        '''
+        Retrieves the messages stored after the given cursor like
+        retrieve_since, yielding them as they arrive. The cursor to pass
+        next time is saved once they all have. Raises ValueError with the
+        error message if unsuccessful.
+        '''
+        recv = yield from self._stream(msg_type='directmessage',
+                                       message='since', cursor=cursor)
+        self.cursor = recv.cursor
+
+    def subscribe(self, callback: callable) -> bool:
+        '''
+        Asks the server to push new messages to this connection as soon as
+        they arrive instead of waiting for retrieve_new. Starts a listener
+        thread that calls callback with a list of DirectMessage objects for
+        every push, including the unread messages waiting when subscribing.
+        The callback runs on the listener thread. Subscribes again after a
+        reconnect, which also delivers the pushes lost with the connection;
+        each message is given to callback once. Returns False if the server
+        doesn't support pushing messages.
+        '''
+        if not self.token or 'push' not in self.capabilities:
+            return False
+        recv = self._request(resend=False,
+                             msg_type='directmessage', message='subscribe')
+        if recv.msg_type != 'ok':
+            return False
+        self._push_callback = callback
+        self._deliver(recv.message)
+        self._start_listener(self._conn)
+        return True
+
+    def retrieve_pages(self, limit: int = 50):
+        '''
+        Generator that lazily retrieves the message history from the server
+        one page at a time, newest page first. Each page is a list of at most
+        limit DirectMessage objects, oldest first. Stops when the oldest page
+        was retrieved or the server returns an error.
+        '''
+        before = None
+        while True:
+            recv = self._request(msg_type='directmessage',
+                                 message='all',
+                                 limit=limit,
+                                 before=before)
+            if recv.msg_type != 'ok':
+                return
+            yield [to_direct_message(line) for line in recv.message]
+            before = recv.cursor
+            if before is None:
+                return
+
+    def retrieve_since(self, cursor: int = 0) -> list:
+        '''
+        Retrieves the messages, both sent and received, that the server
+        stored after the given cursor. If successful, returns a list of
+        DirectMessage objects and saves the cursor to pass next time in
+        the cursor attribute. If unsuccessful, returns an error message.
+        '''
+        recv = self._request(msg_type='directmessage',
+                             message='since',
+                             cursor=cursor)
         if recv.msg_type == 'ok':
-            lines = recv.message
-            all_msgs = []
-            for line in lines:
-                dm = DirectMessage()
-                if 'recipient' in line:
-                    dm.recipient = line['recipient']
+            self.cursor = recv.cursor
+            return [to_direct_message(line) for line in recv.message]
+        return recv.message
+
+    def close(self):
+        '''
+        Closes the connection to the server without reconnecting.
+        '''
+        self._closed = True
+        if self._conn:
+            self._conn.close()
+
+    def _request(self, resend: bool = True,
+                 **fields) -> ds_protocol.DataTuple:
+        '''
+        Encodes a request with the current token, sends it and returns the
+        response as a DataTuple. If the connection has dropped, reconnects
+        and sends the request again. If only the response was lost, the
+        request is sent again only when resend is True, since the server
+        may already have executed it. Raises ConnectionError if the server
+        can't be reached.
+        '''
+        conn = self._conn
+        for _ in range(2):
+            frame = ds_protocol.encode_json_bytes(token=self.token, **fields)
+            if conn is None:
+                conn = self._reconnect(conn)
+            try:
+                conn.send(frame)
+            except OSError:
+                conn = self._reconnect(conn)
+                continue
+            try:
+                return self._recv_response(conn)
+            except OSError:
+                conn = self._reconnect(conn)
+                if not resend:
+                    raise
+        raise ConnectionError("Connection to the server keeps dropping")
+
+    def _stream(self, **fields):
+        '''
+        Sends a request for messages and yields them as DirectMessage
+        objects as each one arrives. Returns the response without its
+        messages. Raises ValueError with the error message if unsuccessful.
+        '''
+        conn = self._conn
+        if conn is not None and conn.listener is None:
+            try:
+                conn.send(ds_protocol.encode_json_bytes(token=self.token,
+                                                        **fields))
+            except OSError:
+                conn = None
+        if conn is None or conn.listener is not None:
+            # Reconnecting, or subscribed and the listener thread reads
+            # the responses: the response comes whole
+            recv = self._request(**fields)
+            if recv.msg_type != 'ok':
+                raise ValueError(recv.message)
+            for line in recv.message:
+                yield to_direct_message(line)
+            return recv
+        stream = ds_protocol.MessageStream()
+        chunks = conn.read_chunks()
+        try:
+            for chunk in chunks:
+                for line in stream.feed(chunk):
+                    yield to_direct_message(line)
+            for line in stream.feed(b'', final=True):
+                yield to_direct_message(line)
+        except OSError as ex:
+            self._reconnect(conn)
+            raise ConnectionError("Connection dropped while retrieving "
+                                  "messages") from ex
+        finally:
+            chunks.close()  # skips the rest of an abandoned response
+        if stream.response.msg_type != 'ok':
+            raise ValueError(stream.response.message)
+        return stream.response
+
+    def _reconnect(self, failed):
+        '''
+        Replaces the failed connection, unless another thread already did.
+        Retries with exponential backoff, then restarts the session on the
+        new connection. Returns the new connection, or raises
+        ConnectionError if the server can't be reached.
+        '''
+        with self._reconnect_lock:
+            if self._conn is not failed:
+                return self._conn
+            if failed:
+                failed.close()
+            self._conn = None
+            if self._closed:
+                raise ConnectionError("The messenger was closed")
+            delay = RECONNECT_DELAY
+            for attempt in range(RECONNECT_ATTEMPTS):
+                if attempt:
+                    time.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                try:
+                    client = connect_to_server(self.dsuserver, self.port)
+                    if not client:
+                        continue
+                    conn = _Connection(client)
+                    self._start_session(conn)
+                except OSError:
+                    continue
+                self._conn = conn
+                return conn
+            raise ConnectionError("Unable to reconnect to the server")
+
+    def _start_session(self, conn):
+        '''
+        Resumes the session on a new connection if the server supports it,
+        otherwise joins, saving the token and the protocol extensions the
+        server supports. Subscribes again if pushes were subscribed to.
+        '''
+        recv = None
+        options = session_options(self.binary, self.compress,
+                                  self.capabilities if self.token else None)
+        if self.token and 'resume' in self.capabilities:
+            conn.send(ds_protocol.encode_json_bytes('resume',
+                                                    token=self.token,
+                                                    **options))
+            recv = ds_protocol.parse_response_bytes(conn.read_frame())
+        if recv is None or recv.msg_type != 'ok':
+            conn.send(ds_protocol.encode_json_bytes('join', self.username,
+                                                    self.password, **options))
+            recv = ds_protocol.parse_response_bytes(conn.read_frame())
+        if recv.msg_type != 'ok' and options:
+            conn.send(ds_protocol.encode_json_bytes('join', self.username,
+                                                    self.password))
+            recv = ds_protocol.parse_response_bytes(conn.read_frame())
+        self.token = recv.token
+        self.capabilities = set(recv.capabilities or ())
+        if self._push_callback and 'push' in self.capabilities:
+            conn.send(ds_protocol.encode_json_bytes(msg_type='directmessage',
+                                                    message='subscribe',
+                                                    token=self.token))
+            recv = ds_protocol.parse_response_bytes(conn.read_frame())
+            if recv.msg_type == 'ok':
+                self._deliver(recv.message)
+                self._start_listener(conn)
+
+    def _start_listener(self, conn):
+        '''
+        Starts the thread reading everything the server sends on conn, if
+        it isn't running yet.
+        '''
+        if conn.listener is None:
+            conn.listener = threading.Thread(target=self._listen,
+                                             args=(conn,), daemon=True)
+            conn.listener.start()
+
+    def _deliver(self, lines: list):
+        '''
+        Calls the push callback with the messages it wasn't given yet. The
+        server keeps pushed messages new, so subscribing again after a
+        reconnect returns the ones pushed before along with any lost.
+        '''
+        msgs = [to_direct_message(line) for line in lines or ()
+                if line['id'] > self._pushed_id]
+        if msgs:
+            self._pushed_id = max(msg.id for msg in msgs)
+            self._push_callback(msgs)
+
+    def _listen(self, conn):
+        '''
+        Reads everything the server sends once subscribed. Pushed messages
+        go to the push callback and responses to the response queue. When
+        the connection drops, or sends something that can't be read,
+        reconnects so pushes keep arriving.
+        '''
+        try:
+            while True:
+                recv = ds_protocol.parse_response_bytes(conn.read_frame())
+                if recv.msg_type == 'push':
+                    self._deliver(recv.message)
                 else:
-                    dm.sender = line['from']
+                    self._responses.put((conn, recv))
+        except Exception as ex:
+            self._responses.put((conn, ex))
+        try:
+            self._reconnect(conn)
+        except ConnectionError:
+            pass
+
+    def _recv_response(self, conn) -> ds_protocol.DataTuple:
+        '''
+        Returns the next response from the server on conn as a DataTuple.
+        Once subscribed, the listener thread reads the responses for us.
+        '''
+        if conn.listener is None:
+            return ds_protocol.parse_response_bytes(conn.read_frame())
+        source, recv = self._responses.get()
+        while source is not conn:  # left over from a dropped connection
+            source, recv = self._responses.get()
+        if isinstance(recv, Exception):
+            raise recv
+        return recv
+
+
+class AsyncDirectMessenger:
+    '''
+    asyncio version of DirectMessenger, so one event loop can drive many
+    accounts at once. Create it with the connect coroutine:
+        dm = await AsyncDirectMessenger.connect(server, username, password)
+    The methods are coroutines returning the same values as DirectMessenger.
+    Requests may be awaited concurrently on one messenger; the server
+    answers them in order.
+    '''
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self.token = None
+        self.cursor = None
+        self.capabilities = set()
+        self._reader = reader
+        self._writer = writer
+        self._pending = collections.deque()
+        self._push_callback = None
+        self._read_task = asyncio.get_running_loop().create_task(
+            self._read_responses())
 
-                dm.message = line['message']
-                dm.timestamp = line['timestamp']
-                all_msgs.append(dm)
-            return all_msgs
+    @classmethod
+    async def connect(cls, dsuserver, username, password,
+                      port=DEFAULT_PORT, binary=False, compress=False):
+        '''
+        Connects to the server and joins it, asking for binary responses if
+        binary is True and for large responses to be compressed if compress
+        is True. Returns the messenger, or None if the server can't be
+        reached.
+        '''
+        host, port = split_address(dsuserver, port)
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            return None
+        messenger = cls(reader, writer)
+        options = session_options(binary, compress)
+        recv = await messenger._request(ds_protocol.encode_json_bytes(
+            'join', username, password, **options))
+        if recv.msg_type != 'ok' and options:
+            recv = await messenger._request(
+                ds_protocol.encode_json_bytes('join', username, password))
+        messenger.token = recv.token
+        messenger.capabilities = set(recv.capabilities or ())
+        return messenger
+
+    async def send(self, message: str, recipient: str) -> bool:
+        '''
+        Attempts to send a message to the specified recipient.
+        '''
+        return await self.send_message(message, recipient) is not None
+
+    async def send_message(self, message: str,
+                           recipient: str) -> DirectMessage:
+        '''
+        Attempts to send a message to the specified recipient. Returns the
+        message as the server stored it, or None if unsuccessful.
+        '''
+        if not self.token:
+            return None
+        recv = await self._request(ds_protocol.encode_json_bytes(
+            msg_type='directmessage', username=recipient,
+            message=message, token=self.token))
+        return sent_direct_message(recv, message, recipient)
+
+    async def retrieve_new(self) -> list:
+        '''
+        Attempts to retrieve unread messages from the server. If successful,
+        returns a list of DirectMessage objects. Returns an error message if
+        unsuccessful.
+        '''
+        return await self._retrieve(ds_protocol.encode_json_bytes(
+            msg_type='directmessage', message='new', token=self.token))
+
+    async def retrieve_all(self) -> list:
+        '''
+        Retrieves all messages, both sent and received, from the server. If
+        successful, returns a list of DirectMessage objects. If unsuccessful,
+        returns an error message.
+        '''
+        return await self._retrieve(ds_protocol.encode_json_bytes(
+            msg_type='directmessage', message='all', token=self.token))
+
+    async def retrieve_since(self, cursor: int = 0) -> list:
+        '''
+        Retrieves the messages stored after the given cursor and saves the
+        cursor to pass next time in the cursor attribute. If unsuccessful,
+        returns an error message.
+        '''
+        recv = await self._request(ds_protocol.encode_json_bytes(
+            msg_type='directmessage', message='since', cursor=cursor,
+            token=self.token))
+        if recv.msg_type == 'ok':
+            self.cursor = recv.cursor
+            return [to_direct_message(line) for line in recv.message]
         return recv.message
 
+    async def subscribe(self, callback: callable) -> bool:
+        '''
+        Asks the server to push new messages as soon as they arrive. callback
+        is called on the event loop with a list of DirectMessage objects for
+        every push, including the unread messages waiting when subscribing.
+        Returns False if the server doesn't support pushing messages.
+        '''
+        if not self.token or 'push' not in self.capabilities:
+            return False
+        recv = await self._request(ds_protocol.encode_json_bytes(
+            msg_type='directmessage', message='subscribe', token=self.token))
+        if recv.msg_type != 'ok':
+            return False
+        self._push_callback = callback
+        if recv.message:
+            callback([to_direct_message(line) for line in recv.message])
+        return True
+
+    async def close(self):
+        '''
+        Closes the connection to the server.
+        '''
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        await self._read_task
+
+    async def _retrieve(self, request: bytes) -> list:
+        '''
+        Sends a request for messages and returns them as DirectMessage
+        objects, or the error message.
+        '''
+        recv = await self._request(request)
+        if recv.msg_type == 'ok':
+            return [to_direct_message(line) for line in recv.message]
+        return recv.message
+
+    async def _request(self, request: bytes) -> ds_protocol.DataTuple:
+        '''
+        Sends an encoded request and waits for its response. Raises
+        ConnectionError if the connection is closed.
+        '''
+        if self._read_task.done():
+            raise ConnectionError("Connection closed by the server")
+        response = asyncio.get_running_loop().create_future()
+        self._pending.append(response)
+        self._writer.write(request)
+        await self._writer.drain()
+        return await response
+
+    async def _read_responses(self):
+        '''
+        Reads everything the server sends, handing each response to the
+        oldest request still waiting and pushed messages to the push
+        callback. Responses no request is waiting for are ignored. Once
+        reading stops, the requests still waiting fail with the reason.
+        '''
+        error = ConnectionError("Connection closed by the server")
+        try:
+            while True:
+                frame = await self._read_frame()
+                recv = ds_protocol.parse_response_bytes(frame)
+                if recv.msg_type == 'push':
+                    if self._push_callback is not None:
+                        self._push_callback([to_direct_message(line)
+                                             for line in recv.message])
+                elif self._pending:
+                    response = self._pending.popleft()
+                    if not response.done():  # its caller may have given up
+                        response.set_result(recv)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        except Exception as ex:  # a bad frame or a failing push callback
+            error = ex
+        finally:
+            while self._pending:
+                response = self._pending.popleft()
+                if not response.done():
+                    response.set_exception(error)
+
+    async def _read_frame(self) -> bytes:
+        '''
+        Reads a full response frame, even one longer than the stream
+        reader's limit, and returns it: a JSON line without its CRLF or a
+        binary or compressed frame with its header.
+        '''
+        header = await self._reader.readexactly(1)
+        if header[0] in ds_protocol.FRAME_MARKERS:
+            header += await self._reader.readexactly(
+                ds_protocol.FRAME_HEADER.size - 1)
+            size = ds_protocol.FRAME_HEADER.unpack(header)[1]
+            return header + await self._reader.readexactly(size)
+        line = bytearray(header)
+        while True:
+            try:
+                line += await self._reader.readuntil(b'\r\n')
+                return bytes(line[:-2])
+            except asyncio.LimitOverrunError as ex:
+                line += await self._reader.readexactly(ex.consumed)
+
+
+class _Connection:
+    '''
+    One socket connected to a DSU server, with the bytes read from it that
+    don't make a full frame yet and the thread listening on it, if any.
+    '''
+    def __init__(self, client: socket.socket):
+        self.client = client
+        self.listener = None
+        self._buffer = bytearray()
+
+    def send(self, data: bytes):
+        '''
+        Writes data to the server.
+        '''
+        self.client.sendall(data)
+
+    def read_frame(self) -> bytes:
+        '''
+        Reads from the server until a full response frame has arrived,
+        however large it is, and returns it: a JSON line without its CRLF or
+        a binary or compressed frame with its header.
+        '''
+        found = ds_protocol.find_frame(self._buffer)
+        while found is None:
+            start = max(len(self._buffer) - 1, 0)
+            self._receive()
+            found = ds_protocol.find_frame(self._buffer, start)
+        end, following = found
+        frame = bytes(self._buffer[:end])
+        del self._buffer[:following]
+        return frame
+
+    def read_chunks(self):
+        '''
+        Reads the next response frame from the server, yielding it in chunks
+        as they arrive: pieces of a JSON line without its CRLF, a binary
+        frame whole, or the decompressed pieces of a compressed frame. If
+        closed before the end, skips the rest of the frame.
+        '''
+        while not self._buffer:
+            self._receive()
+        if self._buffer[0] in ds_protocol.FRAME_MARKERS:
+            frame = self.read_frame()
+            if frame[0] != ds_protocol.COMPRESSED_FRAME:
+                yield frame
+                return
+            decompressor = zlib.decompressobj()
+            data = memoryview(frame)[ds_protocol.FRAME_HEADER.size:]
+            while data:
+                yield decompressor.decompress(data, READ_SIZE)
+                data = decompressor.unconsumed_tail
+            yield decompressor.flush()
+            return
+        try:
+            while True:
+                end = self._buffer.find(b'\r\n')
+                if end != -1:
+                    chunk = bytes(self._buffer[:end])
+                    del self._buffer[:end + 2]
+                    break
+                # Keep a last \r, which may start the CRLF
+                end = len(self._buffer) - self._buffer.endswith(b'\r')
+                chunk = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                if chunk:
+                    yield chunk
+                self._receive()
+        except GeneratorExit:
+            try:
+                self.read_frame()
+            except OSError:
+                pass  # the next request reconnects
+            raise
+        yield chunk
+
+    def _receive(self):
+        '''
+        Adds the next bytes sent by the server to the buffer.
+        '''
+        data = self.client.recv(READ_SIZE)
+        if not data:
+            raise ConnectionError("Connection closed by the server")
+        self._buffer += data
+
+    def close(self):
+        '''
+        Closes the socket, waking up a thread blocked reading from it.
+        '''
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.client.close()
+
+
+def to_direct_message(line: dict) -> DirectMessage:
+    '''
+    Helper method that converts a message dictionary received from the
+    server to a DirectMessage object.
+    '''
+    return DirectMessage.from_dict(line)
+
 
 def join_server(client: socket,
                 username: str, password: str) -> ds_protocol.DataTuple:
@@ -121,23 +740,67 @@ def join_server(client: socket,
     '''
     if not client:
         return None
-    join_msg = ds_protocol.encode_json('join',
-                                       username,
-                                       password).encode()
-    client.sendall(join_msg + b'\r\n')
-    recv = client.recv(4096).decode().strip()
-    data = ds_protocol.extract_json(recv)
+    client.sendall(ds_protocol.encode_json_bytes('join', username, password))
+    data = ds_protocol.parse_response_bytes(client.recv(4096))
     return data.token
 
 
-def connect_to_server(server):
+def sent_direct_message(recv: ds_protocol.DataTuple,
+                        message: str, recipient: str) -> DirectMessage:
+    '''
+    Helper method that converts the response to a sent direct message to the
+    DirectMessage the server stored. Servers that don't return the stored
+    message only confirm it was sent, so it is rebuilt with a local
+    timestamp and no id. Returns None if the message wasn't sent.
+    '''
+    if recv.msg_type != 'ok':
+        return None
+    if recv.record:
+        return to_direct_message(recv.record)
+    return DirectMessage.from_dict({'recipient': recipient,
+                                    'message': message,
+                                    'timestamp': str(time.time())})
+
+
+def session_options(binary: bool, compress: bool,
+                    capabilities: set = None) -> dict:
+    '''
+    Helper method that returns the optional join or resume fields asking
+    for binary and compressed responses. With the capabilities of the
+    server, only asks for those it supports. Before the first join they are
+    unknown: servers without them reject the fields, and the join is sent
+    again without them.
+    '''
+    options = {}
+    if binary and (capabilities is None or 'binary' in capabilities):
+        options['encoding'] = 'binary'
+    if compress and (capabilities is None or 'compression' in capabilities):
+        options['compression'] = 'zlib'
+    return options
+
+
+def split_address(server, port=DEFAULT_PORT):
+    '''
+    Helper method that splits a server address given as host:port into its
+    host and port. Returns the server and port unchanged if it has no port.
+    '''
+    if server and ':' in server:
+        host, _, host_port = server.rpartition(':')
+        if host_port.isdigit():
+            return host, int(host_port)
+    return server, port
+
+
+def connect_to_server(server, port=DEFAULT_PORT):
     '''
-    Helper method that creates a socket and connects to the server. Returns the
+    Helper method that creates a socket and connects to the server. The
+    server can be given as host:port to use another port. Returns the
     socket.
     '''
+    server, port = split_address(server, port)
     try:
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((server, 3001))
+        client.connect((server, port))
         return client
     except ConnectionRefusedError:
         return None
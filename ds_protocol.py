@@ -4,59 +4,334 @@
 
 '''
 ds_protocol allows a client to parse messages received by a DSU server and
-encode messages sent to the server.
+encode messages sent to the server. DirectMessage is the form direct messages
+are kept in once parsed. Responses come either as JSON lines or, for clients
+that ask for it at join, as length-prefixed frames in the MessagePack format,
+with lists of messages packed column-wise.
+Clients may also ask for large responses to be compressed with zlib.
+MessageStream parses the messages of a response as they arrive.
 '''
 
+import re
+import sys
 import json
+import zlib
+import codecs
+import struct
+import functools
+from array import array
+from itertools import accumulate, repeat
 from collections import namedtuple
+from json.encoder import encode_basestring_ascii
+
+# Line terminator of every request and response frame.
+FRAME_END = b'\r\n'
+
+# Binary frames start with a marker byte, which no JSON line starts with,
+# followed by the length of their payload. The payload of a compressed
+# frame is another frame, JSON or binary, compressed with zlib.
+FRAME_HEADER = struct.Struct('>BI')
+BINARY_FRAME = 0x00
+COMPRESSED_FRAME = 0x01
+FRAME_MARKERS = frozenset((BINARY_FRAME, COMPRESSED_FRAME))
+
+# Structs of the MessagePack types with a fixed size, after their type byte.
+_UINT8 = struct.Struct('>BB')
+_UINT16 = struct.Struct('>BH')
+_UINT32 = struct.Struct('>BI')
+_UINT64 = struct.Struct('>BQ')
+_INT8 = struct.Struct('>Bb')
+_INT16 = struct.Struct('>Bh')
+_INT32 = struct.Struct('>Bi')
+_INT64 = struct.Struct('>Bq')
+_FLOAT32 = struct.Struct('>Bf')
+_FLOAT64 = struct.Struct('>Bd')
+
+# Lists of at least _TABLE_MIN_ROWS dictionaries, such as the messages of a
+# response, are packed column-wise in a MessagePack extension of type
+# _TABLE_EXT, so each key is sent once and the values are parsed a column at
+# a time.
+_TABLE_EXT = 1
+_TABLE_MIN_ROWS = 16
+# Array type codes of the unsigned 32 bit and signed 64 bit columns.
+_UINT32_ARRAY = 'I' if array('I').itemsize == 4 else 'L'
+_INT64_ARRAY = 'q'
+
+# Fragments of the frames built by encode_json_bytes and
+# encode_response_bytes. They join to the same bytes json.dumps gives for
+# the equivalent dictionaries.
+_TOKEN_START = b'{"token": '
+_ENTRY_START = b', "directmessage": {"entry": '
+_RECIPIENT_START = b', "recipient": '
+_TIMESTAMP_START = b', "timestamp": '
+_ENTRY_END = b'}}' + FRAME_END
+_DIRECTMESSAGE_READS = {
+    read: b', "directmessage": "' + read.encode() + b'"}' + FRAME_END
+    for read in ('new', 'all', 'subscribe')}
+_RESPONSE_START = b'{"response": {"type": '
+_RESPONSE_END = b'}}' + FRAME_END
+_RESPONSE_FIELDS = {
+    field: b', "' + field.encode() + b'": '
+    for field in ('message', 'messages', 'token', 'cursor',
+                  'capabilities', 'record')}
 
 # Namedtuple to hold the values retrieved from json messages.
-DataTuple = namedtuple('DataTuple', ['msg_type', 'message', 'token'])
+# cursor is only set by responses that return a sync cursor or the cursor of
+# the next page of history. capabilities lists the protocol extensions a
+# server advertises in its join response. record is the message a server
+# stored for a sent direct message.
+DataTuple = namedtuple('DataTuple',
+                       ['msg_type', 'message', 'token', 'cursor',
+                        'capabilities', 'record'],
+                       defaults=(None, None, None))
+
+
+class DirectMessage:
+    '''
+    Class for storing direct messages sent and received by users. Slotted
+    and with interned usernames, since a client may hold its whole history.
+    '''
+    __slots__ = ('sender', 'recipient', 'message', 'timestamp', 'id')
+
+    def __init__(self):
+        self.sender = None
+        self.recipient = None
+        self.message = None
+        self.timestamp = None
+        self.id = None
+
+    def __eq__(self, other):
+        if not isinstance(other, DirectMessage):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self.__slots__)
+
+    # Equal messages hash alike, so they can be kept in sets and used as
+    # keys, as long as they are not changed while they are
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in self.__slots__))
+
+    def to_dict(self):
+        '''
+        Method for converting a DirectMessage object to a dictionary.
+        '''
+        msg = {}
+        if self.sender:
+            msg['from'] = self.sender
+        else:
+            msg['recipient'] = self.recipient
+        msg['message'] = self.message
+        msg['timestamp'] = self.timestamp
+        if self.id is not None:
+            msg['id'] = self.id
+        return msg
+
+    @classmethod
+    def from_dict(cls, line: dict):
+        '''
+        Converts a message dictionary, as sent by the server or saved in a
+        DSU file, to a DirectMessage object.
+        '''
+        dm = cls()
+        if 'recipient' in line:
+            dm.recipient = sys.intern(line['recipient'])
+        else:
+            dm.sender = sys.intern(line['from'])
+        dm.message = line['message']
+        dm.timestamp = line['timestamp']
+        dm.id = line.get('id')
+        return dm
 
 
 def extract_json(json_msg: str) -> DataTuple:
     '''
     Call the json.loads function on a json string and
-    converts it to a DataTuple object
+    converts it to a DataTuple object. Responses of type 'push' hold the
+    messages a server pushes to a subscribed client.
     '''
     try:
         json_obj = json.loads(json_msg)
-        response = json_obj['response']
-        msg_type = json_obj['response']['type']
-        if msg_type == 'ok':
-            if 'token' in response:
-                token = response['token']
-            else:
-                token = ''
-            if 'message' in response:
-                message = response['message']
-            elif 'messages' in response:
-                message = response['messages']
-            else:
-                raise ValueError("ProtocolError: No message found")
-        elif msg_type == 'error':
-            message = response['message']
-            token = ''
-        else:
-            raise ValueError(f"ProtocolError: Invalid message type {msg_type}")
-
     except json.JSONDecodeError:
         print("Json cannot be decoded.")
 
-    return DataTuple(msg_type=msg_type, message=message, token=token)
+    return _data_tuple(json_obj)
+
+
+def parse_response_bytes(frame: bytes) -> DataTuple:
+    '''
+    Converts a response frame, as read from the socket, to a DataTuple
+    object without decoding it to a str first. The frame is either a JSON
+    line without its CRLF or a binary or compressed frame with its header.
+    Raises ValueError if the frame is not a valid response.
+    '''
+    if frame and frame[0] == COMPRESSED_FRAME:
+        try:
+            frame = zlib.decompress(frame[FRAME_HEADER.size:])
+        except zlib.error as ex:
+            raise ValueError(f"ProtocolError: {ex}") from ex
+    if frame and frame[0] == BINARY_FRAME:
+        return _data_tuple(unpack(frame[FRAME_HEADER.size:]))
+    return _data_tuple(json.loads(frame))
+
+
+class MessageStream:
+    '''
+    Parses a response frame fed in chunks, returning the messages it holds
+    as soon as each one has arrived, so a long history never has to be in
+    memory at once. Binary frames are parsed once they have fully arrived.
+    Once the frame ends, response is the DataTuple of the response with an
+    empty list of messages.
+    '''
+    _DECODER = json.JSONDecoder()
+    _MESSAGES_START = re.compile(r'"messages"\s*:\s*\[')
+    _SEPARATORS = re.compile(r'[\s,]*')
+
+    def __init__(self):
+        self.response = None
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''         # text not parsed yet
+        self._head = None       # text of the response up to the messages
+        self._closed = False    # True once the list of messages has ended
+        self._binary = None     # chunks of a binary frame
+        self._started = False
+
+    def feed(self, chunk: bytes, final: bool = False) -> list:
+        '''
+        Parses the next chunk of the frame, the last one if final is True.
+        Returns the messages completed by it as dictionaries. Raises
+        ValueError if the frame is not a valid response.
+        '''
+        if not self._started and chunk:
+            self._started = True
+            if chunk[0] == BINARY_FRAME:
+                self._binary = []
+        if self._binary is not None:
+            self._binary.append(chunk)
+            if not final:
+                return []
+            return self._finish(parse_response_bytes(b''.join(self._binary)))
+        self._text += self._utf8.decode(chunk, final)
+        if self._head is None:
+            match = self._MESSAGES_START.search(self._text)
+            if match is None:
+                if final:  # a response without messages, such as an error
+                    return self._finish(_data_tuple(json.loads(self._text)))
+                return []
+            self._head = self._text[:match.end()]
+            self._text = self._text[match.end():]
+        messages = []
+        if not self._closed:
+            messages = self._parse_messages(final)
+        if final:
+            if not self._closed:
+                raise ValueError("ProtocolError: Truncated messages")
+            self._finish(_data_tuple(json.loads(self._head + self._text)))
+        return messages
+
+    def _parse_messages(self, final: bool) -> list:
+        '''
+        Parses the messages that have fully arrived, keeping the text of the
+        next one. The text after the list is kept with its closing bracket.
+        '''
+        messages = []
+        text = self._text
+        pos = 0
+        while True:
+            pos = self._SEPARATORS.match(text, pos).end()
+            if pos == len(text):
+                break
+            if text[pos] == ']':
+                self._closed = True
+                break
+            if text[pos] != '{':
+                raise ValueError("ProtocolError: Invalid message")
+            try:
+                msg, pos = self._DECODER.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break  # the rest of the message hasn't arrived yet
+            messages.append(msg)
+        self._text = text[pos:]
+        return messages
+
+    def _finish(self, recv: DataTuple) -> list:
+        '''
+        Saves the response without its messages and returns the messages.
+        '''
+        if isinstance(recv.message, list):
+            self.response = recv._replace(message=[])
+            return recv.message
+        self.response = recv
+        return []
+
+
+def find_frame(buffer: bytes, start: int = 0):
+    '''
+    Finds the first full response frame at the beginning of buffer. Returns
+    the end of the frame and the start of the next one, or None if it has
+    not fully arrived yet. start is where to resume looking for the CRLF
+    ending a JSON line.
+    '''
+    if buffer and buffer[0] in FRAME_MARKERS:
+        if len(buffer) < FRAME_HEADER.size:
+            return None
+        end = FRAME_HEADER.size + FRAME_HEADER.unpack_from(buffer)[1]
+        return (end, end) if len(buffer) >= end else None
+    end = buffer.find(FRAME_END, start)
+    return (end, end + len(FRAME_END)) if end != -1 else None
+
+
+def _data_tuple(json_obj: dict) -> DataTuple:
+    '''
+    Converts a parsed response to a DataTuple object.
+    '''
+    response = json_obj['response']
+    msg_type = json_obj['response']['type']
+    if msg_type in ('ok', 'push'):
+        if 'token' in response:
+            token = response['token']
+        else:
+            token = ''
+        if 'message' in response:
+            message = response['message']
+        elif 'messages' in response:
+            message = response['messages']
+        else:
+            raise ValueError("ProtocolError: No message found")
+    elif msg_type == 'error':
+        message = response['message']
+        token = ''
+    else:
+        raise ValueError(f"ProtocolError: Invalid message type {msg_type}")
+
+    return DataTuple(msg_type=msg_type, message=message, token=token,
+                     cursor=response.get('cursor'),
+                     capabilities=response.get('capabilities'),
+                     record=response.get('record'))
 
 
 def encode_json(msg_type: str,
                 username: str = None, password: str = None,
                 message: str = None, timestamp=None,
-                token: str = None):
+                token: str = None, cursor: int = None,
+                limit: int = None, before: int = None,
+                encoding: str = None, compression: str = None):
     '''
-    Encodes message types of ('join', 'post', 'bio', 'directmessage').
+    Encodes message types of ('join', 'resume', 'post', 'bio',
+    'directmessage').
     'join' requires a username and password
+    'resume' requires the token of a session to continue on a new connection
+    'join' & 'resume' ask for responses in the given encoding ('json' or
+    'binary') and large ones compressed with the given compression ('none'
+    or 'zlib'), if they are given.
     'post' & 'bio' requirse a token received from the server and a message
-    'directmessage' requires a token and three types of messages.
-    If 'all', encodes a request for all messages saved in a user.
+    'directmessage' requires a token and five types of messages.
+    If 'all', encodes a request for all messages saved in a user, or for
+    one page of at most limit messages with an id below before.
     If 'new', encodes a request for new messages sent to a user.
+    If 'since', encodes a request for the messages after a cursor.
+    If 'subscribe', encodes a request to have new messages pushed.
     Else, requires a username to send the message to.
 
     '''
@@ -66,6 +341,19 @@ def encode_json(msg_type: str,
         msg = {msg_type: {"username": username,
                           "password": password,
                           "token": ""}}
+        if encoding:
+            msg[msg_type]["encoding"] = encoding
+        if compression:
+            msg[msg_type]["compression"] = compression
+
+    elif msg_type == 'resume':
+        if not token:
+            raise ValueError("ProtocolError: No token")
+        msg = {msg_type: {"token": token}}
+        if encoding:
+            msg[msg_type]["encoding"] = encoding
+        if compression:
+            msg[msg_type]["compression"] = compression
 
     elif msg_type in ('post', 'bio'):
         if not token or not message:
@@ -81,11 +369,466 @@ def encode_json(msg_type: str,
                    msg_type: {"entry": message,
                               "recipient": username,
                               "timestamp": timestamp}}
-        elif message in ('new', 'all'):
+        elif message == 'all' and (limit or before):
+            page = {}
+            if limit:
+                page["limit"] = limit
+            if before:
+                page["before"] = before
+            msg = {"token": token, msg_type: {"all": page}}
+        elif message in ('new', 'all', 'subscribe'):
             msg = {"token": token, msg_type: message}
+        elif message == 'since':
+            msg = {"token": token, msg_type: {"since": cursor or 0}}
         else:
             raise ValueError("ProtocolError: Invalid directmessage")
     else:
         raise ValueError("ProtocolError: Invalid message type")
 
     return json.dumps(msg)
+
+
+def encode_json_bytes(msg_type: str,
+                      username: str = None, password: str = None,
+                      message: str = None, timestamp=None,
+                      token: str = None, cursor: int = None,
+                      limit: int = None, before: int = None,
+                      encoding: str = None,
+                      compression: str = None) -> bytes:
+    '''
+    Encodes the same messages as encode_json, as a frame of bytes ready to
+    be sent. Direct messages, the requests a client sends most, are joined
+    from precomputed fragments instead of being dumped from a dictionary.
+    '''
+    if msg_type == 'directmessage' and token and message:
+        if username:
+            return b''.join((_TOKEN_START, _json_bytes(token),
+                             _ENTRY_START, _json_bytes(message),
+                             _RECIPIENT_START, _json_bytes(username),
+                             _TIMESTAMP_START, _json_bytes(timestamp),
+                             _ENTRY_END))
+        if message in _DIRECTMESSAGE_READS and not (limit or before):
+            return b''.join((_TOKEN_START, _json_bytes(token),
+                             _DIRECTMESSAGE_READS[message]))
+    return encode_json(msg_type, username, password, message, timestamp,
+                       token, cursor, limit, before,
+                       encoding, compression).encode() + FRAME_END
+
+
+def encode_response_bytes(msg_type: str, **fields) -> bytes:
+    '''
+    Encodes a server response of type msg_type holding fields, in order,
+    as a frame of bytes ready to be sent. Responses holding only a message,
+    such as errors, are encoded once and reused.
+    '''
+    if len(fields) == 1 and isinstance(fields.get('message'), str):
+        return _message_response(msg_type, fields['message'])
+    frame = [_RESPONSE_START, _json_bytes(msg_type)]
+    for field, value in fields.items():
+        frame.append(_RESPONSE_FIELDS.get(field)
+                     or b', ' + _json_bytes(field) + b': ')
+        frame.append(_json_bytes(value))
+    frame.append(_RESPONSE_END)
+    return b''.join(frame)
+
+
+def encode_binary_response(msg_type: str, **fields) -> bytes:
+    '''
+    Encodes the same response as encode_response_bytes as a binary frame.
+    '''
+    payload = pack({'response': {'type': msg_type, **fields}})
+    return FRAME_HEADER.pack(BINARY_FRAME, len(payload)) + payload
+
+
+def compress_frame(frame: bytes, level: int = 6) -> bytes:
+    '''
+    Compresses a JSON or binary frame into a compressed frame.
+    '''
+    payload = zlib.compress(frame, level)
+    return FRAME_HEADER.pack(COMPRESSED_FRAME, len(payload)) + payload
+
+
+@functools.lru_cache(maxsize=1024)
+def _message_response(msg_type: str, message: str) -> bytes:
+    '''
+    Encodes a response holding only a message. Cached, since most of them
+    are fixed error and status messages.
+    '''
+    return b''.join((_RESPONSE_START, _json_bytes(msg_type),
+                     _RESPONSE_FIELDS['message'], _json_bytes(message),
+                     _RESPONSE_END))
+
+
+def _json_bytes(value) -> bytes:
+    '''
+    Encodes value as json.dumps would, skipping its setup for strings.
+    '''
+    if type(value) is str:
+        return encode_basestring_ascii(value).encode()
+    return json.dumps(value).encode()
+
+
+def pack(obj) -> bytes:
+    '''
+    Encodes obj, made of None, bools, ints, floats, strs, bytes, lists and
+    dicts, in the MessagePack format.
+    '''
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _pack(obj, out: bytearray):
+    '''
+    Appends obj, encoded in the MessagePack format, to out.
+    '''
+    kind = type(obj)
+    if kind is str:
+        data = obj.encode()
+        size = len(data)
+        if size < 0x20:
+            out.append(0xa0 | size)
+        elif size < 0x100:
+            out += _UINT8.pack(0xd9, size)
+        elif size < 0x10000:
+            out += _UINT16.pack(0xda, size)
+        else:
+            out += _UINT32.pack(0xdb, size)
+        out += data
+    elif kind is bytes:
+        size = len(obj)
+        if size < 0x100:
+            out += _UINT8.pack(0xc4, size)
+        elif size < 0x10000:
+            out += _UINT16.pack(0xc5, size)
+        else:
+            out += _UINT32.pack(0xc6, size)
+        out += obj
+    elif kind is dict:
+        _pack_container(len(obj), 0x80, 0xde, out)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    elif kind in (list, tuple):
+        if len(obj) >= _TABLE_MIN_ROWS and _pack_table(obj, out):
+            return
+        _pack_container(len(obj), 0x90, 0xdc, out)
+        for value in obj:
+            _pack(value, out)
+    elif obj is None:
+        out.append(0xc0)
+    elif kind is bool:
+        out.append(0xc3 if obj else 0xc2)
+    elif kind is int:
+        _pack_int(obj, out)
+    elif kind is float:
+        out += _FLOAT64.pack(0xcb, obj)
+    else:
+        raise TypeError(f"Object of type {kind.__name__} can't be packed")
+
+
+def _pack_container(size: int, fixed: int, sized: int, out: bytearray):
+    '''
+    Appends the header of a map or an array of size items to out. fixed is
+    the type of the short form and sized the type of the 16 bit form.
+    '''
+    if size < 0x10:
+        out.append(fixed | size)
+    elif size < 0x10000:
+        out += _UINT16.pack(sized, size)
+    else:
+        out += _UINT32.pack(sized + 1, size)
+
+
+def _pack_table(rows, out: bytearray) -> bool:
+    '''
+    Appends rows, a list of dictionaries, to out as a table: the number of
+    rows, the index of the keys of each row, as bytes, and for every set of
+    keys the keys and a column of values for each of them. Returns False,
+    appending nothing, if rows are not all dictionaries with some keys or
+    have more than 256 different sets of keys.
+    '''
+    shapes = {}
+    order = bytearray()
+    for row in rows:
+        if type(row) is not dict or not row:
+            return False
+        shape = shapes.setdefault(tuple(row), len(shapes))
+        if shape > 0xff:
+            return False
+        order.append(shape)
+    tables = []
+    for keys, shape in shapes.items():
+        shaped = rows
+        if len(shapes) > 1:
+            shaped = [row for row, index in zip(rows, order)
+                      if index == shape]
+        tables.append([list(keys), [_pack_column([row[key] for row in shaped])
+                                    for key in keys]])
+    payload = bytearray()
+    _pack([len(rows), bytes(order) if len(shapes) > 1 else b'', tables],
+          payload)
+    size = len(payload)
+    if size < 0x100:
+        out += _UINT8.pack(0xc7, size)
+    elif size < 0x10000:
+        out += _UINT16.pack(0xc8, size)
+    else:
+        out += _UINT32.pack(0xc9, size)
+    out.append(_TABLE_EXT)
+    out += payload
+    return True
+
+
+def _pack_column(values: list) -> list:
+    '''
+    Returns the column of a table holding values. Strings are sent as one
+    UTF-8 string, split at NUL characters unless one of them holds some, in
+    which case the length of each is sent too. Integers are sent as an
+    array of 64 bit integers. Any other values are sent as they are.
+    '''
+    kinds = set(map(type, values))
+    if kinds == {str}:
+        text = '\x00'.join(values)
+        if text.count('\x00') == len(values) - 1:
+            return ['s', text.encode()]
+        lengths = array(_UINT32_ARRAY, map(len, values))
+        return ['l', ''.join(values).encode(), _little_endian(lengths)]
+    if kinds == {int}:
+        try:
+            return ['i', _little_endian(array(_INT64_ARRAY, values))]
+        except OverflowError:
+            pass
+    return ['v', values]
+
+
+def _little_endian(values: array) -> bytes:
+    '''
+    Returns the items of values as little endian bytes.
+    '''
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _pack_int(obj: int, out: bytearray):
+    '''
+    Appends the integer obj, in its shortest form, to out.
+    '''
+    if 0 <= obj < 0x80:
+        out.append(obj)
+    elif -0x20 <= obj < 0:
+        out.append(obj & 0xff)
+    elif obj >= 0:
+        for limit, form, kind in ((0x100, _UINT8, 0xcc),
+                                  (0x10000, _UINT16, 0xcd),
+                                  (0x100000000, _UINT32, 0xce),
+                                  (0x10000000000000000, _UINT64, 0xcf)):
+            if obj < limit:
+                out += form.pack(kind, obj)
+                return
+        raise OverflowError("Integer too large to be packed")
+    else:
+        for limit, form, kind in ((0x80, _INT8, 0xd0),
+                                  (0x8000, _INT16, 0xd1),
+                                  (0x80000000, _INT32, 0xd2),
+                                  (0x8000000000000000, _INT64, 0xd3)):
+            if obj >= -limit:
+                out += form.pack(kind, obj)
+                return
+        raise OverflowError("Integer too small to be packed")
+
+
+def unpack(data: bytes):
+    '''
+    Decodes one object encoded in the MessagePack format. Raises ValueError
+    if data is not exactly one valid object.
+    '''
+    try:
+        obj, end = _unpack(data, 0)
+    except (IndexError, TypeError, AttributeError, struct.error) as ex:
+        raise ValueError(f"Invalid MessagePack data: {ex}") from ex
+    if end != len(data):
+        raise ValueError("Invalid MessagePack data: wrong length")
+    return obj
+
+
+def _unpack(data: bytes, pos: int):
+    '''
+    Decodes the object starting at pos. Returns it with the position of the
+    next one.
+    '''
+    kind = data[pos]
+    pos += 1
+    if kind < 0x80:
+        return kind, pos
+    if kind >= 0xe0:
+        return kind - 0x100, pos
+    if 0xa0 <= kind < 0xc0:
+        return _unpack_str(data, pos, kind & 0x1f)
+    if kind < 0x90:
+        return _unpack_map(data, pos, kind & 0x0f)
+    if kind < 0xa0:
+        return _unpack_array(data, pos, kind & 0x0f)
+    if kind == 0xc0:
+        return None, pos
+    if kind in (0xc2, 0xc3):
+        return kind == 0xc3, pos
+    if kind in _FIXED_SIZE:
+        form = _FIXED_SIZE[kind]
+        return form.unpack_from(data, pos - 1)[1], pos + form.size - 1
+    if kind in _SIZED:
+        form, unpack_sized = _SIZED[kind]
+        size = form.unpack_from(data, pos - 1)[1]
+        return unpack_sized(data, pos + form.size - 1, size)
+    raise ValueError(f"Unsupported MessagePack type 0x{kind:02x}")
+
+
+def _unpack_str(data: bytes, pos: int, size: int):
+    '''
+    Decodes the UTF-8 string of size bytes starting at pos.
+    '''
+    end = pos + size
+    if end > len(data):
+        raise ValueError("Invalid MessagePack data: truncated string")
+    return data[pos:end].decode(), end
+
+
+def _unpack_bin(data: bytes, pos: int, size: int):
+    '''
+    Decodes the size bytes starting at pos.
+    '''
+    end = pos + size
+    if end > len(data):
+        raise ValueError("Invalid MessagePack data: truncated bytes")
+    return bytes(data[pos:end]), end
+
+
+def _unpack_ext(data: bytes, pos: int, size: int):
+    '''
+    Decodes the extension of size bytes, after its type, starting at pos.
+    Only tables are supported.
+    '''
+    end = pos + 1 + size
+    if end > len(data):
+        raise ValueError("Invalid MessagePack data: truncated extension")
+    if data[pos] != _TABLE_EXT:
+        raise ValueError(f"Unsupported MessagePack extension {data[pos]}")
+    table, table_end = _unpack(data, pos + 1)
+    if table_end != end:
+        raise ValueError("Invalid MessagePack data: wrong table length")
+    return _unpack_table(*table), end
+
+
+def _unpack_table(count: int, order: bytes, tables: list) -> list:
+    '''
+    Rebuilds the list of dictionaries packed by _pack_table. The rows of
+    each set of keys are built at once, from columns of (key, value) pairs,
+    then merged back in order.
+    '''
+    if len(order) != (count if len(tables) > 1 else 0):
+        raise ValueError("Invalid MessagePack data: wrong table order")
+    shaped = []
+    for index, (keys, columns) in enumerate(tables):
+        size = order.count(index) if order else count
+        if len(keys) != len(columns) or not keys:
+            raise ValueError("Invalid MessagePack data: wrong table keys")
+        items = [zip(repeat(key), _unpack_column(column, size))
+                 for key, column in zip(keys, columns)]
+        shaped.append(list(map(dict, zip(*items))))
+    if not order:
+        return shaped[0]
+    if sum(map(len, shaped)) != count:
+        raise ValueError("Invalid MessagePack data: wrong table order")
+    shaped = list(map(iter, shaped))
+    return list(map(next, map(shaped.__getitem__, order)))
+
+
+def _unpack_column(column: list, size: int) -> list:
+    '''
+    Returns the size values of a column packed by _pack_column.
+    '''
+    kind = column[0]
+    if kind == 's':
+        values = column[1].decode().split('\x00')
+    elif kind == 'l':
+        text = column[1].decode()
+        ends = list(accumulate(_native_array(_UINT32_ARRAY, column[2])))
+        if ends and ends[-1] != len(text):
+            raise ValueError("Invalid MessagePack data: wrong string lengths")
+        values = list(map(text.__getitem__, map(slice, [0] + ends, ends)))
+    elif kind == 'i':
+        values = _native_array(_INT64_ARRAY, column[1]).tolist()
+    elif kind == 'v':
+        values = column[1]
+    else:
+        raise ValueError(f"Unsupported table column {kind!r}")
+    if len(values) != size:
+        raise ValueError("Invalid MessagePack data: wrong column length")
+    return values
+
+
+def _native_array(typecode: str, data: bytes) -> array:
+    '''
+    Returns the array of the little endian items in data.
+    '''
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _unpack_array(data: bytes, pos: int, size: int):
+    '''
+    Decodes the size items of an array starting at pos.
+    '''
+    obj = []
+    for _ in range(size):
+        value, pos = _unpack(data, pos)
+        obj.append(value)
+    return obj, pos
+
+
+def _unpack_map(data: bytes, pos: int, size: int):
+    '''
+    Decodes the size pairs of a map starting at pos. Short string keys and
+    values, which make up most of a response, are decoded inline: a
+    truncated one ends past the data, which unpack rejects.
+    '''
+    obj = {}
+    for _ in range(size):
+        kind = data[pos]
+        if 0xa0 <= kind < 0xc0:
+            end = pos + 1 + (kind & 0x1f)
+            key = data[pos + 1:end].decode()
+            pos = end
+        else:
+            key, pos = _unpack(data, pos)
+        kind = data[pos]
+        if 0xa0 <= kind < 0xc0:
+            end = pos + 1 + (kind & 0x1f)
+            obj[key] = data[pos + 1:end].decode()
+            pos = end
+        elif kind < 0x80:
+            obj[key] = kind
+            pos += 1
+        else:
+            obj[key], pos = _unpack(data, pos)
+    return obj, pos
+
+
+# Types whose value follows them, with the struct to read it.
+_FIXED_SIZE = {0xcc: _UINT8, 0xcd: _UINT16, 0xce: _UINT32, 0xcf: _UINT64,
+               0xd0: _INT8, 0xd1: _INT16, 0xd2: _INT32, 0xd3: _INT64,
+               0xca: _FLOAT32, 0xcb: _FLOAT64}
+# Types followed by their size, with the struct to read it and the function
+# decoding what follows.
+_SIZED = {0xd9: (_UINT8, _unpack_str), 0xda: (_UINT16, _unpack_str),
+          0xdb: (_UINT32, _unpack_str), 0xc4: (_UINT8, _unpack_bin),
+          0xc5: (_UINT16, _unpack_bin), 0xc6: (_UINT32, _unpack_bin),
+          0xdc: (_UINT16, _unpack_array), 0xdd: (_UINT32, _unpack_array),
+          0xde: (_UINT16, _unpack_map), 0xdf: (_UINT32, _unpack_map),
+          0xc7: (_UINT8, _unpack_ext), 0xc8: (_UINT16, _unpack_ext),
+          0xc9: (_UINT32, _unpack_ext)}
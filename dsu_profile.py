@@ -17,10 +17,29 @@
 '''
 The dsu_profile module allows a user to save their information to a DSU file or
 load information from an existing DSU file to a Profile object.
+
+A DSU file is a JSON snapshot of the profile. Changes saved after it was
+written are appended to a journal next to it (name.dsu.journal), one JSON
+record per line, and folded back into the snapshot once the journal holds
+JOURNAL_COMPACT_THRESHOLD records. DSU files without a journal load as before.
+
+The messages of a snapshot are grouped by contact, and an index next to it
+(name.dsu.index) holds the rest of the profile and where each contact's
+messages are in the snapshot, so load_profile(path, lazy=True) only reads a
+conversation when it is first used.
 '''
 
+import atexit
 import json
+import os
+import threading
 from pathlib import Path
+from ds_protocol import DirectMessage
+
+# Journal records written before save_profile rewrites the whole snapshot.
+JOURNAL_COMPACT_THRESHOLD = 500
+# Default seconds between two saves in write-behind mode.
+WRITE_BEHIND_INTERVAL = 1.0
 
 
 class DsuFileError(Exception):
@@ -59,39 +78,80 @@ class Profile:
         self.password = password    # REQUIRED
         self._friends = []
         self._messages = []
+        self.sync_cursor = None     # cursor of the last delta sync
+        self._message_ids = set()
+        self._friend_set = set()    # index of _friends
+        self._conversations = {}    # contact -> their messages, in order
+        self._lazy = {}             # contact -> (offset, length) not loaded
+        self._lazy_path = None      # snapshot the offsets are in
+        self._journal_path = None   # journal of the last DSU file saved
+        self._journal_size = 0      # records in that journal
+        self._generation = 0        # snapshot the journal belongs to
+        self._pending = []          # records not saved to the journal yet
+        self._saved_fields = None
+        self._needs_snapshot = False
+        self._lock = threading.RLock()       # guards changes to the profile
+        self._save_lock = threading.Lock()   # one save at a time
+        self._writer = None                  # write-behind thread
+        self._stop_writer = None
+        self._dirty_path = None              # DSU file with unsaved changes
 
     def save_messages(self, msgs: list) -> None:
         '''
         save_messages appends all messages passed in to the end of profile
-        object's ._messages attribute.
+        object's ._messages attribute. Messages can be DirectMessage objects
+        or message dictionaries, and are saved as DirectMessage objects.
+        Messages carrying a server id that is already saved are skipped.
         '''
-        for msg in msgs:
-            self._messages.append(msg)
-            if 'from' in msg:
-                self.save_friends(msg['from'])
-            else:
-                self.save_friends(msg['recipient'])
+        with self._lock:
+            for msg in msgs:
+                if isinstance(msg, dict):
+                    msg = DirectMessage.from_dict(msg)
+                if self._add_message(msg):
+                    self._pending.append({'message': msg})
 
     def overwrite_messages(self, msgs: list):
         '''
         overwrite_messages replaces the _messages attribute with the new list
-        of messages.
+        of messages. msgs can be any iterable, such as a generator streaming
+        them from the server: the profile is only locked once all of them
+        are read, and keeps its messages if reading them fails.
         '''
-        self._messages = []
-        self.save_messages(msgs)
+        history = Profile()
+        for msg in msgs:
+            if isinstance(msg, dict):
+                msg = DirectMessage.from_dict(msg)
+            history._add_message(msg)
+        with self._lock:
+            self._messages = history._messages
+            self._message_ids = history._message_ids
+            self._conversations = history._conversations
+            self._lazy = {}
+            for friend in history._friends:
+                self._add_friend(friend)
+            # Only a new snapshot can drop the old messages
+            self._pending = []
+            self._needs_snapshot = True
 
     def save_friends(self, friend: str):
         '''
         appends a friend to the end of the ._friends attribute if the name is
         not in the list.
         '''
-        if friend not in self._friends:
-            self._friends.append(friend)
+        with self._lock:
+            if self._add_friend(friend):
+                self._pending.append({'friend': friend})
 
     def get_messages(self) -> list:
         '''
-        returns all messages
+        returns all messages, as DirectMessage objects. Loads every
+        conversation not loaded yet.
+
+        Raises DsuProfileError
         '''
+        with self._lock:
+            for contact in list(self._lazy):
+                self._load_conversation(contact)
         return self._messages
 
     def get_friends(self) -> list:
@@ -100,6 +160,83 @@ class Profile:
         '''
         return self._friends
 
+    def get_conversation(self, contact: str) -> list:
+        '''
+        returns the messages sent to and received from a contact, in the
+        order they were saved, as DirectMessage objects
+
+        Raises DsuProfileError
+        '''
+        with self._lock:
+            self._load_conversation(contact)
+            return self._conversations.get(contact, [])
+
+    def _add_message(self, msg: DirectMessage) -> bool:
+        '''
+        adds a message and its contact, unless a message with the same
+        server id is already saved. Returns True if the message was added.
+        '''
+        # A copy of the message can only be in the same conversation
+        self._load_conversation(msg.sender or msg.recipient)
+        if msg.id is not None:
+            if msg.id in self._message_ids:
+                return False
+            self._message_ids.add(msg.id)
+        self._add_friend(self._index_message(msg))
+        return True
+
+    def _index_message(self, msg: DirectMessage) -> str:
+        '''
+        appends a message to the messages and to its conversation. Returns
+        the contact it was sent to or received from.
+        '''
+        contact = msg.sender or msg.recipient
+        self._messages.append(msg)
+        self._conversations.setdefault(contact, []).append(msg)
+        return contact
+
+    def _add_friend(self, friend: str) -> bool:
+        '''
+        adds a friend if not already saved. Returns True if it was added.
+        '''
+        if friend in self._friend_set:
+            return False
+        self._friend_set.add(friend)
+        self._friends.append(friend)
+        return True
+
+    def _load_conversation(self, contact: str):
+        '''
+        reads the messages of a contact from the snapshot, if they weren't
+        loaded yet. Caller holds the lock.
+        '''
+        span = self._lazy.get(contact)
+        if span is None:
+            return
+        offset, length = span
+        try:
+            with open(self._lazy_path, 'rb') as f:
+                f.seek(offset)
+                lines = json.loads(b'[' + f.read(length) + b']')
+        except (OSError, ValueError) as ex:
+            raise DsuProfileError(ex) from ex
+        del self._lazy[contact]
+        msgs = [DirectMessage.from_dict(line) for line in lines]
+        # Messages saved after the snapshot are already in the conversation
+        self._conversations[contact] = msgs + self._conversations.get(contact,
+                                                                      [])
+        self._messages.extend(msgs)
+        self._message_ids.update(msg.id for msg in msgs if msg.id is not None)
+
+    def _fields(self) -> dict:
+        '''
+        returns the fields of the profile other than friends and messages
+        '''
+        return {'dsuserver': self.dsuserver,
+                'username': self.username,
+                'password': self.password,
+                'sync_cursor': self.sync_cursor}
+
     def save_profile(self, path: str) -> None:
         """
         save_profile accepts an existing dsu file to save the current instance
@@ -110,23 +247,151 @@ class Profile:
         profile = Profile()
         profile.save_profile('/path/to/file.dsu')
 
+        Only the changes since the last save are appended to the journal,
+        unless the file is new or the journal is due for compaction. In
+        write-behind mode the profile is only marked as changed.
+
         Raises DsuFileError
         """
         p = Path(path)
-        p.touch()
 
-        if p.exists() and p.suffix == '.dsu':
+        if p.suffix == '.dsu':
+            if self._writer:
+                with self._lock:
+                    self._dirty_path = p
+                return
+            self._save(p)
+        else:
+            raise DsuFileError("Invalid DSU file path or type")
+
+    def compact(self, path: str = None) -> None:
+        """
+        compact writes the whole profile to a DSU file as a new snapshot and
+        starts an empty journal for it. Defaults to the DSU file last saved
+        or loaded.
+
+        Raises DsuFileError
+        """
+        if path is None and self._journal_path is None:
+            raise DsuFileError("No DSU file saved or loaded yet")
+        p = Path(path) if path else self._journal_path.with_suffix('')
+        if p.suffix != '.dsu':
+            raise DsuFileError("Invalid DSU file path or type")
+        with self._lock:
+            self._needs_snapshot = True
+        self._save(p)
+
+    def start_write_behind(self,
+                           interval: float = WRITE_BEHIND_INTERVAL) -> None:
+        """
+        start_write_behind makes save_profile only mark the profile as
+        changed. A background thread then saves it at most once every
+        interval seconds, so a burst of saves costs one write. flush saves
+        right away, and is called when the program exits.
+        """
+        if self._writer:
+            self._stop_writer.set()
+        else:
+            atexit.register(self.flush)
+        self._stop_writer = threading.Event()
+        self._writer = threading.Thread(target=self._write_behind,
+                                        args=(self._stop_writer, interval),
+                                        daemon=True)
+        self._writer.start()
+
+    def stop_write_behind(self) -> None:
+        """
+        stop_write_behind saves the pending changes and makes save_profile
+        write right away again.
+
+        Raises DsuFileError
+        """
+        if self._writer:
+            self._stop_writer.set()
+            self._writer = None
+            atexit.unregister(self.flush)
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        flush saves the changes save_profile marked in write-behind mode.
+
+        Raises DsuFileError
+        """
+        with self._lock:
+            p, self._dirty_path = self._dirty_path, None
+        if p:
+            try:
+                self._save(p)
+            except DsuFileError:
+                with self._lock:
+                    self._dirty_path = self._dirty_path or p
+                raise
+
+    def _write_behind(self, stop: threading.Event, interval: float):
+        while not stop.wait(interval):
+            try:
+                self.flush()
+            except DsuFileError:
+                pass  # tried again next time, and raised by flush
+
+    def _save(self, p: Path):
+        """
+        writes the changes to the DSU file p. The fields to write are taken
+        under the lock, but written without it, so the profile can change
+        while a large snapshot is being written.
+        """
+        with self._save_lock:
+            journal_path = _journal_path(p)
+            with self._lock:
+                snapshot = (self._needs_snapshot
+                            or journal_path != self._journal_path
+                            or not p.exists()
+                            or self._journal_size + len(self._pending)
+                            >= JOURNAL_COMPACT_THRESHOLD)
+                fields = self._fields()
+                if snapshot:
+                    header = dict(fields, _friends=list(self._friends),
+                                  journal_generation=self._generation + 1)
+                    conversations = {contact: list(msgs) for contact, msgs
+                                     in self._conversations.items()}
+                    lazy, lazy_path = dict(self._lazy), self._lazy_path
+                elif fields != self._saved_fields:
+                    self._pending.append({'fields': fields})
+                records, self._pending = self._pending, []
+                self._needs_snapshot = False
             try:
-                with open(p, 'w', encoding='utf-8') as f:
-                    json.dump(self.__dict__, f)
-                    f.close()
+                if snapshot:
+                    spans = _write_snapshot(p, header, conversations,
+                                            lazy, lazy_path)
+                    with self._lock:
+                        _install_snapshot(p, header, spans)
+                        self._lazy = {contact: spans[contact]
+                                      for contact in self._lazy
+                                      if contact in spans}
+                        self._lazy_path = p
+                elif records:
+                    with open(journal_path, 'a', encoding='utf-8') as f:
+                        f.write(''.join(json.dumps(record, default=_to_json)
+                                        + '\n'
+                                        for record in records))
             except Exception as ex:
+                with self._lock:
+                    if snapshot:
+                        self._needs_snapshot = True
+                    else:
+                        self._pending = records + self._pending
                 raise DsuFileError("Error while attempting to process the DSU"
                                    "file.", ex) from ex
-        else:
-            raise DsuFileError("Invalid DSU file path or type")
+            if snapshot:
+                self._journal_path = journal_path
+                self._journal_size = 0
+                self._generation += 1
+            else:
+                self._journal_size += len(records)
+            self._saved_fields = fields
 
-    def load_profile(self, path: str) -> None:
+    def load_profile(self, path: str, lazy: bool = False) -> None:
         """
         load_profile will populate the current instance of Profile with data
         stored in a DSU file.
@@ -136,24 +401,181 @@ class Profile:
         profile = Profile()
         profile.load_profile('/path/to/file.dsu')
 
+        If lazy is True and the DSU file is indexed, only reads the index;
+        each conversation is read from the file when it is first used.
+
         Raises DsuProfileError, DsuFileError
         """
         p = Path(path)
 
         if p.exists() and p.suffix == '.dsu':
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    obj = json.load(f)
-                    self.username = obj['username']
-                    self.password = obj['password']
-                    self.dsuserver = obj['dsuserver']
-                    self._friends = obj['_friends']
+                if not (lazy and self._load_index(p)):
+                    with open(p, 'r', encoding='utf-8') as f:
+                        obj = json.load(f)
+                    self._load_header(obj)
                     for msg_obj in obj['_messages']:
-                        self._messages.append(msg_obj)
-
-                    f.close()
+                        self._index_message(DirectMessage.from_dict(msg_obj))
+                        if 'id' in msg_obj:
+                            self._message_ids.add(msg_obj['id'])
+                self._journal_path = _journal_path(p)
+                replayed = self._replay_journal()
+                # Without a journal of its own, or with a journal cut short,
+                # the next save starts a new one
+                self._needs_snapshot = replayed is None
+                self._journal_size = replayed or 0
+                self._pending = []
+                self._saved_fields = self._fields()
 
             except Exception as ex:
                 raise DsuProfileError(ex) from ex
         else:
             raise DsuFileError()
+
+    def _load_header(self, obj: dict):
+        """
+        sets the fields of the profile other than messages from a snapshot
+        """
+        self.username = obj['username']
+        self.password = obj['password']
+        self.dsuserver = obj['dsuserver']
+        self._friends = obj['_friends']
+        self._friend_set = set(self._friends)
+        self.sync_cursor = obj.get('sync_cursor')
+        self._generation = obj.get('journal_generation', 0)
+
+    def _load_index(self, p: Path) -> bool:
+        """
+        loads the fields of the profile from the index of the DSU file p and
+        leaves its conversations to load on demand. Returns False if p has
+        no index, or changed since it was indexed.
+        """
+        try:
+            with open(_index_path(p), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            stat = os.stat(p)
+            if (index['size'], index['mtime']) != (stat.st_size,
+                                                   stat.st_mtime_ns):
+                return False
+            header, spans = index['header'], index['conversations']
+        except (OSError, ValueError, KeyError):
+            return False
+        self._load_header(header)
+        self._lazy = {contact: tuple(span) for contact, span in spans.items()}
+        self._lazy_path = p
+        return True
+
+    def _replay_journal(self) -> int:
+        """
+        applies the records of the journal of the loaded snapshot. Returns
+        the number of records applied, or None if the snapshot has no journal
+        or its last record was cut short, so that nothing is appended to it.
+        """
+        if not self._journal_path.exists():
+            return None
+        with open(self._journal_path, 'r', encoding='utf-8') as f:
+            header = f.readline()
+            if not header.endswith('\n') or \
+                    json.loads(header)['generation'] != self._generation:
+                return None
+            applied = 0
+            for line in f:
+                if not line.endswith('\n'):
+                    return None  # cut short by a crash while saving
+                record = json.loads(line)
+                if 'message' in record:
+                    self._add_message(
+                        DirectMessage.from_dict(record['message']))
+                elif 'friend' in record:
+                    self._add_friend(record['friend'])
+                else:
+                    for field, value in record['fields'].items():
+                        setattr(self, field, value)
+                applied += 1
+        return applied
+
+
+def _write_snapshot(path: Path, header: dict, conversations: dict,
+                    lazy: dict, lazy_path: Path) -> dict:
+    """
+    writes a snapshot of a profile next to the DSU file path, for
+    _install_snapshot to move over it. Messages are grouped by contact. The
+    contacts in lazy were never loaded, so their messages are copied as is
+    from the lazy_path snapshot. Returns the (offset, length) of each
+    contact's messages in the file.
+    """
+    spans = {}
+    with open(_tmp_path(path), 'wb') as f:
+        f.write(json.dumps(header)[:-1].encode() + b', "_messages": [')
+        for contact, msgs in conversations.items():
+            if msgs:
+                data = json.dumps(msgs, default=_to_json)[1:-1].encode()
+                _write_span(f, spans, contact, data)
+        if lazy:
+            with open(lazy_path, 'rb') as src:
+                for contact, (offset, length) in lazy.items():
+                    src.seek(offset)
+                    _write_span(f, spans, contact, src.read(length))
+        f.write(b']}')
+        f.flush()
+        os.fsync(f.fileno())
+    return spans
+
+
+def _write_span(f, spans: dict, contact: str, data: bytes):
+    """
+    appends the messages of a contact to the _messages of a snapshot
+    """
+    if spans:
+        f.write(b', ')
+    spans[contact] = (f.tell(), len(data))
+    f.write(data)
+
+
+def _install_snapshot(path: Path, header: dict, spans: dict):
+    """
+    atomically replaces a DSU file with the snapshot _write_snapshot wrote,
+    indexes it and starts an empty journal for it
+    """
+    os.replace(_tmp_path(path), path)
+    stat = os.stat(path)
+    index_path = _index_path(path)
+    with open(_tmp_path(index_path), 'w', encoding='utf-8') as f:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                   'header': header, 'conversations': spans}, f)
+    os.replace(_tmp_path(index_path), index_path)
+    # A crash before the new journal is started leaves one of an older
+    # generation, which load_profile ignores
+    with open(_journal_path(path), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'generation': header['journal_generation']})
+                + '\n')
+
+
+def _to_json(obj):
+    """
+    serializes the DirectMessage objects of a profile for json.dump
+    """
+    if isinstance(obj, DirectMessage):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def _journal_path(path: Path) -> Path:
+    """
+    returns the path of the journal of a DSU file
+    """
+    return path.with_name(path.name + '.journal')
+
+
+def _index_path(path: Path) -> Path:
+    """
+    returns the path of the index of a DSU file
+    """
+    return path.with_name(path.name + '.index')
+
+
+def _tmp_path(path: Path) -> Path:
+    """
+    returns the path a file is written to before it replaces path
+    """
+    return path.with_name(path.name + '.tmp')
@@ -1,28 +1,75 @@
 import socket
 import threading
+import asyncio
 import json
+import os
+import sqlite3
+import argparse
 from pathlib import Path
-import sys
+from urllib.parse import quote, unquote
+from abc import ABC, abstractmethod
 from flask import Flask, render_template, redirect, url_for
 from datetime import datetime
 import string
 import secrets
+import time
+import queue
+import bisect
+import ds_protocol
 
 USERS_PATH = 'users.json'
 POSTS_PATH = 'posts.json'
 STORE_DIR_PATH = 'store'
+USERS_WAL_PATH = 'users.wal'
+WAL_COMPACT_THRESHOLD = 1000 ##number of logged writes before the log is folded back into users.json
+WAL_FSYNC = False ##SET THIS TO TRUE TO FSYNC EVERY LOG RECORD (slower, survives power loss)
+USER_SHARDS_DIR_PATH = 'users'
+SQLITE_PATH = 'dsu.sqlite3'
+SQLITE_MAX_ROWID = 2 ** 63 - 1
+CAPABILITIES = ['pipelining', 'push', 'resume', 'binary', 'compression'] ##protocol extensions advertised to clients in the join response
+ENCODINGS = ['json', 'binary'] ##response encodings a client can ask for in join or resume
+COMPRESSIONS = ['none', 'zlib'] ##response compressions a client can ask for in join or resume
+SESSION_OPTIONS = ['encoding', 'compression'] ##optional fields of join and resume
+COMPRESS_THRESHOLD = 16 * 1024 ##responses longer than this are compressed for clients that asked for it
+COMPRESS_LEVEL = 6 ##zlib level: 1 is fastest, 9 smallest
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5] ##upper bounds, in seconds, of the buckets of the per command latency histograms. One more bucket holds slower requests
+ENGINE = 'threads' ##default server engine: 'threads' (one thread per client) or 'asyncio' (one event loop for every client). Override with --engine
+SESSION_RESUME_GRACE = 60 ##seconds the token of a closed connection can still be resumed on a new one
+MAX_REQUEST_SIZE = 1024 * 1024 ##longest request line the server accepts
+LISTEN_BACKLOG = 1024 ##pending connections either engine lets the OS queue
+PUSH_BACKLOG_LIMIT = 1024 * 1024 ##bytes of pushes a subscriber may leave unwritten before it is disconnected as too slow
+STORAGE_MODE = 'wal' ##default storage backend: 'wal' (users.json + write-ahead log), 'sharded' (one file per user) or 'sqlite'. Override with --storage
 DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
 
 
 ##The server uses two json files to store data:
 ##users - bio's, posts
 ##posts - just the posts for each user and timestamp 
+##Both are snapshots: the server keeps them in memory and logs every change to users.wal,
+##folding the log back into the json files every WAL_COMPACT_THRESHOLD writes and on shutdown.
+##In the 'sharded' STORAGE_MODE each user lives in store/users/<username>.json instead of users.json,
+##and the 'sqlite' STORAGE_MODE keeps users, messages and posts in indexed tables in store/dsu.sqlite3.
 
 ##user schema:
 #{user_name: {'bio':{'entry':, 'timestamp':}, 'posts':[{'entry':, 'timestamp':}]} }
 #post schema
 #posts[{'username':,'entry':, 'timestamp:']
 #messages[{'entry','from/recipient', 'timestamp','status'}] ##status can be "new" or "read". "from" denotes the user recieved the message and "recipient" denotes that they sent it 
+##messages in responses also carry an 'id' that only grows per user; {"directmessage": {"since": id}} returns the messages after it
+##and {"directmessage": {"all": {"limit": n, "before": id}}} returns one page of history plus the 'cursor' of the next older page
+##{"directmessage": "subscribe"} returns the new messages like "new", then pushes each new message to the connection as it arrives:
+##{"response": {"type": "push", "messages": [...]}}
+##pushed messages stay new until a "new", "all", "since" or "subscribe" request returns them, so a push lost with its connection
+##is returned again when the client subscribes on its next connection. A subscriber too slow to read its pushes is disconnected.
+##a successful send answers with the stored message as its 'record': {'recipient':, 'message':, 'timestamp':, 'id':}
+##when a connection closes its token is kept for SESSION_RESUME_GRACE seconds, and {"resume": {"token": token}} joins it again
+##on a new connection without the password. It answers like join.
+##join and resume take an optional 'encoding' field. With "encoding": "binary" every response on the connection, starting
+##with the join response, is sent as a binary frame instead of a json line: a 0x00 byte, the length of the payload as 4 bytes
+##(big endian), then the response in the MessagePack format (see ds_protocol.pack). Lists of messages are packed column-wise,
+##each key once, so they are smaller and parse faster than in json.
+##With "compression": "zlib" responses longer than COMPRESS_THRESHOLD are sent as compressed frames: a 0x01 byte, the
+##length of the payload as 4 bytes (big endian), then the json line or binary frame compressed with zlib.
 
 def generate_token():
     '''Randomly generate a token of the form xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx'''
@@ -34,411 +81,1386 @@ def _generate_random_string(n:int) -> str:
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
-users_file_lock = threading.Lock()
-posts_file_lock = threading.Lock()
+def _new_user_record(password):
+    '''Build the users.json record for a freshly joined user'''
+    return {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}
+
+
+def _create_json_files(store_path):
+    '''Create the store directory with empty users.json and posts.json files if they dont exist yet'''
+    users_path = store_path / Path(USERS_PATH)
+    posts_path = store_path / Path(POSTS_PATH)
+    store_path.mkdir(exist_ok=True)
+    if not users_path.exists():
+        with users_path.open('w') as json_file:
+            json.dump({}, json_file, indent=4)
+    if not posts_path.exists():
+        with posts_path.open('w') as json_file:
+            json.dump({'posts':[]}, json_file, indent=4)
+
+
+def _index_unread(messages):
+    '''Return the positions of the messages in a user's mailbox that are still "new"'''
+    return [i for i, message in enumerate(messages) if message['status'] == 'new']
+
+
+def _mailbox_message(messages, i):
+    '''Format the message at position i of a user's mailbox for a response. Its id is its 1-based position in the mailbox.'''
+    message = messages[i]
+    if 'from' in message:
+        return {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp'], 'id': i + 1}
+    return {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp'], 'id': i + 1}
+
+
+def _mark_unread_read(messages, unread, first = 0, last = None):
+    '''Flip the unread positions in [first, last) of a mailbox to read. Returns the positions that stay unread.'''
+    still_unread = []
+    for i in unread:
+        if first <= i and (last is None or i < last):
+            messages[i]['status'] = 'read'
+        else:
+            still_unread.append(i)
+    return still_unread
+
+
+def _page_bounds(count, limit, before):
+    '''Return the mailbox positions [start, end) of the page of at most limit messages with an id below before'''
+    end = count if before is None else min(count, before - 1)
+    start = max(0, end - limit) if limit else 0
+    return start, end
+
+
+def _replace_json_file(path, obj):
+    '''Dump obj to a temporary file next to path and atomically move it over path'''
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w') as json_file:
+        json.dump(obj, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class UserStore(ABC):
+    '''
+    Interface implemented by every storage backend. DSUServer only reaches its data through
+    these methods, so the backend can be chosen with the --storage command line option.
+    Users are returned in the users.json schema: {'password':, 'bio':{'entry':, 'timestamp':}, 'posts':[...], ...}
+    '''
+
+    @abstractmethod
+    def open(self):
+        '''Create the backing files if they dont exist yet and load the store'''
+
+    @abstractmethod
+    def close(self):
+        '''Flush anything still pending and release the backing files'''
+
+    @abstractmethod
+    def get_user(self, username):
+        '''Return the user record for username, or None'''
+
+    @abstractmethod
+    def get_posts(self):
+        '''Return every post, newest first'''
+
+    @abstractmethod
+    def get_or_create_user(self, username, password):
+        '''Return the existing user record for username, or create the user and return None'''
+
+    @abstractmethod
+    def update_bio(self, username, entry, timestamp):
+        '''Replace the bio of username'''
+
+    @abstractmethod
+    def create_post(self, username, entry, timestamp):
+        '''Add a post by username'''
+
+    @abstractmethod
+    def send_message(self, entry, username, recipient, timestamp = ''):
+        '''Deliver a message from username to recipient. Returns the sent message as it is in the mailbox of username, or False if either user doesnt exist'''
+
+    @abstractmethod
+    def read_all_messages(self, username):
+        '''Return every message sent or received by username and mark the received ones read'''
+
+    @abstractmethod
+    def read_new_messages(self, username):
+        '''Return the unread messages received by username and mark them read'''
+
+    @abstractmethod
+    def peek_new_messages(self, username, after = 0):
+        '''Return the unread messages received by username with an id above after, without marking them read'''
+
+    @abstractmethod
+    def read_messages_since(self, username, cursor):
+        '''
+        Return (messages, cursor): the messages sent or received by username whose id is greater than
+        cursor, oldest first, and the cursor to pass next time. Marks the received ones read.
+        '''
+
+    @abstractmethod
+    def read_messages_page(self, username, limit = None, before = None):
+        '''
+        Return (messages, cursor): the newest limit messages sent or received by username whose id is
+        below before, oldest first, and the id to pass as before for the next (older) page, or None
+        if this is the oldest page. Marks the received messages of the page read.
+        '''
+
+    def release(self):
+        '''Release what the calling thread holds in the store. Called when a client thread ends.'''
+
+
+class WalUserStore(UserStore):
+    '''
+    Keeps every user and the post feed in memory. Each mutation is appended to the
+    write-ahead log (store/users.wal) as one json record before it is applied, so a
+    write costs O(1) I/O and reads never touch the disk. Once the log holds
+    compact_threshold records (and when the server shuts down) it is folded into
+    users.json/posts.json and truncated.
+
+    Every record carries a log sequence number (lsn). Users and the post feed remember
+    the last lsn applied to them, which makes replaying the log after a crash in the
+    middle of a compaction idempotent.
+
+    Each user's unread messages are indexed by their position in the mailbox, so fetching
+    new messages costs O(unread) and marking them read is a single "read" log record.
+    '''
+
+    def __init__(self, store_dir = STORE_DIR_PATH, compact_threshold = WAL_COMPACT_THRESHOLD):
+        store_path = Path('.') / Path(store_dir)
+        self.users_path = store_path / Path(USERS_PATH)
+        self.posts_path = store_path / Path(POSTS_PATH)
+        self.wal_path = store_path / Path(USERS_WAL_PATH)
+        self.compact_threshold = compact_threshold
+        self.lock = threading.Lock()
+        self.users = {}
+        self.posts = []
+        self._unread = {} ##username -> positions of the unread messages in the user's mailbox
+        self._posts_lsn = 0
+        self._lsn = 0
+        self._wal_file = None
+        self._wal_records = 0
+
+    def open(self):
+        '''Load the last snapshot, replay the log on top of it and start a fresh log'''
+        _create_json_files(self.users_path.parent)
+        with self.lock:
+            with self.users_path.open('r') as user_file:
+                self.users = json.load(user_file)
+            with self.posts_path.open('r') as posts_file:
+                posts = json.load(posts_file)
+            self.posts = posts['posts']
+            self._posts_lsn = posts.get('lsn', 0)
+            self._lsn = max([self._posts_lsn] + [user.get('lsn', 0) for user in self.users.values()])
+            self._unread = {username: _index_unread(user['messages']) for username, user in self.users.items()}
+
+            replayed = 0
+            if self.wal_path.exists():
+                with self.wal_path.open('r') as wal_file:
+                    for line in wal_file:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            break ##torn write at the tail of the log, nothing after it was acknowledged
+                        self._apply(record)
+                        self._lsn = max(self._lsn, record['lsn'])
+                        replayed += 1
+            if DEBUG and replayed:
+                print(f'Replayed {replayed} write-ahead log records.')
+            self._compact()
+
+    def close(self):
+        '''Fold the log into the snapshot files and close it'''
+        with self.lock:
+            if self._wal_file:
+                self._compact()
+                self._wal_file.close()
+                self._wal_file = None
+
+    def get_user(self, username):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            return dict(fetched_user) if fetched_user else None
+
+    def get_posts(self):
+        with self.lock:
+            return list(self.posts)
+
+    def get_or_create_user(self, username, password):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            if fetched_user:
+                return fetched_user
+            self._log({'op': 'user', 'user': username, 'password': password})
+
+    def update_bio(self, username, entry, timestamp):
+        with self.lock:
+            if username not in self.users:
+                return False
+            self._log({'op': 'bio', 'user': username, 'entry': entry, 'timestamp': timestamp})
+            return True
+
+    def create_post(self, username, entry, timestamp):
+        with self.lock:
+            if username not in self.users:
+                return False
+            self._log({'op': 'post', 'user': username, 'entry': entry, 'timestamp': timestamp})
+            return True
+
+    def send_message(self, entry, username, recipient, timestamp = ''):
+        with self.lock:
+            if username not in self.users or recipient not in self.users:
+                return False
+            sent = len(self.users[username]['messages'])
+            self._log({'op': 'message', 'user': username, 'recipient': recipient, 'entry': entry, 'timestamp': timestamp})
+            return _mailbox_message(self.users[username]['messages'], sent)
+
+    def read_all_messages(self, username):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            result = [_mailbox_message(messages, i) for i in range(len(messages))]
+            if self._unread[username]:
+                self._log({'op': 'read', 'user': username})
+            return sorted(result, key=lambda x: float(x["timestamp"]))
+
+    def read_new_messages(self, username):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            result = [_mailbox_message(messages, i) for i in self._unread[username]]
+            if result:
+                self._log({'op': 'read', 'user': username})
+            return sorted(result, key=lambda x: float(x["timestamp"]))
+
+    def peek_new_messages(self, username, after = 0):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            if not fetched_user:
+                return False ##double check that user exists
+            unread = self._unread[username]
+            result = [_mailbox_message(fetched_user['messages'], i) for i in unread[bisect.bisect_left(unread, after):]] ##the id of position i is i + 1
+            return sorted(result, key=lambda x: float(x["timestamp"]))
+
+    def read_messages_since(self, username, cursor):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            result = [_mailbox_message(messages, i) for i in range(cursor, len(messages))]
+            if self._unread[username]:
+                self._log({'op': 'read', 'user': username})
+            return result, len(messages)
+
+    def read_messages_page(self, username, limit = None, before = None):
+        with self.lock:
+            fetched_user = self.users.get(username, None)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            start, end = _page_bounds(len(messages), limit, before)
+            result = [_mailbox_message(messages, i) for i in range(start, end)]
+            if any(start <= i < end for i in self._unread[username]):
+                self._log({'op': 'read', 'user': username, 'first': start, 'last': end})
+            return result, start + 1 if start > 0 else None
+
+    def _log(self, record):
+        '''Append record to the write-ahead log, then apply it to the in-memory store. Caller holds the lock.'''
+        self._lsn += 1
+        record['lsn'] = self._lsn
+        self._wal_file.write(json.dumps(record) + '\n')
+        self._wal_file.flush()
+        if WAL_FSYNC:
+            os.fsync(self._wal_file.fileno())
+        self._apply(record)
+        self._wal_records += 1
+        if self._wal_records >= self.compact_threshold:
+            self._compact()
+
+    def _claim(self, username, lsn):
+        '''Return the user record if the record with this lsn has not been applied to it yet'''
+        fetched_user = self.users.get(username, None)
+        if fetched_user is None or fetched_user.get('lsn', 0) >= lsn:
+            return None
+        fetched_user['lsn'] = lsn
+        return fetched_user
+
+    def _apply(self, record):
+        op = record['op']
+        lsn = record['lsn']
+        username = record['user']
+        if op == 'user':
+            if username not in self.users:
+                self.users[username] = _new_user_record(record['password'])
+                self.users[username]['lsn'] = lsn
+                self._unread[username] = []
+        elif op == 'bio':
+            fetched_user = self._claim(username, lsn)
+            if fetched_user:
+                fetched_user['bio'] = {'entry': record['entry'], 'timestamp': record['timestamp']}
+        elif op == 'post':
+            post = {'user': username, 'entry': record['entry'], 'timestamp': record['timestamp']}
+            fetched_user = self._claim(username, lsn)
+            if fetched_user:
+                fetched_user['posts'].insert(0, dict(post))
+            if self._posts_lsn < lsn:
+                self._posts_lsn = lsn
+                self.posts.insert(0, post)
+        elif op == 'message':
+            recipient = record['recipient']
+            fetched_sender = self._claim(username, lsn)
+            if fetched_sender:
+                fetched_sender['messages'].append({'message': record['entry'], 'recipient': recipient, 'timestamp': record['timestamp'], 'status': 'sent'})
+            fetched_user = self._claim(recipient, lsn) if recipient != username else fetched_sender
+            if fetched_user:
+                self._unread[recipient].append(len(fetched_user['messages']))
+                fetched_user['messages'].append({'message': record['entry'], 'from': username, 'timestamp': record['timestamp'], 'status': 'new'})
+        elif op == 'read':
+            fetched_user = self._claim(username, lsn)
+            if fetched_user:
+                self._unread[username] = _mark_unread_read(fetched_user['messages'], self._unread[username], record.get('first', 0), record.get('last'))
+
+    def _compact(self):
+        '''Write the in-memory store out as the new snapshot and start an empty log. Caller holds the lock.'''
+        if self._wal_file:
+            self._wal_file.close()
+        _replace_json_file(self.users_path, self.users)
+        _replace_json_file(self.posts_path, {'posts': self.posts, 'lsn': self._posts_lsn})
+        self._wal_file = self.wal_path.open('w')
+        self._wal_records = 0
+
+
+class ShardedUserStore(UserStore):
+    '''
+    Keeps each user's record and mailbox in its own shard file (store/users/<percent-encoded username>.json)
+    guarded by its own lock, so unrelated users never wait on each other and a write only
+    re-serializes the shards it touches. Shards are cached in memory once read, along with
+    the positions of each user's unread messages, so fetching new messages costs O(unread).
+
+    Opening the store migrates an existing single-file users.json (and any pending
+    write-ahead log) into shards and moves it aside to users.json.migrated.
+    '''
+
+    def __init__(self, store_dir = STORE_DIR_PATH):
+        store_path = Path('.') / Path(store_dir)
+        self.store_dir = store_dir
+        self.users_path = store_path / Path(USERS_PATH)
+        self.posts_path = store_path / Path(POSTS_PATH)
+        self.shards_path = store_path / Path(USER_SHARDS_DIR_PATH)
+        self.posts_lock = threading.Lock()
+        self.posts = []
+        self._shards = {} ##username -> cached user record
+        self._unread = {} ##username -> positions of the unread messages in the cached record
+        self._locks = {} ##username -> lock guarding that user's shard
+        self._locks_lock = threading.Lock()
+
+    def open(self):
+        '''Create the shard directory, migrate users.json into it if needed and load the post feed'''
+        _create_json_files(self.shards_path.parent)
+        self.shards_path.mkdir(exist_ok=True)
+        self._rename_shards()
+        self._migrate()
+        with self.posts_lock:
+            with self.posts_path.open('r') as posts_file:
+                self.posts = json.load(posts_file)['posts']
+
+    def close(self):
+        pass ##every write already reached its shard
+
+    def get_user(self, username):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            return dict(fetched_user) if fetched_user else None
+
+    def get_posts(self):
+        with self.posts_lock:
+            return list(self.posts)
+
+    def get_or_create_user(self, username, password):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if fetched_user:
+                return fetched_user
+            self._write_shard(username, _new_user_record(password))
+
+    def update_bio(self, username, entry, timestamp):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False
+            fetched_user['bio'] = {'entry': entry, 'timestamp': timestamp}
+            self._write_shard(username, fetched_user)
+        return True
+
+    def create_post(self, username, entry, timestamp):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False
+            fetched_user['posts'].insert(0, {'user': username, 'entry': entry, 'timestamp': timestamp})
+            self._write_shard(username, fetched_user)
+        with self.posts_lock:
+            self.posts.insert(0, {'user': username, 'entry': entry, 'timestamp': timestamp})
+            _replace_json_file(self.posts_path, {'posts': self.posts})
+        return True
+
+    def send_message(self, entry, username, recipient, timestamp = ''):
+        ##always take the two shard locks in username order so two users messaging each other cannot deadlock
+        first, second = sorted({username, recipient}) if username != recipient else (username, None)
+        with self._lock_for(first):
+            if second:
+                self._lock_for(second).acquire()
+            try:
+                fetched_sender = self._load_shard(username)
+                fetched_user = self._load_shard(recipient)
+                if not fetched_sender or not fetched_user:
+                    return False
+                sent = len(fetched_sender['messages'])
+                fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
+                self._unread[recipient].append(len(fetched_user['messages']))
+                fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'new'})
+                self._write_shard(username, fetched_sender)
+                if recipient != username:
+                    self._write_shard(recipient, fetched_user)
+            finally:
+                if second:
+                    self._lock_for(second).release()
+            return _mailbox_message(fetched_sender['messages'], sent)
+
+    def read_all_messages(self, username):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            result = [_mailbox_message(messages, i) for i in range(len(messages))]
+            if self._mark_read(username, fetched_user):
+                self._write_shard(username, fetched_user)
+            return sorted(result, key=lambda x: float(x["timestamp"]))
+
+    def read_new_messages(self, username):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            result = [_mailbox_message(messages, i) for i in self._unread[username]]
+            if self._mark_read(username, fetched_user):
+                self._write_shard(username, fetched_user) ##an empty poll never touches the disk
+            return sorted(result, key=lambda x: float(x["timestamp"]))
+
+    def peek_new_messages(self, username, after = 0):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False ##double check that user exists
+            unread = self._unread[username]
+            result = [_mailbox_message(fetched_user['messages'], i) for i in unread[bisect.bisect_left(unread, after):]] ##the id of position i is i + 1
+            return sorted(result, key=lambda x: float(x["timestamp"]))
+
+    def read_messages_since(self, username, cursor):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            result = [_mailbox_message(messages, i) for i in range(cursor, len(messages))]
+            if self._mark_read(username, fetched_user):
+                self._write_shard(username, fetched_user)
+            return result, len(messages)
+
+    def read_messages_page(self, username, limit = None, before = None):
+        with self._lock_for(username):
+            fetched_user = self._load_shard(username)
+            if not fetched_user:
+                return False ##double check that user exists
+            messages = fetched_user['messages']
+            start, end = _page_bounds(len(messages), limit, before)
+            result = [_mailbox_message(messages, i) for i in range(start, end)]
+            if self._mark_read(username, fetched_user, start, end):
+                self._write_shard(username, fetched_user)
+            return result, start + 1 if start > 0 else None
+
+    def _mark_read(self, username, fetched_user, first = 0, last = None):
+        '''Flip the indexed unread messages of username in [first, last) to read. Returns whether there were any. Caller holds the user's lock.'''
+        unread = self._unread[username]
+        self._unread[username] = _mark_unread_read(fetched_user['messages'], unread, first, last)
+        return len(self._unread[username]) != len(unread)
+
+    def _lock_for(self, username):
+        with self._locks_lock:
+            lock = self._locks.get(username, None)
+            if lock is None:
+                lock = self._locks[username] = threading.Lock()
+            return lock
+
+    def _shard_path(self, username):
+        '''Percent-encode the username, upper case letters included, so no two usernames share a shard even on case-insensitive file systems'''
+        name = ''.join(f'%{ord(c):02X}' if c in string.ascii_uppercase else quote(c, safe = '') for c in username)
+        return self.shards_path / Path(name + '.json')
+
+    def _rename_shards(self):
+        '''Move shards named before upper case letters were encoded to their current name'''
+        for shard_path in self.shards_path.glob('*.json'):
+            current_path = self._shard_path(unquote(shard_path.stem))
+            if shard_path.name != current_path.name:
+                os.replace(shard_path, current_path)
+
+    def _load_shard(self, username):
+        '''Return the cached record for username, reading its shard on first use. Caller holds the user's lock.'''
+        fetched_user = self._shards.get(username, None)
+        if fetched_user is None:
+            shard_path = self._shard_path(username)
+            if not shard_path.exists():
+                return None
+            with shard_path.open('r') as shard_file:
+                fetched_user = self._shards[username] = json.load(shard_file)
+            self._unread[username] = _index_unread(fetched_user['messages'])
+        return fetched_user
+
+    def _write_shard(self, username, fetched_user):
+        '''Persist the record for username to its shard. Caller holds the user's lock.'''
+        _replace_json_file(self._shard_path(username), fetched_user)
+        self._shards[username] = fetched_user
+        if username not in self._unread:
+            self._unread[username] = _index_unread(fetched_user['messages'])
+
+    def _migrate(self):
+        '''Split a single-file users.json (plus its write-ahead log) into per-user shards'''
+        if not self.users_path.exists():
+            return
+        wal_store = WalUserStore(self.store_dir)
+        wal_store.open() ##replays and folds in any log the single-file mode left behind
+        wal_store.close()
+        if not wal_store.users:
+            return
+        for username, fetched_user in wal_store.users.items():
+            fetched_user.pop('lsn', None)
+            if not self._shard_path(username).exists():
+                with self._lock_for(username):
+                    self._write_shard(username, fetched_user)
+        os.replace(self.users_path, self.users_path.with_name(self.users_path.name + '.migrated'))
+        wal_store.wal_path.unlink(missing_ok=True)
+        with self.users_path.open('w') as json_file:
+            json.dump({}, json_file, indent=4)
+        if DEBUG:
+            print(f'Migrated {len(wal_store.users)} users from {USERS_PATH} into {self.shards_path}.')
+
+
+class SqliteUserStore(UserStore):
+    '''
+    Keeps users, messages and posts in indexed SQLite tables (store/dsu.sqlite3). Each message is
+    one row with its sender, recipient, status and timestamp, so unread lookups, a user's history
+    and the post feed are index lookups instead of full-file scans.
+
+    Opening an empty database imports an existing users.json/posts.json.
+    Every thread gets its own connection, closed by release when its client thread ends; the
+    database runs in WAL journal mode so readers dont block the writer.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            bio_entry TEXT NOT NULL DEFAULT '',
+            bio_timestamp TEXT NOT NULL DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            status TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (sender, id);
+        CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, id);
+        CREATE INDEX IF NOT EXISTS messages_unread ON messages (recipient, status, id);
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS posts_by_user ON posts (username, id);
+    '''
+
+    def __init__(self, store_dir = STORE_DIR_PATH):
+        self.store_dir = store_dir
+        self.db_path = Path('.') / Path(store_dir) / Path(SQLITE_PATH)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def open(self):
+        '''Create the database and its tables if needed and import users.json into an empty database'''
+        self.db_path.parent.mkdir(exist_ok=True)
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(self.SCHEMA)
+        if not db.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+            self._import_json_store()
+
+    def close(self):
+        with self._connections_lock:
+            for db in self._connections:
+                db.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def release(self):
+        '''Close the connection of the calling thread, if it opened one'''
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            self._local.db = None
+            with self._connections_lock:
+                if db in self._connections:
+                    self._connections.remove(db)
+            db.close()
+
+    def get_user(self, username):
+        '''Return the user record for username without its messages'''
+        db = self._db()
+        row = db.execute('SELECT password, bio_entry, bio_timestamp FROM users WHERE username = ?', (username,)).fetchone()
+        if not row:
+            return None
+        posts = db.execute('SELECT entry, timestamp FROM posts WHERE username = ? ORDER BY id DESC', (username,)).fetchall()
+        return {'password': row[0], 'bio': {'entry': row[1], 'timestamp': row[2]},
+                'posts': [{'user': username, 'entry': entry, 'timestamp': timestamp} for entry, timestamp in posts]}
+
+    def get_posts(self):
+        rows = self._db().execute('SELECT username, entry, timestamp FROM posts ORDER BY id DESC').fetchall()
+        return [{'user': username, 'entry': entry, 'timestamp': timestamp} for username, entry, timestamp in rows]
+
+    def get_or_create_user(self, username, password):
+        db = self._db()
+        with db:
+            created = db.execute('INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)', (username, password))
+        if created.rowcount == 0:
+            return self.get_user(username)
+
+    def update_bio(self, username, entry, timestamp):
+        db = self._db()
+        with db:
+            updated = db.execute('UPDATE users SET bio_entry = ?, bio_timestamp = ? WHERE username = ?', (entry, timestamp, username))
+        return updated.rowcount == 1
+
+    def create_post(self, username, entry, timestamp):
+        db = self._db()
+        with db:
+            if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                return False
+            db.execute('INSERT INTO posts (username, entry, timestamp) VALUES (?, ?, ?)', (username, entry, timestamp))
+        return True
+
+    def send_message(self, entry, username, recipient, timestamp = ''):
+        db = self._db()
+        with db:
+            found = db.execute('SELECT COUNT(*) FROM users WHERE username IN (?, ?)', (username, recipient)).fetchone()[0]
+            if found != len({username, recipient}):
+                return False
+            inserted = db.execute('INSERT INTO messages (sender, recipient, entry, timestamp, status) VALUES (?, ?, ?, ?, ?)',
+                                  (username, recipient, entry, timestamp, 'new'))
+        return {'recipient': recipient, 'message': entry, 'timestamp': timestamp, 'id': inserted.lastrowid}
+
+    def read_all_messages(self, username):
+        db = self._db()
+        with db:
+            if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                return False ##double check that user exists
+            rows = self._history(db, username, 0)
+            db.execute("UPDATE messages SET status = 'read' WHERE recipient = ? AND status = 'new'", (username,))
+        return [{direction: other, 'message': entry, 'timestamp': timestamp, 'id': id} for id, direction, other, entry, timestamp in rows]
+
+    def read_new_messages(self, username):
+        db = self._db()
+        with db:
+            if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                return False ##double check that user exists
+            rows = db.execute("SELECT id, sender, entry, timestamp FROM messages WHERE recipient = ? AND status = 'new' ORDER BY id",
+                              (username,)).fetchall()
+            if rows:
+                db.execute("UPDATE messages SET status = 'read' WHERE recipient = ? AND status = 'new' AND id <= ?", (username, rows[-1][0]))
+        return [{'from': sender, 'message': entry, 'timestamp': timestamp, 'id': id} for id, sender, entry, timestamp in rows]
+
+    def peek_new_messages(self, username, after = 0):
+        db = self._db()
+        if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+            return False ##double check that user exists
+        rows = db.execute("SELECT id, sender, entry, timestamp FROM messages WHERE recipient = ? AND status = 'new' AND id > ? ORDER BY id",
+                          (username, after)).fetchall()
+        return [{'from': sender, 'message': entry, 'timestamp': timestamp, 'id': id} for id, sender, entry, timestamp in rows]
+
+    def read_messages_since(self, username, cursor):
+        '''Message ids are the global row ids, which only ever grow, so they work as a per-user cursor too'''
+        db = self._db()
+        with db:
+            if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                return False ##double check that user exists
+            rows = self._history(db, username, cursor)
+            db.execute("UPDATE messages SET status = 'read' WHERE recipient = ? AND status = 'new'", (username,))
+        result = [{direction: other, 'message': entry, 'timestamp': timestamp, 'id': id} for id, direction, other, entry, timestamp in rows]
+        return result, rows[-1][0] if rows else cursor
+
+    def read_messages_page(self, username, limit = None, before = None):
+        db = self._db()
+        with db:
+            if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                return False ##double check that user exists
+            upper = before if before is not None else SQLITE_MAX_ROWID
+            ##newest first so LIMIT picks the page; one extra row tells whether an older page exists
+            rows = db.execute('''SELECT id, 'recipient', recipient, entry, timestamp FROM messages WHERE sender = ? AND id < ?
+                                 UNION ALL
+                                 SELECT id, 'from', sender, entry, timestamp FROM messages WHERE recipient = ? AND id < ?
+                                 ORDER BY id DESC LIMIT ?''', (username, upper, username, upper, limit + 1 if limit else -1)).fetchall()
+            has_older = bool(limit) and len(rows) > limit
+            rows = rows[:limit] if limit else rows
+            rows.reverse()
+            if rows:
+                db.execute("UPDATE messages SET status = 'read' WHERE recipient = ? AND status = 'new' AND id BETWEEN ? AND ?",
+                           (username, rows[0][0], rows[-1][0]))
+        result = [{direction: other, 'message': entry, 'timestamp': timestamp, 'id': id} for id, direction, other, entry, timestamp in rows]
+        return result, rows[0][0] if has_older else None
+
+    def _history(self, db, username, cursor):
+        '''Rows (id, direction, other user, entry, timestamp) of the messages of username with an id above cursor'''
+        ##a message a user sent to themselves shows up once as sent and once as received, like in users.json
+        return db.execute('''SELECT id, 'recipient', recipient, entry, timestamp FROM messages WHERE sender = ? AND id > ?
+                             UNION ALL
+                             SELECT id, 'from', sender, entry, timestamp FROM messages WHERE recipient = ? AND id > ?
+                             ORDER BY id''', (username, cursor, username, cursor)).fetchall()
+
+    def _db(self):
+        '''Return this thread's connection to the database, opening it on first use'''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.db_path, timeout = 30, check_same_thread = False)
+            with self._connections_lock:
+                self._connections.append(db)
+        return db
+
+    def _import_json_store(self):
+        '''Copy the users and posts of the json store into the (empty) database'''
+        if not (Path('.') / Path(self.store_dir) / Path(USERS_PATH)).exists():
+            return
+        wal_store = WalUserStore(self.store_dir)
+        wal_store.open() ##replays and folds in any log the json mode left behind
+        wal_store.close()
+        if not wal_store.users:
+            return
+        ##both copies of a message live in users.json; import the recipient's copy, which carries the status
+        messages = []
+        for username, fetched_user in wal_store.users.items():
+            for message in fetched_user['messages']:
+                if 'from' in message:
+                    messages.append((message['from'], username, message['message'], message['timestamp'], message['status']))
+        messages.sort(key=lambda x: float(x[3])) ##ids must follow delivery order
+        db = self._db()
+        with db:
+            db.executemany('INSERT INTO users (username, password, bio_entry, bio_timestamp) VALUES (?, ?, ?, ?)',
+                           [(username, fetched_user['password'], fetched_user['bio']['entry'], fetched_user['bio']['timestamp'])
+                            for username, fetched_user in wal_store.users.items()])
+            db.executemany('INSERT INTO messages (sender, recipient, entry, timestamp, status) VALUES (?, ?, ?, ?, ?)', messages)
+            db.executemany('INSERT INTO posts (username, entry, timestamp) VALUES (?, ?, ?)',
+                           [(post['user'], post['entry'], post['timestamp']) for post in reversed(wal_store.posts)])
+        if DEBUG:
+            print(f'Imported {len(wal_store.users)} users from {USERS_PATH} into {self.db_path}.')
+
+
+STORE_CLASSES = {'wal': WalUserStore, 'sharded': ShardedUserStore, 'sqlite': SqliteUserStore}
+
+
+##Field schemas of the commands: rules of (check, error message), checked in order before the command runs.
+##The rules below build the checks shared by several commands.
+
+def _has_token():
+    return (lambda command: 'token' in command, 'Missing token.')
+
+def _command_size(size, error):
+    '''The command has size top level fields'''
+    return (lambda command: len(command) == size, error)
+
+def _max_fields(name, size, error, optional = ()):
+    '''The command object has at most size fields, plus the optional ones it holds'''
+    return (lambda command: len(command[name]) <= size + sum(field in command[name] for field in optional), error)
+
+def _required_fields(name, fields, error):
+    return (lambda command: all(field in command[name] for field in fields), error)
+
+def _choice(name, field, choices, default, error):
+    '''The optional field of the command object, if given, is one of choices'''
+    return (lambda command: command[name].get(field, default) in choices, error)
+
+def _directmessage_args(check):
+    '''Check the directmessage command object only if it is a dict'''
+    return lambda command: type(command['directmessage']) is not dict or check(command['directmessage'])
+
+COMMAND_SCHEMAS = {
+    'join': [
+        _command_size(1, "Incorrectly formatted join command."),
+        _max_fields('join', 3, "Extra fields provided to join command object.", SESSION_OPTIONS),
+        _required_fields('join', ['username', 'password', 'token'], "Missing required fields for join command object."),
+        _choice('join', 'encoding', ENCODINGS, 'json', "Unsupported encoding."),
+        _choice('join', 'compression', COMPRESSIONS, 'none', "Unsupported compression."),
+    ],
+    'resume': [
+        (lambda command: len(command) == 1 and type(command['resume']) is dict, "Incorrectly formatted resume command."),
+        _required_fields('resume', ['token'], "Missing required fields for resume command object."),
+        _max_fields('resume', 1, "Extra fields provided to resume command object.", SESSION_OPTIONS),
+        _choice('resume', 'encoding', ENCODINGS, 'json', "Unsupported encoding."),
+        _choice('resume', 'compression', COMPRESSIONS, 'none', "Unsupported compression."),
+    ],
+    'bio': [
+        _has_token(),
+        _command_size(2, "Incorrectly formatted bio command."),
+        _max_fields('bio', 2, "Extra fields provided to bio command object."),
+        _required_fields('bio', ['entry', 'timestamp'], "Missing required fields for bio command object."),
+    ],
+    'post': [
+        _has_token(),
+        _command_size(2, "Incorrectly formatted post command."),
+        _max_fields('post', 2, "Extra fields provided to post command object."),
+        _required_fields('post', ['entry', 'timestamp'], "Missing required fields for post command."),
+    ],
+    'directmessage': [
+        _has_token(),
+        _command_size(2, "Incorrectly formatted directmessage command."),
+        (lambda command: command['directmessage'] in ['all', 'new', 'subscribe'] or (type(command['directmessage']) is dict and (len(command['directmessage']) == 3 or list(command['directmessage']) in (['since'], ['all']))),
+         "Incorrect fields provided to directmessage command object."),
+        (_directmessage_args(lambda args: len(args) != 3 or all(field in args for field in ['entry', 'timestamp', 'recipient'])),
+         "Missing required fields for directmessage command."),
+        (_directmessage_args(lambda args: 'since' not in args or (type(args['since']) is int and args['since'] >= 0)),
+         "Invalid cursor provided to directmessage command."),
+        (_directmessage_args(lambda args: 'all' not in args or (type(args['all']) is dict and set(args['all']) <= {'limit', 'before'})),
+         "Incorrect fields provided to directmessage all object."),
+        (_directmessage_args(lambda args: 'all' not in args or all(type(value) is int and value > 0 for value in args['all'].values())),
+         "Invalid limit or before provided to directmessage command."),
+    ],
+}
+
+def _directmessage_variant(command):
+    '''Name the kind of directmessage command: send, since, page, or the all, new or subscribe string it holds'''
+    args = command['directmessage']
+    if type(args) is not dict:
+        return args
+    if 'since' in args:
+        return 'since'
+    if 'all' in args:
+        return 'page'
+    return 'send'
+
+
+class Command:
+    '''A command of the protocol, registered with DSUServer.register_command'''
+
+    def __init__(self, name, schema, handler, requires_user, variant):
+        self.name = name
+        self.rules = tuple(schema) ##compiled once: validate only walks the rules
+        self.handler = handler ##handler(command, session, user) returning the status and the fields of the response, or a dict of handlers per variant
+        self.requires_user = requires_user ##the command needs the token of the user joined on the session
+        self.variant = variant ##variant(command) names the handler to run and the histogram the request is recorded in
+
+    def validate(self, command):
+        '''Return the error message of the first rule of the schema the command breaks, or None'''
+        for check, error in self.rules:
+            try:
+                if not check(command):
+                    return error
+            except (TypeError, AttributeError, KeyError): ##a field of the wrong type
+                return error
+        return None
+
+
+class CommandStats:
+    '''Latency histograms of the requests handled, per command and outcome. Safe to record from any thread.'''
+
+    def __init__(self):
+        self.histograms = {} ##(command, outcome) -> number of requests per bucket of LATENCY_BUCKETS, plus one for slower requests
+        self._lock = threading.Lock()
+
+    def record(self, command, outcome, seconds):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            counts = self.histograms.get((command, outcome))
+            if counts is None:
+                counts = self.histograms[(command, outcome)] = [0] * (len(LATENCY_BUCKETS) + 1)
+            counts[bucket] += 1
+
+    def summary(self):
+        '''Return the count, the p50 and p99 latencies (the upper bound of their bucket, None if slower than every bound) and the histogram of each command and outcome'''
+        with self._lock:
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+        summary = {}
+        for (command, outcome), counts in sorted(histograms.items()):
+            summary.setdefault(command, {})[outcome] = {'count': sum(counts), 'p50': _percentile(counts, 0.5), 'p99': _percentile(counts, 0.99), 'histogram': counts}
+        return {'buckets': LATENCY_BUCKETS, 'commands': summary}
+
+    def report(self):
+        '''Format the summary as a table, slowest p99 first'''
+        rows = [(command, outcome, stats) for command, outcomes in self.summary()['commands'].items() for outcome, stats in outcomes.items()]
+        rows.sort(key = lambda row: row[2]['p99'] if row[2]['p99'] is not None else float('inf'), reverse = True)
+        lines = [f'{"command":24}{"outcome":8}{"count":>10}{"p50 ms":>10}{"p99 ms":>10}']
+        for command, outcome, stats in rows:
+            p50, p99 = (f'{value * 1000:.2f}' if value is not None else 'slower' for value in (stats['p50'], stats['p99']))
+            lines.append(f'{command:24}{outcome:8}{stats["count"]:>10}{p50:>10}{p99:>10}')
+        return '\n'.join(lines)
+
+def _percentile(counts, fraction):
+    '''Return the upper bound of the bucket holding the given fraction of the requests'''
+    rank = fraction * sum(counts)
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + [None], counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+
+class ClientSession:
+    '''State of one client connection, shared by the threaded and asyncio engines'''
+
+    def __init__(self, write, abort):
+        self.token = None ##token of the user joined on this connection
+        self.subscribed_user = None ##user whose new direct messages are pushed to this connection
+        self.subscribing = None ##user a subscribe request was answered for, until the pushes start
+        self.pushed_id = 0 ##highest id of the messages pushed to this connection
+        self.push_lock = threading.Lock() ##one push at a time, so no message is pushed twice
+        self.encoding = 'json' ##encoding of the responses, chosen by the client in join or resume
+        self.compression = 'none' ##compression of the large responses, chosen by the client in join or resume
+        self._write = write
+        self._abort = abort
+        self._write_lock = threading.Lock()
+        self._pushes = None ##frames waiting for the push thread to write them
+        self._push_backlog = 0 ##bytes in _pushes
+        self._push_backlog_lock = threading.Lock()
+        self._closed = False
+
+    def send(self, data):
+        '''Write encoded frames to the client. Safe to call from any thread.'''
+        with self._write_lock:
+            self._write(data)
+
+    def push(self, data):
+        '''Queue a push frame and return without waiting for it to be written, so the request pushing it never waits on a slow client.
+        A client leaving more than PUSH_BACKLOG_LIMIT bytes of pushes unwritten is disconnected instead.'''
+        with self._push_backlog_lock:
+            if self._closed:
+                return
+            if self._push_backlog + len(data) > PUSH_BACKLOG_LIMIT:
+                self._abort()
+                return
+            self._push_backlog += len(data)
+            if self._pushes is None:
+                self._pushes = queue.Queue()
+                threading.Thread(target = self._write_pushes, args = (self._pushes,), daemon = True).start()
+            self._pushes.put(data)
+
+    def close(self):
+        '''Stop the push thread once the connection is closed'''
+        with self._push_backlog_lock:
+            self._closed = True
+            if self._pushes is not None:
+                self._pushes.put(None)
+
+    def _write_pushes(self, pushes):
+        while True:
+            data = pushes.get()
+            if data is None:
+                return
+            try:
+                self.send(data)
+            except OSError:
+                return ##connection closed
+            with self._push_backlog_lock:
+                self._push_backlog -= len(data)
+
+    def encode_response(self, msg_type, **fields):
+        '''Encode a response in the encoding the client asked for, compressing it if it is large and the client asked for it'''
+        if self.encoding == 'binary':
+            frame = ds_protocol.encode_binary_response(msg_type, **fields)
+        else:
+            frame = ds_protocol.encode_response_bytes(msg_type, **fields)
+        if self.compression == 'zlib' and len(frame) > COMPRESS_THRESHOLD:
+            frame = ds_protocol.compress_frame(frame, COMPRESS_LEVEL)
+        return frame
+
+
+class AsyncClientSession(ClientSession):
+    '''Client session of the asyncio engine. The event loop writes every frame, buffering it without blocking.'''
+
+    def __init__(self, loop, writer):
+        super().__init__(lambda data: loop.call_soon_threadsafe(writer.write, data), writer.transport.abort)
+        self._loop = loop
+        self._writer = writer
+
+    def push(self, data):
+        self._loop.call_soon_threadsafe(self._push_on_loop, data)
+
+    def close(self):
+        pass ##no push thread
+
+    def _push_on_loop(self, data):
+        if self._writer.transport.get_write_buffer_size() + len(data) > PUSH_BACKLOG_LIMIT:
+            self._writer.transport.abort() ##the client is too slow
+        elif not self._writer.is_closing():
+            self._writer.write(data)
+
+
 class DSUServer:
     
-    def __init__(self, host = '127.0.0.1', port = 3001):
+    def __init__(self, host = '127.0.0.1', port = 3001, store = None):
         self.host = host
         self.port = port
         self.sessions = {} ##token -> user 
+        self.detached_sessions = {} ##token -> (user, deadline) of closed connections, oldest first
+        self.detached_lock = threading.Lock()
         self.clients = []
+        self.subscribers = {} ##user -> sessions their new direct messages are pushed to
+        self.subscribers_lock = threading.Lock()
+        self.store = store if store else STORE_CLASSES[STORAGE_MODE]()
+        self.stats = CommandStats()
+        self.commands = {} ##command name -> Command, in the order they are looked for in a request
+        self.register_command('join', COMMAND_SCHEMAS['join'], self._join)
+        self.register_command('resume', COMMAND_SCHEMAS['resume'], self._resume)
+        self.register_command('bio', COMMAND_SCHEMAS['bio'], self._bio, requires_user = True)
+        self.register_command('post', COMMAND_SCHEMAS['post'], self._post, requires_user = True)
+        self.register_command('directmessage', COMMAND_SCHEMAS['directmessage'], {
+            'send': self._send_direct_message,
+            'all': self._direct_messages_all,
+            'page': self._direct_messages_page,
+            'since': self._direct_messages_since,
+            'new': self._direct_messages_new,
+            'subscribe': self._direct_messages_subscribe,
+        }, requires_user = True, variant = _directmessage_variant)
+
+    def register_command(self, name, schema, handler, requires_user = False, variant = None):
+        '''Add a command to the protocol. schema is its list of (check, error message) rules, and handler(command, session, user)
+        returns the status and the fields of its response. user is the user joined on the session when requires_user is True:
+        requests without a valid token are answered with an error without running the handler. If variant is given, handler is a
+        dict of handlers and variant(command) names the one to run.'''
+        self.commands[name] = Command(name, schema, handler, requires_user, variant)
     
     def handle_client(self, client_socket, client_address):
 
         '''Handle requests from a single client'''
-        current_user_token = None   
+        session = ClientSession(client_socket.sendall, lambda: client_socket.shutdown(socket.SHUT_RDWR))
         self.clients.append(client_socket)
+        buffer = bytearray() ##bytes received but not yet terminated by \r\n
         try:
             while True:
-                data = client_socket.recv(4096)
+                data = client_socket.recv(65536)
                 if DEBUG:
                     print(f"Message received by server: {repr(data)}")
-                direct_message_read = False
-                direct_message_sent = False
-                msg = data.decode().strip() 
-                if not msg:
+                if not data:
+                    msg = buffer.strip() ##a last request may have been sent without its \r\n
+                    if msg:
+                        session.send(self.handle_request(msg, session))
                     if DEBUG:
                         print("Connection closed.")
                     break
-                try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
-                    message = 'Incorrectly formatted JSON message.'
-                    status = 'error'
-                else: 
-                    message = ""
-                    status = "error"
-                    
-                    if 'join' in command:
-                        
-                        if len(command) != 1: 
-                            status = "error"
-                            message = "Incorrectly formatted join command."
-                        elif len(command['join']) > 3:
-                            status = "error"
-                            message = "Extra fields provided to join command object."
-                        elif not all(field in command['join'] for field in ['username', 'password', 'token']):
-                            status = "error"
-                            message = "Missing required fields for join command object."
-                        elif current_user_token:
-                            status = "error"
-                            message = "User already joined on the active session."
-                        else:
-                            ##execute join command
-                            
-                            uname = command['join']['username']
-                            password = command['join']['password']
-                            token = command['join']['token']
-                            
-                            fetched_user = self._get_or_create_new_user(uname, password)
-
-                            current_user_token = generate_token()
-                            if not fetched_user:
-                                message = f'Welcome to ICS32 Distributed Social, {uname}!'
-                                status = 'ok'
-                                self.sessions[current_user_token] = uname
-
-                                
-                            else:
-                                if fetched_user['password'] != password:
-                                    status = "error"
-                                    message = f'Incorrect password for the user {uname}'
-                                    current_user_token = None
-                                    
-                                else:
-                                    status = "ok"
-                                    message = f'Welcome back, {uname}!'
-                                    self.sessions[current_user_token] = uname
-
-
-                    elif 'bio' in command:
-                        if 'token' not in command:
-                        
-                            message = "Missing token."
-                            status = "error"
-                            #print('Missing token')
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted bio command."
-                            status = "error"
-                            #print('Incorrectly formatted command')
-                        elif len(command['bio']) > 2:
-                            message = "Extra fields provided to bio command object."
-                            status = "error"
-                            #print('Incorrect number of fields')
-                        elif not all(field in command['bio'] for field in ['entry', 'timestamp']):
-                            status = "error"
-                            message = "Missing required fields for bio command object."
-                        
-                        else:
-                            entry = command['bio']['entry']
-                            #timestamp = command['bio']['timestamp']
-                            
-                            timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
-                            token = command['token']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                self._update_bio(current_user, entry, timestamp)
-                                message = f"Bio for {current_user} updated."
-                                status = 'ok'
-                            else:
-                                message = 'Invalid user token.'
-                                status = 'error'
-
-                    elif 'post' in command:
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted post command."
-                            status = 'error'
-                        elif len(command['post']) > 2:
-                            message = "Extra fields provided to post command object."
-                            status = 'error'
-                        elif not all(field in command['post'] for field in ['entry', 'timestamp']):
-                            message = "Missing required fields for post command."
-                            status = 'error'
-                        else:
-                            entry = command['post']['entry']
-                            #timestamp = command['post']['timestamp'] COMMENTED OUT TO SHOW HOW IT COULD USE YOUR PROVIDED TIMESTAMP
-                            
-                            timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
-                            token = command['token']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                self._create_post(current_user, entry, timestamp)
-                                message = f'Post created by {current_user}'
-                                status = 'ok'
-                            else:
-                                message = 'Invalid user token.'
-                                status = 'error'
-
-                    ###direct message handling
-                    elif 'directmessage' in command:
-                        
-                        args = command['directmessage']
-
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted directmessage command."
-                            status = 'error'
-                        elif args not in ['all', 'new'] and not (type(args) is dict and len(args) == 3):
-                            message = "Incorrect fields provided to directmessage command object."
-                            status = 'error'
-                        elif type(args) is dict and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
-                            message = "Missing required fields for directmessage command."
-                            status = 'error'
-                        else:
-                            token = command['token']
-                            
-                            if type(args) is dict:
-                                recipient = args['recipient']
-                                #timestamp = args['timestamp']
-                                timestamp = str((datetime.now().timestamp()))
-                                entry = args['entry']
-                                print(token, current_user_token, self.sessions)
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_sent = True
-                                    
-                                    if self._send_message(entry,current_user, recipient, timestamp):
-                                        message = f'Direct message sent'
-                                        status = 'ok'
-                                    else:
-                                        message = f'Unable to send direct message'
-                                        status = 'error'
-                                else:
-                                    message = 'Invalid user token.'
-                                    status = 'error'
-                            elif args == 'all':
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_read = True
-                                    message = self._read_all_messages(current_user)
-                                    status = 'ok'
-                                else:
-                                    message = f'Invalid user token.'
-                                    status = 'error'
-                            elif args == 'new':
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_read = True
-                                    message = self._read_new_messages(current_user)
-                                    status = 'ok'
-                                else:
-                                    message = f'Invalid user token.'
-                                    status = 'error'
-
-                            else:
-                                message = 'Invalid argument for directmessage field.'
-                                status = 'error'
-
-                    else:
-                        message = 'Invalid command.'
-                        status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
-                    resp = {'response': {'type':status, 'messages': message} }
-                elif direct_message_sent:
-                    resp = {'response': {'type':status, 'message': message} }
-                elif status == 'ok':
-                    resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
-                else:
-                    resp = {'response': {'type':status, 'message': message}}
-                json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
+                ##a read may hold part of a request or several pipelined ones: answer every complete line, in order, with one send
+                search_from = max(len(buffer) - 1, 0)
+                buffer += data
+                responses = []
+                line_start = 0
+                line_end = buffer.find(b'\r\n', search_from)
+                while line_end != -1:
+                    msg = buffer[line_start:line_end].strip() ##requests stay bytes: json.loads reads them directly
+                    if msg:
+                        responses.append(self.handle_request(msg, session))
+                    line_start = line_end + 2
+                    line_end = buffer.find(b'\r\n', line_start)
+                del buffer[:line_start]
+                if responses:
+                    session.send(b''.join(responses))
+                    self._start_pushes(session)
+                if len(buffer) > MAX_REQUEST_SIZE:
+                    session.send(session.encode_response('error', message='Request too large.'))
+                    break
         except Exception as e:
             print(f"Error handling client {client_address}: {e}")
         finally:
+            self._end_session(session) ##however the connection ended, even reset, its token can be resumed
             client_socket.close()
+            session.close()
+            self.store.release() ##the thread ends with this client
             self.clients.remove(client_socket)
-            
+
+    def handle_request(self, msg, session):
+
+        '''Execute one request (a json command) sent on the client session and return the encoded response. Shared by the threaded and asyncio engines.
+        The time it takes is recorded in the histogram of its command.'''
+        started = time.perf_counter()
+        label = 'invalid'
+        try:
+            command = json.loads(msg.strip())
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            status, fields = 'error', {'message': 'Incorrectly formatted JSON message.'}
+        else:
+            status, fields, label = self._dispatch(command, session)
+        if DEBUG:
+            print(f'Server sending the following message: "{fields.get("message", fields.get("messages"))}"')
+        response = session.encode_response(status, **fields) ##encoded straight to bytes, fixed messages (most errors) from a cache
+        self.stats.record(label, status, time.perf_counter() - started)
+        return response
+
+    def _dispatch(self, command, session):
+        '''Find the registered command of a request, validate it against its schema and run its handler. Returns the status and the fields of the response,
+        and the name of the histogram the request is recorded in.'''
+        try:
+            spec = next((spec for name, spec in self.commands.items() if name in command), None)
+        except TypeError:
+            spec = None
+        if spec is None:
+            return 'error', {'message': 'Invalid command.'}, 'invalid'
+        error = spec.validate(command)
+        if error:
+            return 'error', {'message': error}, spec.name
+        handler, label = spec.handler, spec.name
+        if spec.variant:
+            variant = spec.variant(command)
+            handler, label = spec.handler[variant], f'{spec.name} {variant}'
+        user = None
+        if spec.requires_user:
+            token = command['token']
+            if token != session.token or token not in self.sessions:
+                return 'error', {'message': 'Invalid user token.'}, label
+            user = self.sessions[token]
+        status, fields = handler(command, session, user)
+        return status, fields, label
+
+    ##command handlers, registered in __init__
+
+    def _join(self, command, session, user):
+        if session.token:
+            return 'error', {'message': "User already joined on the active session."}
+        uname = command['join']['username']
+        password = command['join']['password']
+        fetched_user = self._get_or_create_new_user(uname, password)
+        if not fetched_user:
+            message = f'Welcome to ICS32 Distributed Social, {uname}!'
+        elif fetched_user['password'] != password:
+            return 'error', {'message': f'Incorrect password for the user {uname}'}
+        else:
+            message = f'Welcome back, {uname}!'
+        token = generate_token()
+        self.sessions[token] = uname
+        return self._joined(session, token, message, command['join'])
+
+    def _resume(self, command, session, user):
+        if session.token:
+            return 'error', {'message': "User already joined on the active session."}
+        token = command['resume']['token']
+        uname = self._resume_session(token)
+        if not uname:
+            return 'error', {'message': "Unable to resume the session."}
+        return self._joined(session, token, f'Welcome back, {uname}!', command['resume'])
+
+    def _joined(self, session, token, message, options):
+        '''Join the session with token, using the encoding and compression asked for in options. The join response already uses them.'''
+        session.token = token
+        session.encoding = options.get('encoding', 'json')
+        session.compression = options.get('compression', 'none')
+        return 'ok', {'message': message, 'token': token, 'capabilities': CAPABILITIES}
+
+    def _bio(self, command, session, user):
+        timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
+        self._update_bio(user, command['bio']['entry'], timestamp)
+        return 'ok', {'message': f"Bio for {user} updated.", 'token': session.token}
+
+    def _post(self, command, session, user):
+        #timestamp = command['post']['timestamp'] COMMENTED OUT TO SHOW HOW IT COULD USE YOUR PROVIDED TIMESTAMP
+        timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
+        self._create_post(user, command['post']['entry'], timestamp)
+        return 'ok', {'message': f'Post created by {user}', 'token': session.token}
+
+    def _send_direct_message(self, command, session, user):
+        args = command['directmessage']
+        timestamp = str((datetime.now().timestamp()))
+        sent_record = self._send_message(args['entry'], user, args['recipient'], timestamp)
+        if not sent_record:
+            return 'error', {'message': 'Unable to send direct message'}
+        self._push_new_messages(args['recipient'])
+        return 'ok', {'message': 'Direct message sent', 'record': sent_record}
+
+    def _direct_messages_all(self, command, session, user):
+        return 'ok', {'messages': self._read_all_messages(user)}
+
+    def _direct_messages_page(self, command, session, user):
+        page = command['directmessage']['all']
+        messages, cursor = self._read_messages_page(user, page.get('limit'), page.get('before'))
+        return 'ok', {'messages': messages, 'cursor': cursor}
+
+    def _direct_messages_since(self, command, session, user):
+        messages, cursor = self._read_messages_since(user, command['directmessage']['since'])
+        if cursor is None:
+            return 'ok', {'messages': messages}
+        return 'ok', {'messages': messages, 'cursor': cursor}
+
+    def _direct_messages_new(self, command, session, user):
+        return 'ok', {'messages': self._read_new_messages(user)}
+
+    def _direct_messages_subscribe(self, command, session, user):
+        self._unsubscribe(session)
+        messages = self._read_new_messages(user) ##whatever arrived before subscribing
+        session.subscribing = user ##the pushes start once this response is sent, see _start_pushes
+        return 'ok', {'messages': messages}
+
+    def _end_session(self, session):
+        '''Detach the token of the user joined on a closed client session. It can be resumed for SESSION_RESUME_GRACE seconds.'''
+        uname = self.sessions.pop(session.token, None) if session.token else None
+        if uname:
+            now = time.monotonic()
+            with self.detached_lock:
+                self._expire_detached_sessions(now)
+                self.detached_sessions[session.token] = (uname, now + SESSION_RESUME_GRACE)
+        self._unsubscribe(session)
+
+    def _resume_session(self, token):
+        '''Reattach the token of a closed client session if it is still within its grace period. Returns its user, or None.'''
+        with self.detached_lock:
+            self._expire_detached_sessions(time.monotonic())
+            detached = self.detached_sessions.pop(token, None)
+        if not detached:
+            return None
+        self.sessions[token] = detached[0]
+        return detached[0]
+
+    def _expire_detached_sessions(self, now):
+        ##every token gets the same grace period, so the oldest ones come first
+        while self.detached_sessions:
+            token = next(iter(self.detached_sessions))
+            if self.detached_sessions[token][1] > now:
+                break
+            del self.detached_sessions[token]
+
+    def _start_pushes(self, session):
+        '''Start the pushes a subscribe request on the session asked for. Called once its response is sent: a push written
+        before it would be read as the response. Then pushes what arrived in between.'''
+        username, session.subscribing = session.subscribing, None
+        if username:
+            self._subscribe(session, username)
+            self._push(session, username)
+
+    def _subscribe(self, session, username):
+        '''Push the new direct messages of username to the client session from now on'''
+        self._unsubscribe(session)
+        with self.subscribers_lock:
+            self.subscribers.setdefault(username, []).append(session)
+        session.subscribed_user = username
+        session.pushed_id = 0
+
+    def _unsubscribe(self, session):
+        with self.subscribers_lock:
+            subscribed = self.subscribers.get(session.subscribed_user, [])
+            if session in subscribed:
+                subscribed.remove(session)
+            if not subscribed:
+                self.subscribers.pop(session.subscribed_user, None)
+        session.subscribed_user = None
+
+    def _push_new_messages(self, username):
+        '''Push the new direct messages of username to every connection subscribed to them'''
+        with self.subscribers_lock:
+            subscribed = list(self.subscribers.get(username, []))
+        for session in subscribed:
+            self._push(session, username)
+
+    def _push(self, session, username):
+        '''Push the new direct messages of username not pushed to the session yet. They are not marked read: a push lost with its
+        connection is returned again by the subscribe request of the next one.'''
+        with session.push_lock:
+            messages = self._peek_new_messages(username, session.pushed_id)
+            if not messages:
+                return ##another request already delivered them
+            try:
+                session.push(session.encode_response('push', messages=messages))
+            except (OSError, RuntimeError) as e: ##connection or event loop already closed
+                if DEBUG:
+                    print(f'Unable to push to a subscriber of {username}: {e}')
+                return
+            session.pushed_id = max(message['id'] for message in messages)
+
+    async def _handle_async_client(self, reader, writer):
+
+        '''Handle requests from a single client on the event loop. Requests run in the default executor since the storage backends block.'''
+        loop = asyncio.get_running_loop()
+        session = AsyncClientSession(loop, writer)
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(b'\r\n')
+                except asyncio.IncompleteReadError as e:
+                    data = e.partial ##connection closed, possibly after a last unterminated request
+                if DEBUG:
+                    print(f"Message received by server: {repr(data)}")
+                msg = data.strip()
+                if not msg:
+                    if DEBUG:
+                        print("Connection closed.")
+                    break
+                writer.write(await loop.run_in_executor(None, self.handle_request, msg, session))
+                if session.subscribing:
+                    await loop.run_in_executor(None, self._start_pushes, session)
+                await writer.drain()
+        except asyncio.LimitOverrunError:
+            writer.write(session.encode_response('error', message='Request too large.'))
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            self._end_session(session)
+            writer.close()
+
     
 
     def _send_message(self, entry, username, recipient, timestamp = ''):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-            
-            fetched_sender = existing_users.get(username, None)
-            fetched_user = existing_users.get(recipient, None)
-            if not fetched_sender:
-                return False
-            if not fetched_user:
-                return False
-            
-            else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'new'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
-        return True
+        return self.store.send_message(entry, username, recipient, timestamp)
 
     def _read_all_messages(self, username):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                else:
-                    mod_message = {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'new':
-                    message['status'] = 'read'
-
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        return self.store.read_all_messages(username)
 
-    
     def _read_new_messages(self, username):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if message['status'] == 'new':
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                    result.append(mod_message)
-                    message['status'] = 'read'
-            
-            
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
-                    
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        return self.store.read_new_messages(username)
 
+    def _peek_new_messages(self, username, after):
+        return self.store.peek_new_messages(username, after)
 
+    def _read_messages_page(self, username, limit, before):
+        '''Read one page of the history of username. Returns the messages and the before cursor of the next (older) page, or None.'''
+        return self.store.read_messages_page(username, limit, before)
 
+    def _read_messages_since(self, username, cursor):
+        '''Read the messages of username newer than cursor. Returns the messages and the cursor the client should send next time.'''
+        return self.store.read_messages_since(username, cursor)
 
     def _get_user(self, username):
 
         '''Gets the user object associated with the username. This function is never called.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
-    
-
+        return self.store.get_user(username)
 
     def _get_or_create_new_user(self, username, password):
 
-        '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+        '''Get the user associated with the username. If it doesnt exist, create a new user.'''
+        return self.store.get_or_create_user(username, password)
 
-            fetched_user = existing_users.get(username, None)
-            if fetched_user:
-                return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user: ##double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}})
-                    json.dump(existing_users, user_file)
-            
-    
-    
     def _update_bio(self,username, entry, timestamp):
 
         '''Update the bio associated with the username.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            with users_path.open('w') as user_file:
-                
-                fetched_user = existing_users.get(username, None)
-                if not fetched_user: ##double check that no user exists
-                    return False
-                else:
-                    fetched_user['bio'] = {'entry':entry, 'timestamp':timestamp}
-                    
-                json.dump(existing_users, user_file)
+        return self.store.update_bio(username, entry, timestamp)
 
-    
     def _create_post(self, username, entry, timestamp):
         '''Create a post for the user (username). Add the post to the user's posts and add the post to the list of all posts'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            
-            with users_path.open('w') as user_file:
-                fetched_user = existing_users.get(username, None)
-                if not fetched_user: ##double check that user exists
-                    return False
-                else:
-                    fetched_user['posts'].insert(0, {'user': username, 'entry':entry, 'timestamp':timestamp})
-                    
-                json.dump(existing_users, user_file)
-        with posts_file_lock:
-            existing_posts = None
-            posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-            with posts_path.open('r') as posts_file:
-                existing_posts = json.load(posts_file)['posts']
-            
-            existing_posts.insert(0, {'user':username, 'entry':entry, 'timestamp':timestamp})
-
-            with posts_path.open('w') as posts_file:
-                json.dump({"posts":existing_posts}, posts_file)
+        return self.store.create_post(username, entry, timestamp)
         
     def _create_storage_system(self):
-        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-        store_path = Path('.') / Path(STORE_DIR_PATH)
-        store_path.mkdir(exist_ok=True)
-        if not users_path.exists():
-            with users_path.open('w') as json_file:
-                json.dump({}, json_file, indent=4)
-        if not posts_path.exists():
-            with posts_path.open('w') as json_file:
-                json.dump({'posts':[]}, json_file, indent=4)
+        '''Creates the local storage system if it doesnt already exist. The storage backend creates a directory called "store" with the files it needs (posts.json and users.json by default)'''
+        self.store.open()
 
     def start_server(self):
         
@@ -447,7 +1469,7 @@ class DSUServer:
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
                 srv.bind((self.host, self.port))
-                srv.listen(5)
+                srv.listen(LISTEN_BACKLOG)
                 if DEBUG:
                     print("DSUserver is listening on port", self.port)
                 while True:
@@ -463,6 +1485,30 @@ class DSUServer:
             self.clients = []
             if DEBUG:
                 print('Disconnected all clients.')
+                print(self.stats.report())
+            self.store.close()
+
+    def start_async_server(self):
+
+        '''Starts the server on a single asyncio event loop, so idle clients cost a coroutine instead of an OS thread'''
+        self._create_storage_system() #does nothing if the server store files exists already
+        try:
+            asyncio.run(self._serve_async())
+        except KeyboardInterrupt as e:
+            if DEBUG:
+                print(f'Server shutting down...')
+        finally:
+            if DEBUG:
+                print('Disconnected all clients.')
+                print(self.stats.report())
+            self.store.close()
+
+    async def _serve_async(self):
+        srv = await asyncio.start_server(self._handle_async_client, self.host, self.port, limit = MAX_REQUEST_SIZE, backlog = LISTEN_BACKLOG)
+        if DEBUG:
+            print("DSUserver (asyncio) is listening on port", self.port)
+        async with srv:
+            await srv.serve_forever()
 
         
 
@@ -479,44 +1525,45 @@ def index():
 
 @app.route('/posts') #UNCOMMENT IF YOU WANT
 def posts():
-    with posts_file_lock:
-        existing_posts = None
-        posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-        with posts_path.open('r') as posts_file:
-            existing_posts = json.load(posts_file)['posts']
+    existing_posts = app.config['DSU_STORE'].get_posts() ##users.json/posts.json lag behind the write-ahead log, so read the live store
 
     return render_template('index.html', posts = existing_posts)
 
 @app.route('/user/<string:username>') #UNCOMMENT IF YOU WANT
 def user_profile(username):
-    with users_file_lock:
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        existing_users = None
-        with users_path.open('r') as user_file:
-            existing_users = json.load(user_file)
-
-        fetched_user = existing_users.get(username, None)
-        #print(fetched_user['posts'])
-        if fetched_user:
-            user = {'username': username, 'bio': fetched_user['bio']['entry'], 'biots': fetched_user['bio']['timestamp'], 'posts': fetched_user['posts'] }
-            return render_template('user_profile.html', user = user)
-        else:
-            return "User not found..."
+    fetched_user = app.config['DSU_STORE'].get_user(username)
+    #print(fetched_user['posts'])
+    if fetched_user:
+        user = {'username': username, 'bio': fetched_user['bio']['entry'], 'biots': fetched_user['bio']['timestamp'], 'posts': fetched_user['posts'] }
+        return render_template('user_profile.html', user = user)
+    else:
+        return "User not found..."
+
+@app.route('/stats')
+def stats():
+    # Latency histograms of the TCP server, per command and outcome
+    return app.config['DSU_STATS'].summary()
 
 
 def run_flask_server(host = '127.0.0.1', port = 3002):
     app.run(host = host, port = port)
 
 
-def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002):
+def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002, storage = STORAGE_MODE, engine = ENGINE):
+
+    server = DSUServer(host, port1, STORE_CLASSES[storage]())
+    app.config['DSU_STORE'] = server.store
+    app.config['DSU_STATS'] = server.stats
 
     #UNCOMMENT THE FOLLOWING LINES TO RUN THE FLASK SERVER
     flask_thread = threading.Thread(target=run_flask_server, daemon=True, args = (host, port2))
     flask_thread.start()
 
     try:
-        server = DSUServer(host, port1)
-        server.start_server()
+        if engine == 'asyncio':
+            server.start_async_server()
+        else:
+            server.start_server()
     except Exception as e:
         print(f'Server raised the following error:{e}')
     
@@ -524,13 +1571,13 @@ def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002):
 
 if __name__ == '__main__':
     host = '127.0.0.1'
-    port1 = 3001
-    port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
-    if len(sys.argv) >= 3:
-        port2 = int(sys.argv[2])
+    parser = argparse.ArgumentParser(description = 'ICS32 Distributed Social server')
+    parser.add_argument('port1', nargs = '?', type = int, default = 3001, help = 'port of the DSU server')
+    parser.add_argument('port2', nargs = '?', type = int, default = 3002, help = 'port of the flask frontend')
+    parser.add_argument('--storage', choices = sorted(STORE_CLASSES), default = STORAGE_MODE, help = 'storage backend (default: %(default)s)')
+    parser.add_argument('--engine', choices = ['asyncio', 'threads'], default = ENGINE, help = 'server engine (default: %(default)s)')
+    args = parser.parse_args()
    
-    run_servers(host,port1,port2)
+    run_servers(host, args.port1, args.port2, args.storage, args.engine)
 
 
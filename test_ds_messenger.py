@@ -3,8 +3,13 @@ Testing module for ds_messenger
 '''
 
 
+import asyncio
+import queue
+import time
+import pytest
+import ds_protocol
 from ds_messenger import DirectMessage, DirectMessenger, \
-    connect_to_server, join_server
+    AsyncDirectMessenger, connect_to_server, join_server
 
 
 def test_to_dict():
@@ -56,6 +61,19 @@ def test_send_fail():
     assert dm2.send('FailTest', 'qwerty') is False
 
 
+def test_send_message():
+    '''
+    Tests that send_message returns the message stored by the server
+    '''
+    dm = DirectMessenger('127.0.0.1', 'tyui', 'tyui')
+    DirectMessenger('127.0.0.1', 'ghjk', 'ghjk')
+    sent = dm.send_message('Stored', 'ghjk')
+    assert sent.recipient == 'ghjk'
+    assert sent.message == 'Stored'
+    assert dm.retrieve_all()[-1].to_dict() == sent.to_dict()
+    assert dm.send_message('FailTest', 'ghjkqwer') is None
+
+
 def test_retrieve_new():
     '''
     Tests the retrieve_new function with a valid call
@@ -117,6 +135,46 @@ def test_retrieve_new_none():
     assert len(msgs2) == 0
 
 
+def test_retrieve_since():
+    '''
+    Tests retrieve_since with and without a cursor
+    '''
+    dm = DirectMessenger('127.0.0.1', 'qwer', 'qwer')
+    msgs = dm.retrieve_since()
+    cursor = dm.cursor
+
+    assert isinstance(msgs, list)
+    assert len(msgs) == 2
+    assert msgs[0].recipient == 'asdf'
+    assert msgs[0].message == 'Test'
+    assert msgs[1].sender == 'asdf'
+    assert msgs[1].message == 'Test2'
+    assert cursor == msgs[1].id
+    assert dm.retrieve_since(cursor) == []
+    assert dm.cursor == cursor
+
+    newer = dm.retrieve_since(msgs[0].id)
+    assert len(newer) == 1
+    assert newer[0].message == 'Test2'
+
+
+def test_retrieve_pages():
+    '''
+    Tests retrieve_pages retrieving the history one message at a time
+    '''
+    dm = DirectMessenger('127.0.0.1', 'qwer', 'qwer')
+    pages = list(dm.retrieve_pages(limit=1))
+
+    assert len(pages) == 2
+    assert len(pages[0]) == 1
+    assert pages[0][0].sender == 'asdf'
+    assert pages[0][0].message == 'Test2'
+    assert pages[1][0].recipient == 'asdf'
+    assert pages[1][0].message == 'Test'
+    assert [msg.message for msg in next(dm.retrieve_pages())] == ['Test',
+                                                                 'Test2']
+
+
 def test_retrieve_all_error():
     '''
     Tests retrieve_all with an invalid call
@@ -144,3 +202,242 @@ def test_retrieve_new_error():
     msgs2 = dm2.retrieve_new()
     assert msgs1 == 'Invalid user token.'
     assert msgs2 == 'Invalid user token.'
+
+
+def test_send_many():
+    '''
+    Tests send_many with valid and invalid recipients
+    '''
+    dm = DirectMessenger('127.0.0.1', 'zxcv', 'zxcv')
+    dm2 = DirectMessenger('127.0.0.1', 'uiop', 'uiop')
+    msgs = [('uiop', f'Bulk{i}') for i in range(300)]
+    msgs.insert(5, ('uiopqwer', 'FailTest'))
+
+    results = dm.send_many(msgs)
+    assert len(results) == 301
+    assert results[5] is False
+    assert results.count(True) == 300
+    received = dm2.retrieve_new()
+    assert [msg.message for msg in received] == [f'Bulk{i}'
+                                                 for i in range(300)]
+
+    dm.capabilities = set()
+    assert dm.send_many([('uiop', 'Single')]) == [True]
+
+
+def test_subscribe():
+    '''
+    Tests that subscribed clients get new messages pushed to them
+    '''
+    dm = DirectMessenger('127.0.0.1', 'zxcv', 'zxcv')
+    dm2 = DirectMessenger('127.0.0.1', 'uiop', 'uiop')
+    pushed = queue.Queue()
+    dm2.retrieve_new()
+    dm.send('Waiting', 'uiop')
+    assert dm2.subscribe(pushed.put) is True
+    assert [msg.message for msg in pushed.get(timeout=2)] == ['Waiting']
+
+    assert dm.send('Pushed', 'uiop') is True
+    msgs = pushed.get(timeout=2)
+    assert len(msgs) == 1
+    assert msgs[0].sender == 'zxcv'
+    assert msgs[0].message == 'Pushed'
+    # Pushed messages stay new until a request returns them
+    assert [msg.message for msg in dm2.retrieve_new()] == ['Pushed']
+    assert dm2.send('Reply', 'zxcv') is True
+
+
+def test_reconnect():
+    '''
+    Tests that a dropped connection is reopened, resuming the session, and
+    that pushes keep arriving after it
+    '''
+    dm = DirectMessenger('127.0.0.1', 'zxcv', 'zxcv')
+    dm2 = DirectMessenger('127.0.0.1:3001', 'uiop', 'uiop')
+    pushed = queue.Queue()
+    dm2.retrieve_new()
+    assert dm2.subscribe(pushed.put) is True
+    token = dm.token
+    dm._conn.close()
+    dm2._conn.close()
+    time.sleep(0.5)
+
+    assert dm.send('Reconnected', 'uiop') is True
+    assert dm.token == token
+    assert [msg.message for msg in pushed.get(timeout=2)] == ['Reconnected']
+
+    # Subscribing again returns the message pushed before, still new, but
+    # the callback only gets the new one
+    dm2._conn.close()
+    time.sleep(0.5)
+    assert dm.send('Again', 'uiop') is True
+    assert [msg.message for msg in pushed.get(timeout=2)] == ['Again']
+    assert pushed.empty()
+    dm.close()
+    dm2.close()
+
+
+def test_async_messenger():
+    '''
+    Tests driving many accounts concurrently with AsyncDirectMessenger
+    '''
+    async def run():
+        receiver = await AsyncDirectMessenger.connect('127.0.0.1',
+                                                      'hjkl', 'hjkl')
+        await receiver.retrieve_new()
+        senders = await asyncio.gather(*[
+            AsyncDirectMessenger.connect('127.0.0.1', f'async{i}', 'pwd')
+            for i in range(200)])
+        results = await asyncio.gather(*[
+            sender.send(f'Async{i}', 'hjkl')
+            for i, sender in enumerate(senders)])
+        assert results == [True] * 200
+        assert await senders[0].send('FailTest', 'hjklqwer') is False
+        received = await receiver.retrieve_new()
+        assert sorted(msg.message for msg in received) == \
+            sorted(f'Async{i}' for i in range(200))
+        assert isinstance(await receiver.retrieve_all(), list)
+        await asyncio.gather(receiver.close(),
+                             *[sender.close() for sender in senders])
+
+    asyncio.run(run())
+
+
+def _fake_server(frames):
+    '''
+    Starts a server that writes frames to its client, then answers each
+    request line with the next frame. Returns the server and an
+    AsyncDirectMessenger connected to it.
+    '''
+    async def answer(reader, writer):
+        frames_left = list(frames)
+        writer.write(frames_left.pop(0))
+        while frames_left and await reader.readline():
+            writer.write(frames_left.pop(0))
+        await writer.drain()
+
+    async def start():
+        server = await asyncio.start_server(answer, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(
+            *server.sockets[0].getsockname())
+        return server, AsyncDirectMessenger(reader, writer)
+    return start()
+
+
+def test_async_unsolicited_frames():
+    '''
+    Tests that AsyncDirectMessenger ignores a response nobody asked for and
+    a push before subscribing
+    '''
+    ok = b'{"response": {"type": "ok", "message": ""}}\r\n'
+    push = b'{"response": {"type": "push", "messages": []}}\r\n'
+
+    async def run():
+        server, adm = await _fake_server([ok + push, ok])
+        recv = await asyncio.wait_for(adm._request(b'{}\r\n'), 5)
+        assert recv.msg_type == 'ok'
+        await adm.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_async_bad_frame():
+    '''
+    Tests that the requests waiting when AsyncDirectMessenger reads a frame
+    it can't parse fail with the parsing error
+    '''
+    async def run():
+        server, adm = await _fake_server([b'', b'not json\r\n'])
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(adm._request(b'{}\r\n'), 5)
+        await adm.close()
+        server.close()
+
+    asyncio.run(run())
+
+
+def test_binary_messenger():
+    '''
+    Tests that clients asking for binary responses get the same results,
+    including pushes and after reconnecting
+    '''
+    dm = DirectMessenger('127.0.0.1', 'vbnm', 'vbnm', binary=True)
+    dm2 = DirectMessenger('127.0.0.1', 'nmvb', 'nmvb', binary=True)
+    assert 'binary' in dm.capabilities
+    pushed = queue.Queue()
+    dm2.retrieve_new()
+    assert dm2.subscribe(pushed.put) is True
+    assert dm.send_message('Binary', 'nmvb').message == 'Binary'
+    assert [msg.message for msg in pushed.get(timeout=2)] == ['Binary']
+    dm._conn.close()
+    time.sleep(0.5)
+
+    assert dm.send('Resumed', 'nmvb') is True
+    assert [msg.message for msg in pushed.get(timeout=2)] == ['Resumed']
+    assert [msg.message for msg in dm.retrieve_all()] == ['Binary',
+                                                          'Resumed']
+
+    async def run():
+        adm = await AsyncDirectMessenger.connect('127.0.0.1', 'nmvb',
+                                                 'nmvb', binary=True)
+        assert [msg.message for msg in await adm.retrieve_all()] == \
+            ['Binary', 'Resumed']
+        await adm.close()
+
+    asyncio.run(run())
+    dm.close()
+    dm2.close()
+
+
+def test_compressed_messenger():
+    '''
+    Tests that large compressed responses are decompressed, in JSON and
+    binary, and that small ones are not compressed
+    '''
+    dm = DirectMessenger('127.0.0.1', 'wxyz', 'wxyz', compress=True)
+    dm2 = DirectMessenger('127.0.0.1', 'zyxw', 'zyxw', binary=True,
+                          compress=True)
+    assert 'compression' in dm.capabilities
+    assert dm.send_many([('zyxw', f'Compressed{i}')
+                         for i in range(500)]) == [True] * 500
+    assert [msg.message for msg in dm.retrieve_all()] == \
+        [f'Compressed{i}' for i in range(500)]
+    assert [msg.message for msg in dm2.retrieve_new()] == \
+        [f'Compressed{i}' for i in range(500)]
+    for request, marker in (('all', ds_protocol.COMPRESSED_FRAME),
+                            ('new', ord('{'))):
+        dm._conn.send(ds_protocol.encode_json_bytes(
+            'directmessage', message=request, token=dm.token))
+        assert dm._conn.read_frame()[0] == marker
+    dm.close()
+    dm2.close()
+
+
+def test_iter_all():
+    '''
+    Tests streaming the history, in JSON and compressed, and that a stream
+    abandoned halfway leaves the connection usable
+    '''
+    dm = DirectMessenger('127.0.0.1', 'strm', 'strm')
+    dm2 = DirectMessenger('127.0.0.1', 'mrts', 'mrts', compress=True)
+    sent = [f'Streamed{i}' for i in range(500)]
+    assert dm.send_many([('mrts', message) for message in sent]) == \
+        [True] * 500
+    for messenger in (dm, dm2):
+        streamed = messenger.iter_all()
+        assert next(streamed).message == 'Streamed0'
+        streamed.close()
+        history = list(messenger.iter_all())
+        assert [msg.message for msg in history] == sent
+        assert [msg.message for msg in
+                messenger.iter_since(history[-2].id)] == ['Streamed499']
+        assert messenger.cursor == history[-1].id
+    dm.token = 'invalid'
+    try:
+        list(dm.iter_all())
+        assert False
+    except ValueError as ex:
+        assert str(ex) == 'Invalid user token.'
+    dm.close()
+    dm2.close()
@@ -1,7 +1,11 @@
 """Test cases for the ds_protocol module."""
+import sys
 import json
 import pytest
-from ds_protocol import encode_json, DataTuple, extract_json
+from ds_protocol import encode_json, DataTuple, extract_json, \
+    DirectMessage, encode_json_bytes, encode_response_bytes, \
+    parse_response_bytes, encode_binary_response, find_frame, pack, \
+    unpack, compress_frame, MessageStream
 
 
 def test_encode_join():
@@ -17,6 +21,12 @@ def test_encode_join():
                        password=pwd) == json_msg
 
 
+def test_encode_resume():
+    """Test encoding a resume message."""
+    json_msg = json.dumps({"resume": {"token": "12345"}})
+    assert encode_json(msg_type='resume', token='12345') == json_msg
+
+
 @pytest.mark.xfail
 def test_encode_join_fail():
     """Test encoding a join message with empty username, expecting failure."""
@@ -138,6 +148,44 @@ def test_directmessage_all():
                        token=token) == json_msg
 
 
+def test_directmessage_since():
+    """Test encoding a request for the direct messages after a cursor."""
+    token = 'user_token'
+    msg_type = 'directmessage'
+    json_msg = json.dumps({"token": token,
+                           msg_type: {"since": 12}})
+    assert encode_json(msg_type=msg_type,
+                       message='since',
+                       cursor=12,
+                       token=token) == json_msg
+
+
+def test_directmessage_all_page():
+    """Test encoding a request for one page of direct messages."""
+    token = 'user_token'
+    msg_type = 'directmessage'
+    json_msg = json.dumps({"token": token,
+                           msg_type: {"all": {"limit": 50,
+                                              "before": 120}}})
+    assert encode_json(msg_type=msg_type,
+                       message='all',
+                       limit=50,
+                       before=120,
+                       token=token) == json_msg
+
+
+def test_directmessage_subscribe():
+    """Test encoding a request to have new direct messages pushed."""
+    token = 'user_token'
+    msg_type = 'directmessage'
+    entry = 'subscribe'
+    json_msg = json.dumps({"token": token,
+                           msg_type: entry})
+    assert encode_json(msg_type=msg_type,
+                       message=entry,
+                       token=token) == json_msg
+
+
 @pytest.mark.xfail
 def test_encode_fail():
     """Test encoding with invalid message type, expecting failure."""
@@ -180,6 +228,15 @@ def test_extract_join_ok():
     assert extract_json(string) == DataTuple('ok', '', 'user_token')
 
 
+def test_extract_join_capabilities():
+    """Test extracting the capabilities advertised in a join response."""
+    string = json.dumps({"response": {"type": "ok",
+                                      "message": "", "token": "user_token",
+                                      "capabilities": ["pipelining"]}})
+    assert extract_json(string) == DataTuple('ok', '', 'user_token',
+                                             capabilities=['pipelining'])
+
+
 def test_extract_directmessage_send():
     """Test extracting a direct message sent confirmation."""
     string = json.dumps({"response": {"type": "ok",
@@ -187,6 +244,17 @@ def test_extract_directmessage_send():
     assert extract_json(string) == DataTuple('ok', 'Direct message sent', '')
 
 
+def test_extract_directmessage_send_record():
+    """Test extracting the stored message of a direct message sent."""
+    record = {"recipient": "ohhimark", "message": "Hello",
+              "timestamp": "1603167689.3928561", "id": 7}
+    string = json.dumps({"response": {"type": "ok",
+                                      "message": "Direct message sent",
+                                      "record": record}})
+    assert extract_json(string) == DataTuple('ok', 'Direct message sent', '',
+                                             record=record)
+
+
 def test_extract_directmessage_new():
     """Test extracting new direct messages."""
     messages = [{"message": "Are you there?!",
@@ -213,6 +281,31 @@ def test_extract_directmessage_all():
     assert extract_json(string) == DataTuple('ok', messages, '')
 
 
+def test_extract_directmessage_since():
+    """Test extracting the direct messages after a cursor."""
+    messages = [{"message": "Are you there?!",
+                 "from": "markb",
+                 "timestamp": "1603167689.3928561",
+                 "id": 13},
+                {"message": "Yeah I just went to grab some water! Jesus!",
+                 "recipient": "markb",
+                 "timestamp": "1603167699.3928561",
+                 "id": 14}]
+    string = json.dumps({"response": {"type": "ok", "messages": messages,
+                                      "cursor": 14}})
+    assert extract_json(string) == DataTuple('ok', messages, '', 14)
+
+
+def test_extract_directmessage_push():
+    """Test extracting direct messages pushed by the server."""
+    messages = [{"message": "Are you there?!",
+                 "from": "markb",
+                 "timestamp": "1603167689.3928561",
+                 "id": 13}]
+    string = json.dumps({"response": {"type": "push", "messages": messages}})
+    assert extract_json(string) == DataTuple('push', messages, '')
+
+
 @pytest.mark.xfail
 def test_extract_notjson():
     """Test extracting from non-JSON input, expecting failure."""
@@ -236,3 +329,140 @@ def test_extract_fail_nomessage():
     string = json.dumps({"response": {"type": "ok",
                                       "messager": "hi"}})
     assert extract_json(string) is False
+
+
+def test_direct_message_from_dict():
+    """Test converting a message dictionary to a DirectMessage."""
+    line = {"from": "mark" + "b", "message": "Hello",
+            "timestamp": "1603167689.3928561", "id": 3}
+    msg = DirectMessage.from_dict(line)
+    assert msg.sender is sys.intern("markb")
+    assert msg.recipient is None
+    assert msg.to_dict() == line
+    assert msg == DirectMessage.from_dict(dict(line))
+    assert len({msg, DirectMessage.from_dict(dict(line))}) == 1
+
+
+def test_encode_json_bytes():
+    """Test that bytes frames match the encoded json messages."""
+    requests = [('join', {'username': 'ohhimark', 'password': 'pwd'}),
+                ('directmessage', {'token': 'tok\u00e9', 'message': 'Hi\n',
+                                   'username': 'markb',
+                                   'timestamp': 1603167689.3928561}),
+                ('directmessage', {'token': 'tok', 'message': 'new'}),
+                ('directmessage', {'token': 'tok', 'message': 'all',
+                                   'limit': 50}),
+                ('directmessage', {'token': 'tok', 'message': 'subscribe'})]
+    for msg_type, fields in requests:
+        assert encode_json_bytes(msg_type, **fields) == \
+            encode_json(msg_type, **fields).encode() + b'\r\n'
+
+
+def test_encode_response_bytes():
+    """Test that bytes responses match the dumped json responses."""
+    responses = [('error', {'message': 'Invalid user token.'}),
+                 ('ok', {'message': 'Welcome', 'token': 'tok',
+                         'capabilities': ['push']}),
+                 ('ok', {'messages': [{'message': 'Hi', 'id': 1}],
+                         'cursor': 1})]
+    for msg_type, fields in responses:
+        response = {"response": {"type": msg_type, **fields}}
+        assert encode_response_bytes(msg_type, **fields) == \
+            json.dumps(response).encode() + b'\r\n'
+
+
+def test_parse_response_bytes():
+    """Test parsing a response frame without decoding it."""
+    frame = encode_response_bytes('ok', message='Welcome', token='tok')
+    assert parse_response_bytes(frame) == DataTuple('ok', 'Welcome', 'tok')
+    with pytest.raises(ValueError):
+        parse_response_bytes(b'this is not json\r\n')
+
+
+def test_pack_unpack():
+    """Test that packed objects unpack to the same objects."""
+    objs = [None, True, False, 0, 127, 128, -32, -33, 65536, 2 ** 64 - 1,
+            -2 ** 63, 1.5, "", "a" * 31, "\u00e9" * 200, "x" * 70000,
+            list(range(20)), {str(i): i for i in range(20)},
+            {"messages": [{"from": "markb", "message": "Hi", "id": 3}]}]
+    for obj in objs:
+        assert unpack(pack(obj)) == obj
+    assert pack({"a": [1, "b"]}) == b"\x81\xa1a\x92\x01\xa1b"
+
+
+def test_pack_table():
+    """Test that long lists of dictionaries unpack to the same lists."""
+    messages = [{"message": f"Hi \u00e9 {i}", "timestamp": str(i / 7),
+                 "id": i, ("from" if i % 3 else "recipient"): "markb"}
+                for i in range(40)]
+    data = pack(messages)
+    assert data[0] == 0xc8
+    assert len(data) < len(pack(messages[:15])) * 40 / 15
+    assert unpack(data) == messages
+    tables = [[{"message": "a\x00b" if i == 5 else "", "id": 2 ** 63 + i,
+                "read": i % 2 == 0, "extra": [i]} for i in range(20)],
+              [{"id": i} for i in range(300)] * 2,
+              [{str(i): i} for i in range(300)],
+              [{}] * 20]
+    for table in tables:
+        assert unpack(pack(table)) == table
+
+
+def test_unpack_invalid():
+    """Test that invalid or truncated binary data is rejected."""
+    data = pack({"message": "Hello", "id": 300})
+    for bad in [data[:-1], data[:4], data + b"\x00", b"\xc1"]:
+        with pytest.raises(ValueError):
+            unpack(bad)
+    data = pack([{"message": "Hello", "id": i} for i in range(20)])
+    for bad in [data[:-1], data.replace(b"Hello", b"Hell\x00"),
+                data.replace(b"\x01\x93\x14", b"\x01\x93\x15"),
+                data.replace(b"\xa1s", b"\xa1x")]:
+        with pytest.raises(ValueError):
+            unpack(bad)
+
+
+def test_binary_response():
+    """Test finding and parsing a binary response frame."""
+    messages = [{"from": "markb", "message": "Hi", "id": 3}]
+    frame = encode_binary_response('ok', messages=messages, cursor=3)
+    assert find_frame(frame[:-1]) is None
+    assert find_frame(frame + b'{"response"') == (len(frame), len(frame))
+    assert parse_response_bytes(frame) == \
+        DataTuple('ok', messages, '', cursor=3)
+    assert find_frame(b'{"response": {}}\r\n') == (16, 18)
+
+
+def test_compressed_response():
+    """Test parsing compressed JSON and binary response frames."""
+    messages = [{"from": "markb", "message": "Hi", "id": i}
+                for i in range(100)]
+    for encode in (encode_response_bytes, encode_binary_response):
+        frame = compress_frame(encode('ok', messages=messages))
+        assert find_frame(frame) == (len(frame), len(frame))
+        assert parse_response_bytes(frame) == DataTuple('ok', messages, '')
+    with pytest.raises(ValueError):
+        parse_response_bytes(frame[:-4])
+
+
+def test_message_stream():
+    """Test parsing the messages of a response fed in small chunks."""
+    messages = [{"from": "markb", "message": f"Hi \u00e9 ] {i}", "id": i}
+                for i in range(50)]
+    for frame in (encode_response_bytes('ok', messages=messages, cursor=49),
+                  encode_binary_response('ok', messages=messages, cursor=49)):
+        stream = MessageStream()
+        parsed = []
+        for i in range(0, len(frame), 7):
+            parsed += stream.feed(frame[i:i + 7])
+        parsed += stream.feed(b'', final=True)
+        assert parsed == messages
+        assert stream.response == DataTuple('ok', [], '', cursor=49)
+
+    stream = MessageStream()
+    assert stream.feed(encode_response_bytes('error', message='Bad'),
+                       final=True) == []
+    assert stream.response == DataTuple('error', 'Bad', '')
+    with pytest.raises(ValueError):
+        MessageStream().feed(b'{"response": {"type": "ok", "messages": [{',
+                             final=True)
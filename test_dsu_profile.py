@@ -0,0 +1,223 @@
+'''
+Testing module for dsu_profile
+'''
+
+
+import json
+import time
+import dsu_profile
+from dsu_profile import Profile
+
+
+def test_journal_replay(tmp_path):
+    '''
+    Tests that changes saved after the snapshot are appended to the journal
+    and replayed by load_profile
+    '''
+    path = tmp_path / 'asdf.dsu'
+    profile = Profile('127.0.0.1', 'asdf', 'asdf')
+    profile.save_profile(path)
+    snapshot = path.read_text()
+
+    profile.save_messages([{'from': 'qwer', 'message': 'Hi',
+                            'timestamp': '1', 'id': 1}])
+    profile.save_friends('zxcv')
+    profile.sync_cursor = 1
+    profile.save_profile(path)
+    assert path.read_text() == snapshot
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.username == 'asdf'
+    assert loaded.get_messages() == profile.get_messages()
+    assert loaded.get_friends() == ['qwer', 'zxcv']
+    assert loaded.sync_cursor == 1
+
+
+def test_journal_compaction(tmp_path, monkeypatch):
+    '''
+    Tests that a full journal is folded into the snapshot, and that a journal
+    left over from an older snapshot isn't replayed
+    '''
+    monkeypatch.setattr(dsu_profile, 'JOURNAL_COMPACT_THRESHOLD', 3)
+    path = tmp_path / 'asdf.dsu'
+    profile = Profile('127.0.0.1', 'asdf', 'asdf')
+    profile.save_profile(path)
+    journal = tmp_path / 'asdf.dsu.journal'
+    old_journal = journal.read_text()
+    for i in range(4):
+        profile.save_messages([{'recipient': 'qwer', 'message': str(i),
+                                'timestamp': str(i), 'id': i}])
+        profile.save_profile(path)
+    assert len(json.loads(path.read_text())['_messages']) == 3
+
+    journal.write_text(old_journal + json.dumps({'friend': 'zxcv'}) + '\n')
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert len(loaded.get_messages()) == 3
+    assert loaded.get_friends() == ['qwer']
+
+
+def test_load_single_json(tmp_path):
+    '''
+    Tests loading a DSU file saved without a journal, and saving again
+    after loading a journal cut short while saving
+    '''
+    path = tmp_path / 'asdf.dsu'
+    path.write_text(json.dumps({'dsuserver': '127.0.0.1',
+                                'username': 'asdf',
+                                'password': 'asdf',
+                                '_friends': ['qwer'],
+                                '_messages': [{'from': 'qwer',
+                                               'message': 'Hi',
+                                               'timestamp': '1'}]}))
+    profile = Profile()
+    profile.load_profile(path)
+    assert profile.get_friends() == ['qwer']
+    profile.save_friends('zxcv')
+    profile.save_profile(path)
+    with open(tmp_path / 'asdf.dsu.journal', 'a', encoding='utf-8') as f:
+        f.write('{"friend": "ty')
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.get_friends() == ['qwer', 'zxcv']
+    assert len(loaded.get_messages()) == 1
+
+    loaded.save_friends('ty')
+    loaded.save_profile(path)
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert reloaded.get_friends() == ['qwer', 'zxcv', 'ty']
+    assert len(reloaded.get_messages()) == 1
+
+
+def test_write_behind(tmp_path):
+    '''
+    Tests that saves in write-behind mode are coalesced into one write by
+    the background thread or by flush
+    '''
+    path = tmp_path / 'asdf.dsu'
+    journal = tmp_path / 'asdf.dsu.journal'
+    profile = Profile('127.0.0.1', 'asdf', 'asdf')
+    profile.save_profile(path)
+    profile.start_write_behind(interval=60)
+    for i in range(3):
+        profile.save_friends(f'friend{i}')
+        profile.save_profile(path)
+    assert len(journal.read_text().splitlines()) == 1
+    profile.flush()
+    assert len(journal.read_text().splitlines()) == 4
+
+    profile.start_write_behind(interval=0.01)
+    profile.save_friends('qwer')
+    profile.save_profile(path)
+    deadline = time.monotonic() + 10
+    while len(journal.read_text().splitlines()) < 5 and \
+            time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(journal.read_text().splitlines()) == 5
+    profile.stop_write_behind()
+    profile.save_friends('zxcv')
+    profile.save_profile(path)
+    assert len(journal.read_text().splitlines()) == 6
+
+
+def test_get_conversation(tmp_path):
+    '''
+    Tests that messages are indexed by contact as they are saved and loaded
+    '''
+    path = tmp_path / 'asdf.dsu'
+    profile = Profile('127.0.0.1', 'asdf', 'asdf')
+    profile.save_messages([{'from': 'qwer', 'message': 'Hi',
+                            'timestamp': '1'},
+                           {'recipient': 'zxcv', 'message': 'Hey',
+                            'timestamp': '2'},
+                           {'recipient': 'qwer', 'message': 'Hello',
+                            'timestamp': '3'}])
+    profile.save_friends('qwer')
+    profile.save_profile(path)
+    assert [msg.message for msg in profile.get_conversation('qwer')] == \
+        ['Hi', 'Hello']
+    assert profile.get_conversation('uiop') == []
+    assert profile.get_friends() == ['qwer', 'zxcv']
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.get_conversation('zxcv') == \
+        profile.get_conversation('zxcv')
+    loaded.overwrite_messages([{'from': 'zxcv', 'message': 'New',
+                                'timestamp': '4'}])
+    assert loaded.get_conversation('qwer') == []
+    assert len(loaded.get_conversation('zxcv')) == 1
+
+
+def test_lazy_load(tmp_path):
+    '''
+    Tests that a lazily loaded profile reads conversations on demand, and
+    keeps the ones it never read when it is compacted
+    '''
+    path = tmp_path / 'asdf.dsu'
+    profile = Profile('127.0.0.1', 'asdf', 'asdf')
+    for i in range(30):
+        profile.save_messages([{'from': f'contact{i % 3}',
+                                'message': f'Hi {i}',
+                                'timestamp': str(i), 'id': i}])
+    profile.save_profile(path)
+    profile.save_messages([{'recipient': 'contact1', 'message': 'Journal',
+                            'timestamp': '30', 'id': 30}])
+    profile.save_profile(path)
+
+    loaded = Profile()
+    loaded.load_profile(path, lazy=True)
+    assert loaded.get_friends() == ['contact0', 'contact1', 'contact2']
+    assert loaded.get_conversation('contact1') == \
+        profile.get_conversation('contact1')
+    loaded.save_messages([{'from': 'contact2', 'message': 'Hi 2',
+                           'timestamp': '2', 'id': 2}])
+    assert len(loaded.get_conversation('contact2')) == 10
+    loaded.compact()
+
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    for contact in loaded.get_friends():
+        assert reloaded.get_conversation(contact) == \
+            profile.get_conversation(contact)
+
+    # A snapshot written without the index is loaded in full
+    path.write_text(path.read_text() + ' ')
+    stale = Profile()
+    stale.load_profile(path, lazy=True)
+    assert len(stale.get_conversation('contact0')) == 10
+
+
+def test_overwrite_from_generator(tmp_path):
+    '''
+    Tests overwriting messages from a generator, and that the saved
+    messages are kept if it fails
+    '''
+    path = tmp_path / 'asdf.dsu'
+    profile = Profile('127.0.0.1', 'asdf', 'asdf')
+    profile.save_messages([{'from': 'qwer', 'message': 'Old',
+                            'timestamp': '1', 'id': 1}])
+
+    def history(fail):
+        for i in range(3):
+            yield {'from': 'zxcv', 'message': f'New{i}',
+                   'timestamp': str(i), 'id': i + 1}
+        if fail:
+            raise ConnectionError('Connection dropped')
+
+    try:
+        profile.overwrite_messages(history(True))
+        assert False
+    except ConnectionError:
+        pass
+    assert [msg.message for msg in profile.get_messages()] == ['Old']
+    profile.overwrite_messages(history(False))
+    profile.save_profile(path)
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert [msg.message for msg in loaded.get_messages()] == \
+        ['New0', 'New1', 'New2']
+    assert loaded.get_friends() == ['qwer', 'zxcv']
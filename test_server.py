@@ -0,0 +1,752 @@
+'''
+Testing module for server
+'''
+
+
+import sys
+import json
+import time
+import types
+import socket
+import struct
+import threading
+
+try:
+    import flask
+except ImportError:
+    # The server also serves a flask frontend, which these tests don't use
+    flask = types.ModuleType('flask')
+
+    class _Flask:
+        '''
+        Stand-in for flask.Flask that ignores the routes
+        '''
+        def __init__(self, name):
+            self.name = name
+            self.config = {}
+
+        def route(self, rule):
+            '''
+            Returns the view unchanged
+            '''
+            return lambda view: view
+
+    flask.Flask = _Flask
+    flask.render_template = flask.redirect = flask.url_for = None
+    sys.modules['flask'] = flask
+
+import server
+
+
+def _connect(dsu_server):
+    '''
+    Returns a socket connected to a thread running handle_client on
+    dsu_server, and the thread
+    '''
+    client, server_side = socket.socketpair()
+    handler = threading.Thread(target=dsu_server.handle_client,
+                               args=(server_side, 'test'), daemon=True)
+    handler.start()
+    return client, handler
+
+
+def _read_lines(client, count):
+    '''
+    Returns the next count response lines sent on client
+    '''
+    data = b''
+    while data.count(b'\r\n') < count:
+        received = client.recv(65536)
+        assert received, 'connection closed'
+        data += received
+    return [json.loads(line)['response']
+            for line in data.split(b'\r\n')[:count]]
+
+
+def _wal_server(tmp_path):
+    '''
+    Returns a DSUServer using a write-ahead log store in tmp_path
+    '''
+    store = server.WalUserStore(tmp_path / 'store')
+    store.open()
+    return server.DSUServer(store=store)
+
+
+JOIN = b'{"join": {"username": "qwer", "password": "qwer", "token": ""}}'
+
+
+def test_wal_replay(tmp_path):
+    '''
+    Tests that the write-ahead log of a store that wasn't closed is
+    replayed when the store is opened again
+    '''
+    store = server.WalUserStore(tmp_path / 'store')
+    store.open()
+    store.get_or_create_user('qwer', 'qwer')
+    store.get_or_create_user('asdf', 'asdf')
+    store.update_bio('qwer', 'Bio', '1')
+    store.create_post('qwer', 'Post', '2')
+    store.send_message('Hi', 'qwer', 'asdf', '3')
+
+    reopened = server.WalUserStore(tmp_path / 'store')
+    reopened.open()
+    assert reopened.get_user('qwer')['bio'] == {'entry': 'Bio',
+                                                'timestamp': '1'}
+    assert len(reopened.get_posts()) == 1
+    assert reopened.read_new_messages('asdf') == [
+        {'from': 'qwer', 'message': 'Hi', 'timestamp': '3', 'id': 1}]
+    assert reopened.read_new_messages('asdf') == []
+    reopened.close()
+
+
+def test_wal_replay_idempotent(tmp_path):
+    '''
+    Tests that records of the log already folded into the snapshot aren't
+    applied twice, as after a crash between writing the snapshot and
+    truncating the log
+    '''
+    store = server.WalUserStore(tmp_path / 'store')
+    store.open()
+    store.get_or_create_user('qwer', 'qwer')
+    store.get_or_create_user('asdf', 'asdf')
+    store.create_post('qwer', 'Post', '1')
+    store.send_message('Hi', 'qwer', 'asdf', '2')
+    store.read_new_messages('asdf')
+    log = store.wal_path.read_text()
+    store.close()
+    store.wal_path.write_text(log)
+
+    reopened = server.WalUserStore(tmp_path / 'store')
+    reopened.open()
+    assert len(reopened.get_posts()) == 1
+    assert len(reopened.get_user('qwer')['posts']) == 1
+    assert len(reopened.read_all_messages('qwer')) == 1
+    assert len(reopened.read_all_messages('asdf')) == 1
+    assert reopened.read_new_messages('asdf') == []
+    reopened.close()
+
+
+def test_wal_replay_self_message(tmp_path):
+    '''
+    Tests that both copies of a message a user sent to themselves are
+    replayed, the received one still new
+    '''
+    store = server.WalUserStore(tmp_path / 'store')
+    store.open()
+    store.get_or_create_user('qwer', 'qwer')
+    store.send_message('Note', 'qwer', 'qwer', '1')
+
+    reopened = server.WalUserStore(tmp_path / 'store')
+    reopened.open()
+    assert reopened.read_new_messages('qwer') == [
+        {'from': 'qwer', 'message': 'Note', 'timestamp': '1', 'id': 2}]
+    assert reopened.read_all_messages('qwer') == [
+        {'recipient': 'qwer', 'message': 'Note', 'timestamp': '1', 'id': 1},
+        {'from': 'qwer', 'message': 'Note', 'timestamp': '1', 'id': 2}]
+    reopened.close()
+
+
+def test_sharded_case(tmp_path):
+    '''
+    Tests that usernames differing only in case get shards whose names
+    differ in more than case, and that shards named the old way are renamed
+    '''
+    store = server.ShardedUserStore(tmp_path / 'store')
+    store.open()
+    store.get_or_create_user('Bob', 'upper')
+    store.get_or_create_user('bob', 'lower')
+    upper, lower = store._shard_path('Bob'), store._shard_path('bob')
+    assert upper.name.lower() != lower.name.lower()
+    assert store.get_user('Bob')['password'] == 'upper'
+
+    upper.rename(upper.with_name('Bob.json'))
+    reopened = server.ShardedUserStore(tmp_path / 'store')
+    reopened.open()
+    assert upper.exists()
+    assert reopened.get_user('Bob')['password'] == 'upper'
+    assert reopened.get_user('bob')['password'] == 'lower'
+
+
+def test_sharded_migrate(tmp_path):
+    '''
+    Tests that a single-file store, with a log that wasn't folded in yet,
+    is split into shards
+    '''
+    store = server.WalUserStore(tmp_path / 'store')
+    store.open()
+    store.get_or_create_user('qwer', 'qwer')
+    store.get_or_create_user('asdf', 'asdf')
+    store.close()
+    store.open()
+    store.send_message('Hi', 'qwer', 'asdf', '1')
+
+    sharded = server.ShardedUserStore(tmp_path / 'store')
+    sharded.open()
+    assert (tmp_path / 'store' / 'users.json.migrated').exists()
+    assert not store.wal_path.exists()
+    assert sharded.get_user('qwer')['password'] == 'qwer'
+    assert sharded.read_new_messages('asdf') == [
+        {'from': 'qwer', 'message': 'Hi', 'timestamp': '1', 'id': 1}]
+
+    reopened = server.ShardedUserStore(tmp_path / 'store')
+    reopened.open()
+    assert reopened.read_new_messages('asdf') == []
+    assert len(reopened.read_all_messages('qwer')) == 1
+
+
+def test_sqlite_import(tmp_path):
+    '''
+    Tests that opening an empty database imports the single-file store,
+    with the status of each message
+    '''
+    store = server.WalUserStore(tmp_path / 'store')
+    store.open()
+    store.get_or_create_user('qwer', 'qwer')
+    store.get_or_create_user('asdf', 'asdf')
+    store.update_bio('qwer', 'Bio', '1')
+    store.create_post('qwer', 'First', '2')
+    store.create_post('qwer', 'Second', '3')
+    store.send_message('Read', 'qwer', 'asdf', '4')
+    store.read_new_messages('asdf')
+    store.send_message('New', 'asdf', 'qwer', '5')
+
+    sqlite = server.SqliteUserStore(tmp_path / 'store')
+    sqlite.open()
+    assert sqlite.get_user('qwer')['bio'] == {'entry': 'Bio',
+                                              'timestamp': '1'}
+    assert [post['entry'] for post in sqlite.get_posts()] == ['Second',
+                                                              'First']
+    assert sqlite.read_new_messages('asdf') == []
+    assert sqlite.read_new_messages('qwer') == [
+        {'from': 'asdf', 'message': 'New', 'timestamp': '5', 'id': 2}]
+    assert [msg['message'] for msg in sqlite.read_all_messages('asdf')] \
+        == ['Read', 'New']
+    sqlite.close()
+
+
+def test_sqlite_release(tmp_path):
+    '''
+    Tests that the connection of a client thread is closed when the client
+    disconnects
+    '''
+    store = server.SqliteUserStore(tmp_path / 'store')
+    store.open()
+    dsu_server = server.DSUServer(store=store)
+    for _ in range(20):
+        client, handler = _connect(dsu_server)
+        client.sendall(JOIN + b'\r\n')
+        assert _read_lines(client, 1)[0]['type'] == 'ok'
+        client.close()
+        handler.join()
+    assert len(store._connections) == 1
+    store.close()
+
+
+def test_request_split(tmp_path):
+    '''
+    Tests that a request arriving over several reads, split inside its
+    CRLF too, is answered once it is complete
+    '''
+    client, _ = _connect(_wal_server(tmp_path))
+    for piece in (JOIN[:10], JOIN[10:], b'\r'):
+        client.sendall(piece)
+        time.sleep(0.05)
+    client.sendall(b'\n')
+    assert _read_lines(client, 1)[0]['type'] == 'ok'
+    client.close()
+
+
+def test_pipelined_requests(tmp_path):
+    '''
+    Tests that several requests sent in one write are all answered, in order
+    '''
+    client, _ = _connect(_wal_server(tmp_path))
+    client.sendall(JOIN + b'\r\n' + b'not json\r\n\r\n' + JOIN + b'\r\n')
+    first, second, third = _read_lines(client, 3)
+    assert first['type'] == 'ok'
+    assert second['message'] == 'Incorrectly formatted JSON message.'
+    assert third['message'] == 'User already joined on the active session.'
+    client.close()
+
+
+def test_request_without_crlf(tmp_path):
+    '''
+    Tests that a last request sent without its CRLF before the client closes
+    its side is still answered
+    '''
+    client, handler = _connect(_wal_server(tmp_path))
+    client.sendall(JOIN)
+    client.shutdown(socket.SHUT_WR)
+    assert _read_lines(client, 1)[0]['type'] == 'ok'
+    handler.join()
+    client.close()
+
+
+def test_request_too_large(tmp_path, monkeypatch):
+    '''
+    Tests that a request longer than MAX_REQUEST_SIZE is rejected and the
+    connection closed
+    '''
+    monkeypatch.setattr(server, 'MAX_REQUEST_SIZE', 64)
+    client, handler = _connect(_wal_server(tmp_path))
+    client.sendall(b'x' * 100)
+    assert _read_lines(client, 1)[0]['message'] == 'Request too large.'
+    handler.join()
+    assert client.recv(1024) == b''
+    client.close()
+
+
+def test_resume_after_reset(tmp_path):
+    '''
+    Tests that the token of a connection reset by its client can be resumed,
+    and that the reset connection no longer receives pushes
+    '''
+    dsu_server = _wal_server(tmp_path)
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    server_side, address = listener.accept()
+    handler = threading.Thread(target=dsu_server.handle_client,
+                               args=(server_side, address), daemon=True)
+    handler.start()
+    client.sendall(JOIN + b'\r\n')
+    token = _read_lines(client, 1)[0]['token']
+    client.sendall(json.dumps({'token': token, 'directmessage': 'subscribe'})
+                   .encode() + b'\r\n')
+    assert _read_lines(client, 1)[0]['type'] == 'ok'
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                      struct.pack('ii', 1, 0))
+    client.close()
+    handler.join(5)
+    listener.close()
+    assert not handler.is_alive()
+    assert dsu_server.subscribers == {}
+
+    client, _ = _connect(dsu_server)
+    client.sendall(json.dumps({'resume': {'token': token}}).encode() + b'\r\n')
+    assert _read_lines(client, 1)[0]['type'] == 'ok'
+    client.close()
+
+
+def _session(dsu_server, username):
+    '''
+    Returns a ClientSession joined as username whose frames are appended
+    to a list, and the list
+    '''
+    written = []
+    session = server.ClientSession(written.append, lambda: None)
+    join = {'join': {'username': username, 'password': username,
+                     'token': ''}}
+    dsu_server.handle_request(json.dumps(join).encode(), session)
+    written.clear()
+    return session, written
+
+
+def _request(dsu_server, session, **fields):
+    '''
+    Sends a directmessage request on session and returns its response
+    '''
+    request = {'token': session.token, 'directmessage': fields or 'new'}
+    response = dsu_server.handle_request(json.dumps(request).encode(),
+                                         session)
+    return json.loads(response)['response']
+
+
+def _wait_for(condition):
+    '''
+    Waits up to 5 seconds for condition() to be true
+    '''
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_subscribe_pushes_after_response(tmp_path):
+    '''
+    Tests that no push is written before the subscribe response, and that
+    messages sent in between are pushed once it is
+    '''
+    dsu_server = _wal_server(tmp_path)
+    sender, _ = _session(dsu_server, 'qwer')
+    subscriber, written = _session(dsu_server, 'asdf')
+    subscribe = {'token': subscriber.token, 'directmessage': 'subscribe'}
+    response = dsu_server.handle_request(json.dumps(subscribe).encode(),
+                                         subscriber)
+    _request(dsu_server, sender, entry='Hi', recipient='asdf', timestamp='')
+    assert written == []
+
+    subscriber.send(response)
+    dsu_server._start_pushes(subscriber)
+    _wait_for(lambda: len(written) == 2)
+    push = json.loads(written[1])['response']
+    assert push['type'] == 'push'
+    assert [msg['message'] for msg in push['messages']] == ['Hi']
+
+
+def test_pushed_messages_stay_new(tmp_path):
+    '''
+    Tests that each message is pushed once to a connection, and is still
+    new for the next request
+    '''
+    dsu_server = _wal_server(tmp_path)
+    sender, _ = _session(dsu_server, 'qwer')
+    subscriber, written = _session(dsu_server, 'asdf')
+    subscriber.subscribing = 'asdf'
+    dsu_server._start_pushes(subscriber)
+    for entry in ('One', 'Two'):
+        _request(dsu_server, sender, entry=entry, recipient='asdf',
+                 timestamp='')
+    _wait_for(lambda: len(written) == 2)
+    pushes = [json.loads(frame)['response']['messages'] for frame in written]
+    assert [[msg['message'] for msg in push] for push in pushes] == [
+        ['One'], ['Two']]
+
+    other, _ = _session(dsu_server, 'asdf')
+    assert [msg['message'] for msg in _request(dsu_server, other)
+            ['messages']] == ['One', 'Two']
+
+
+def test_slow_subscriber(tmp_path, monkeypatch):
+    '''
+    Tests that a subscriber whose pushes pile up unwritten is disconnected
+    without blocking the sender
+    '''
+    monkeypatch.setattr(server, 'PUSH_BACKLOG_LIMIT', 300)
+    dsu_server = _wal_server(tmp_path)
+    sender, _ = _session(dsu_server, 'qwer')
+    blocked = threading.Event()
+    aborted = threading.Event()
+    subscriber = server.ClientSession(lambda data: blocked.wait(),
+                                      aborted.set)
+    join = {'join': {'username': 'asdf', 'password': 'asdf', 'token': ''}}
+    dsu_server.handle_request(json.dumps(join).encode(), subscriber)
+    subscriber.subscribing = 'asdf'
+    dsu_server._start_pushes(subscriber)
+    for i in range(3):
+        response = _request(dsu_server, sender, entry=f'Message {i}',
+                            recipient='asdf', timestamp='')
+        assert response['type'] == 'ok'
+    assert aborted.is_set()
+    blocked.set()
+    subscriber.close()
+
+
+def test_command_validate():
+    '''
+    Tests that a command reports the error of the first rule it breaks,
+    including rules that fail on a field of the wrong type
+    '''
+    command = server.Command('count', [
+        (lambda cmd: 'count' in cmd, 'Missing count.'),
+        (lambda cmd: cmd['count'] > 0, 'Invalid count.'),
+        (lambda cmd: cmd['count'].bit_length() < 8, 'Count too large.'),
+    ], None, False, None)
+    assert command.validate({}) == 'Missing count.'
+    assert command.validate({'count': 'a'}) == 'Invalid count.'
+    assert command.validate({'count': 0}) == 'Invalid count.'
+    assert command.validate({'count': 256}) == 'Count too large.'
+    assert command.validate({'count': 3}) is None
+
+    join = server.Command('join', server.COMMAND_SCHEMAS['join'], None,
+                          False, None)
+    assert join.validate({'join': 'x'}) == \
+        'Missing required fields for join command object.'
+    assert join.validate({'join': {'username': 'a', 'password': 'b',
+                                   'token': '', 'encoding': 'binary'}}) \
+        is None
+
+
+def test_dispatch(tmp_path):
+    '''
+    Tests that _dispatch routes a request to the handler of its command and
+    variant, with the user of the session, and labels it for the stats
+    '''
+    dsu_server = _wal_server(tmp_path)
+    calls = []
+
+    def handler(name):
+        return lambda command, session, user: (
+            calls.append((name, user)) or ('ok', {'message': name}))
+
+    dsu_server.register_command('echo', [(lambda cmd: 'token' in cmd,
+                                          'Missing token.')], {
+        'loud': handler('loud'), 'quiet': handler('quiet'),
+    }, requires_user=True, variant=lambda cmd: cmd['echo'])
+    session, _ = _session(dsu_server, 'qwer')
+    assert dsu_server._dispatch({'echo': 'loud'}, session) == (
+        'error', {'message': 'Missing token.'}, 'echo')
+    assert dsu_server._dispatch({'echo': 'quiet', 'token': 'bad'},
+                                session) == (
+        'error', {'message': 'Invalid user token.'}, 'echo quiet')
+    assert dsu_server._dispatch({'echo': 'loud', 'token': session.token},
+                                session) == (
+        'ok', {'message': 'loud'}, 'echo loud')
+    assert calls == [('loud', 'qwer')]
+    for request in ([1, 2], {}, {'nothing': 1}):
+        assert dsu_server._dispatch(request, session) == (
+            'error', {'message': 'Invalid command.'}, 'invalid')
+
+    dsu_server.handle_request(b'not json', session)
+    dsu_server.handle_request(json.dumps({'echo': 'quiet',
+                                          'token': session.token}).encode(),
+                              session)
+    commands = dsu_server.stats.summary()['commands']
+    assert commands['invalid']['error']['count'] == 1
+    assert commands['echo quiet']['ok']['count'] == 1
+
+
+def test_command_stats():
+    '''
+    Tests the latency histograms, their percentiles and their report
+    '''
+    stats = server.CommandStats()
+    for _ in range(98):
+        stats.record('join', 'ok', 0.0002)
+    stats.record('join', 'ok', 0.03)
+    stats.record('join', 'ok', 0.04)
+    stats.record('join', 'error', 10)
+    stats.record('bio', 'ok', 0.00005)
+    summary = stats.summary()
+    assert summary['buckets'] == server.LATENCY_BUCKETS
+    join = summary['commands']['join']['ok']
+    assert join['count'] == 100
+    assert (join['p50'], join['p99']) == (0.00025, 0.05)
+    assert join['histogram'][1] == 98
+    error = summary['commands']['join']['error']
+    assert (error['p50'], error['p99']) == (None, None)
+    assert error['histogram'][-1] == 1
+    assert summary['commands']['bio']['ok']['p99'] == 0.0001
+
+    lines = stats.report().splitlines()
+    assert lines[0].split() == ['command', 'outcome', 'count', 'p50', 'ms',
+                                'p99', 'ms']
+    assert [line.split() for line in lines[1:]] == [
+        ['join', 'error', '1', 'slower', 'slower'],
+        ['join', 'ok', '100', '0.25', '50.00'],
+        ['bio', 'ok', '1', '0.10', '0.10']]
+    assert server._percentile([0, 0, 3], 0.5) == 0.0005
+
+
+# Requests of a session recorded against the server before the command
+# router, on two connections, with the responses it gave: the message of
+# the errors, or the response with ... for values that change between runs.
+# TOKEN stands for the token of the user joined on the first connection.
+RECORDED_SESSION = [
+    (0, b'nope', 'Incorrectly formatted JSON message.'),
+    (0, b'[1,2]', 'Invalid command.'),
+    (0, b'"join"', 'Incorrectly formatted join command.'),
+    (0, b'"xbio"', 'Missing token.'),
+    (0, b'{}', 'Invalid command.'),
+    (0, {'bio': {}}, 'Missing token.'),
+    (0, {'join': 'x'}, 'Missing required fields for join command object.'),
+    (0,
+     {'join': {'username': 'a'}},
+     'Missing required fields for join command object.'),
+    (0,
+     {'join': {'username': 'd1',
+               'password': 'p',
+               'token': '',
+               'x': 1,
+               'y': 2}},
+     'Extra fields provided to join command object.'),
+    (0,
+     {'join': {'username': 'd1',
+               'password': 'p',
+               'token': '',
+               'encoding': 'xml'}},
+     'Unsupported encoding.'),
+    (0,
+     {'join': {'username': 'd1',
+               'password': 'p',
+               'token': '',
+               'compression': 'lz4'}},
+     'Unsupported compression.'),
+    (0,
+     {'join': {'username': 'd1', 'password': 'p', 'token': ''},
+      'bio': {}},
+     'Incorrectly formatted join command.'),
+    (0, {'resume': 'x'}, 'Incorrectly formatted resume command.'),
+    (0,
+     {'resume': {}},
+     'Missing required fields for resume command object.'),
+    (0, {'resume': {'token': 'zz'}}, 'Unable to resume the session.'),
+    (0,
+     {'resume': {'token': 'zz', 'a': 1}},
+     'Extra fields provided to resume command object.'),
+    (0,
+     {'token': 'x', 'bio': {'entry': 'e', 'timestamp': 't'}},
+     'Invalid user token.'),
+    (0, {'bio': {'entry': 'e'}}, 'Missing token.'),
+    (0,
+     {'join': {'username': 'd1', 'password': 'p', 'token': ''}},
+     {'type': 'ok',
+      'message': 'Welcome to ICS32 Distributed Social, d1!',
+      'token': ...,
+      'capabilities': ['pipelining',
+                       'push',
+                       'resume',
+                       'binary',
+                       'compression']}),
+    (0,
+     {'join': {'username': 'd1', 'password': 'p', 'token': ''}},
+     'User already joined on the active session.'),
+    (1,
+     {'join': {'username': 'd1', 'password': 'wrong', 'token': ''}},
+     'Incorrect password for the user d1'),
+    (1,
+     {'join': {'username': 'd2', 'password': 'p', 'token': ''}},
+     {'type': 'ok',
+      'message': 'Welcome to ICS32 Distributed Social, d2!',
+      'token': ...,
+      'capabilities': ['pipelining',
+                       'push',
+                       'resume',
+                       'binary',
+                       'compression']}),
+    (0,
+     {'token': 'TOKEN', 'bio': {'entry': 'e', 'timestamp': 't'}},
+     {'type': 'ok', 'message': 'Bio for d1 updated.', 'token': ...}),
+    (0,
+     {'token': 'TOKEN', 'bio': {'entry': 'e', 'timestamp': 't', 'x': 1}},
+     'Extra fields provided to bio command object.'),
+    (0,
+     {'token': 'TOKEN', 'bio': {'entry': 'e'}},
+     'Missing required fields for bio command object.'),
+    (0,
+     {'token': 'TOKEN', 'post': {'entry': 'e', 'timestamp': 't'}},
+     {'type': 'ok', 'message': 'Post created by d1', 'token': ...}),
+    (0,
+     {'token': 'TOKEN', 'post': {'entry': 'e'}},
+     'Missing required fields for post command.'),
+    (0,
+     {'token': 'TOKEN', 'post': {'entry': 'e', 'timestamp': 't'}, 'x': 1},
+     'Incorrectly formatted post command.'),
+    (0,
+     {'token': 'TOKEN',
+      'directmessage': {'entry': 'hi',
+                        'recipient': 'd2',
+                        'timestamp': '1'}},
+     {'type': 'ok',
+      'message': 'Direct message sent',
+      'record': {'recipient': 'd2',
+                 'message': 'hi',
+                 'timestamp': ...,
+                 'id': ...}}),
+    (0,
+     {'token': 'TOKEN',
+      'directmessage': {'entry': 'hi',
+                        'recipient': 'nobody',
+                        'timestamp': '1'}},
+     'Unable to send direct message'),
+    (0,
+     {'token': 'TOKEN',
+      'directmessage': {'entry': 'hi', 'recipient': 'd2', 'x': '1'}},
+     'Missing required fields for directmessage command.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': 'bogus'},
+     'Incorrect fields provided to directmessage command object.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'since': -1}},
+     'Invalid cursor provided to directmessage command.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'since': 'a'}},
+     'Invalid cursor provided to directmessage command.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'since': 0}},
+     {'type': 'ok',
+      'messages': [{'recipient': 'd2',
+                    'message': 'hi',
+                    'timestamp': ...,
+                    'id': ...}],
+      'cursor': ...}),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'all': {}}},
+     {'type': 'ok',
+      'messages': [{'recipient': 'd2',
+                    'message': 'hi',
+                    'timestamp': ...,
+                    'id': ...}],
+      'cursor': None}),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'all': {'limit': 1}}},
+     {'type': 'ok',
+      'messages': [{'recipient': 'd2',
+                    'message': 'hi',
+                    'timestamp': ...,
+                    'id': ...}],
+      'cursor': None}),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'all': {'limit': 0}}},
+     'Invalid limit or before provided to directmessage command.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'all': {'x': 1}}},
+     'Incorrect fields provided to directmessage all object.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': {'all': 5}},
+     'Incorrect fields provided to directmessage all object.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': 'all'},
+     {'type': 'ok',
+      'messages': [{'recipient': 'd2',
+                    'message': 'hi',
+                    'timestamp': ...,
+                    'id': ...}]}),
+    (0,
+     {'token': 'TOKEN', 'directmessage': 'new'},
+     {'type': 'ok', 'messages': []}),
+    (0, {'token': 'bad', 'directmessage': 'new'}, 'Invalid user token.'),
+    (0, {'directmessage': 'new'}, 'Missing token.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': 'new', 'x': 1},
+     'Incorrectly formatted directmessage command.'),
+    (0,
+     {'token': 'TOKEN', 'directmessage': 'subscribe'},
+     {'type': 'ok', 'messages': []}),
+    (0,
+     {'token': 'TOKEN', 'directmessage': 'new'},
+     {'type': 'ok', 'messages': []}),
+    (0,
+     {'token': 'bad', 'directmessage': {'since': 0}},
+     'Invalid user token.'),
+
+]
+
+
+def _matches(value, expected):
+    '''
+    Returns whether value matches expected, where ... matches anything
+    '''
+    if expected is ...:
+        return True
+    if type(expected) is dict:
+        return type(value) is dict and value.keys() == expected.keys() and \
+            all(_matches(value[key], expected[key]) for key in expected)
+    if type(expected) is list:
+        return type(value) is list and len(value) == len(expected) and \
+            all(map(_matches, value, expected))
+    return value == expected
+
+
+def test_recorded_session(tmp_path):
+    '''
+    Tests that the server still answers every request of the recorded
+    session, valid or not, as it did before the command router
+    '''
+    dsu_server = _wal_server(tmp_path)
+    clients = [_connect(dsu_server)[0] for _ in range(2)]
+    token = ''
+    for connection, request, expected in RECORDED_SESSION:
+        client = clients[connection]
+        client.settimeout(5)
+        if type(request) is not bytes:
+            request = json.dumps(request).replace(
+                '"TOKEN"', json.dumps(token)).encode()
+        client.sendall(request + b'\r\n')
+        response = _read_lines(client, 1)[0]
+        if type(expected) is str:
+            expected = {'type': 'error', 'message': expected}
+        assert _matches(response, expected), request
+        if connection == 0 and response.get('token'):
+            token = response['token']
+    for client in clients:
+        client.close()